@@ -0,0 +1,134 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+"""Times the searches behind the main window on a synthetic library. For each search mode it measures how long
+the first page takes to arrive, how long a page deep into the results takes, and how long it takes to go
+through every page. Results go to a JSON file, see compare.py for comparing two of them.
+
+python benchmarks/bench_queries.py --rows 100000 --out before.json
+python benchmarks/bench_queries.py --rows 100000 --tag-index --out after.json"""
+
+
+def time_pages(make_search, deep_page, max_pages=None):
+
+    """(first page seconds, (deep page number, seconds), full iteration seconds, pages, rows) for a
+    search. Every measurement starts a fresh search, as the main window does for each new query.
+    The full iteration stops after max_pages, paging by OFFSET gets slower with every page."""
+
+    search = make_search()
+    first, page = synthetic.timed(next, search, None)
+    search.close()  # gives the reader connection back to the pool
+
+    search = make_search()
+    deep = None
+    for number in range(1, deep_page + 1):
+        seconds, page = synthetic.timed(next, search, None)
+        if page is None:
+            break
+        deep = (number, seconds)
+    search.close()
+
+    def exhaust():
+        search = make_search()
+        sizes = [len(x) for x, number in zip(search, range(max_pages or sys.maxsize))]
+        search.close()
+        return sizes
+
+    full, sizes = synthetic.timed(exhaust)
+    return first, deep, full, len(sizes), sum(sizes)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Times the main window searches on a synthetic library")
+    parser.add_argument("--rows", type=int, default=10000, help="videos in the synthetic library")
+    parser.add_argument("--tags-1", type=int, default=16, help="tags in tag_group_1")
+    parser.add_argument("--tags-2", type=int, default=8, help="tags in tag_group_2")
+    parser.add_argument("--skew", type=float, default=1.0, help="how much more common the first tags are")
+    parser.add_argument("--untagged", type=float, default=0.2, help="fraction of videos with no tags")
+    parser.add_argument("--directories", type=int, default=20)
+    parser.add_argument("--thumb-bytes", type=int, default=4096, help="size of each thumbnail blob")
+    parser.add_argument("--deep-page", type=int, default=20, help="which page to time as the deep page")
+    parser.add_argument("--max-pages", type=int, help="stop the full iteration after this many pages")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per mode, the median is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workspace", help="directory for the library, a temporary one is used by default")
+    parser.add_argument("--reuse", action="store_true", help="use the library already in --workspace")
+    parser.add_argument("--tag-index", action="store_true", help="search with the numpy tag index, see tagindex.py")
+    parser.add_argument("--out", default="query_results.json")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    path = args.workspace or tempfile.mkdtemp(prefix="bench_queries_")
+    settings = synthetic.workspace(path, TAG_INDEX=args.tag_index)
+    db_path = settings["SQLPATH"]
+    if not (args.reuse and os.path.exists(db_path)):
+        print(f"Building a library of {args.rows} videos in {db_path}...")
+        seconds, dirs = synthetic.timed(synthetic.build_library, db_path, args.rows, args.tags_1, args.tags_2,
+                                        args.skew, args.untagged, 0.05, args.directories, args.thumb_bytes,
+                                        args.seed)
+        print(f"Built in {seconds:.1f} s")
+
+    from dbman_v4 import DBManager  # only importable once the workspace exists
+    opened, db = synthetic.timed(DBManager, db_path)  # includes migrations and the text index on first open
+    directory = db.read_one('''select directory from videos group by directory order by count(*) desc''')[0]
+    tag_1, tag_2 = db.tag_group_1[0], db.tag_group_2[0]  # the most common tags
+    word = synthetic.WORDS[0]
+
+    def in_directory(search):
+        def make():
+            db.filter_directory = directory
+            try:
+                yield from search()
+            finally:
+                db.filter_directory = None
+        return make
+
+    def listed(func, *a):
+        def make():
+            yield func(*a)  # path_generator returns everything at once, so it is a single page
+        return make
+
+    modes = (("matches", lambda: db.get_matches([tag_1], [tag_2])),
+             ("matches in directory", in_directory(lambda: db.get_matches([tag_1], [tag_2]))),
+             ("newest", lambda: db.newest_matches([tag_1], [])),
+             ("newest in directory", in_directory(lambda: db.newest_matches([tag_1], []))),
+             ("popular", lambda: db.popular_search([tag_1], [])),
+             ("least popular", lambda: db.popular_search([], [], most_popular=False)),
+             ("title search", lambda: db.text_search(word)),
+             ("untagged in directory", listed(db.path_generator, directory)),
+             ("untagged", listed(db.path_generator, None, True)))
+
+    results = []
+    for name, make_search in modes:
+        runs = [time_pages(make_search, args.deep_page, args.max_pages) for x in range(args.repeat)]
+        first, deep, full, pages, rows = zip(*runs)
+        result = {"name": name,
+                  "first_page_ms": round(synthetic.median(first) * 1000, 3),
+                  "deep_page": deep[0][0] if deep[0] else None,
+                  "deep_page_ms": round(synthetic.median([x[1] for x in deep]) * 1000, 3) if deep[0] else None,
+                  "full_ms": round(synthetic.median(full) * 1000, 3),
+                  "pages": pages[0],
+                  "rows": rows[0]}
+        results.append(result)
+        print(f"{name:<24}first {result['first_page_ms']:>10.2f} ms   "
+              f"page {result['deep_page']} {result['deep_page_ms'] or 0:>10.2f} ms   "
+              f"all {result['pages']} pages {result['full_ms']:>10.2f} ms   {result['rows']} rows")
+    db.commit_changes()
+
+    params = dict(vars(args), open_ms=round(opened * 1000, 3))
+    params.pop("out")
+    synthetic.write_results(out, "queries", params, results)
+    if not args.workspace:
+        os.chdir(synthetic.REPO)
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
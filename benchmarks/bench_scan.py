@@ -0,0 +1,130 @@
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+"""Times the ingest and thumbnail pipeline on a fake library, using stand-ins for ffmpeg and ffprobe so it runs
+on any Linux box without real videos (or --backend synthetic to leave external programs out altogether).
+Measures files per second, ffmpeg/ffprobe processes spawned per file and, for the tagging window's prefetcher,
+how long the user is kept waiting for the next video.
+
+python benchmarks/bench_scan.py --files 1000 --ffmpeg-ms 80 --out before.json"""
+
+
+def quietly(func, *args, **kwargs):
+
+    """The pipeline prints a line or more per file, which would swamp the results and slow the run down"""
+
+    with redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def rates(name, seconds, files, spawned, **extra):
+
+    result = {"name": name,
+              "files": files,
+              "total_ms": round(seconds * 1000, 3),
+              "files_per_sec": round(files / seconds, 2) if seconds else None,
+              "ffmpeg_per_file": round(spawned["ffmpeg"] / files, 2) if files else None,
+              "ffprobe_per_file": round(spawned["ffprobe"] / files, 2) if files else None}
+    result.update(extra)
+    print(f"{name:<16}{result['files']:>6} files {result['files_per_sec'] or 0:>10.1f} files/s   "
+          f"{result['ffmpeg_per_file']} ffmpeg + {result['ffprobe_per_file']} ffprobe per file")
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Times scanning and thumbnailing with stand-in ffmpeg/ffprobe")
+    parser.add_argument("--files", type=int, default=300, help="files in the fake library")
+    parser.add_argument("--directories", type=int, default=10)
+    parser.add_argument("--size-kb", type=int, default=256, help="size of each file, all of it gets hashed")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="fraction of files that are copies")
+    parser.add_argument("--broken", type=float, default=0.02, help="fraction of files ffprobe can't read")
+    parser.add_argument("--probe-ms", type=float, default=20, help="how long each ffprobe run takes")
+    parser.add_argument("--ffmpeg-ms", type=float, default=50, help="how long each ffmpeg run takes")
+    parser.add_argument("--thumbnail-files", type=int, default=30, help="videos to make thumbnails for")
+    parser.add_argument("--backend", default="subprocess", help="media backend, see mediabackend.py")
+    parser.add_argument("--tag-ms", type=float, default=0,
+                        help="time the user spends on each video in the tagging window")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workspace", help="directory for the library, a temporary one is used by default")
+    parser.add_argument("--out", default="scan_results.json")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    path = os.path.abspath(args.workspace or tempfile.mkdtemp(prefix="bench_scan_"))
+    os.makedirs(path, exist_ok=True)
+    ffmpeg, ffprobe, log = synthetic.make_media_standins(path, args.probe_ms / 1000, args.ffmpeg_ms / 1000)
+    # the main window's settings are needed too because ThumbGenerator lives in tk26
+    settings = synthetic.workspace(path, FFMPEG_PATH=ffmpeg, FFPROBE_PATH=ffprobe, MEDIA_BACKEND=args.backend,
+                                   QUERY_X=6, QUERY_Y=4)
+    top = settings["TOP_LEVEL"]
+    shutil.rmtree(top)
+    print(f"Writing {args.files} files to {top}...")
+    paths = synthetic.make_tree(top, args.files, args.directories, args.size_kb * 1024, args.duplicates,
+                                args.broken, args.seed)
+    if os.path.exists(settings["SQLPATH"]):
+        os.remove(settings["SQLPATH"])
+
+    from dbman_v4 import DBManager, ScanProgress  # only importable once the workspace exists
+    from videoobject import VideoObject
+    from tk26 import ThumbGenerator
+
+    results = []
+    db = quietly(DBManager, settings["SQLPATH"])
+    synthetic.count_spawns(log)
+    for name in ("scan", "rescan"):  # the rescan finds nothing new, which is the common case
+        progress = ScanProgress()
+        seconds, unused = synthetic.timed(quietly, db.scan_for_new_files, top, progress)
+        results.append(rates(name, seconds, progress.walked, synthetic.count_spawns(log), **progress.snapshot()))
+
+    videos = [x for x in paths if os.path.exists(x) and "broken_" not in x][:args.thumbnail_files]
+
+    def thumbnails():
+        for x in videos:
+            VideoObject(x)
+
+    seconds, unused = synthetic.timed(quietly, thumbnails)
+    results.append(rates("thumbnails", seconds, len(videos), synthetic.count_spawns(log)))
+
+    # the tagging window takes a video from the prefetcher, the user tags it, then asks for the next one
+    def tagging():
+        waits = []
+        generator = ThumbGenerator(videos)
+        while True:
+            start = time.perf_counter()
+            obj = generator.get_next()
+            waits.append(time.perf_counter() - start)
+            if obj == -1:
+                return waits
+            time.sleep(args.tag_ms / 1000)
+
+    seconds, waits = synthetic.timed(quietly, tagging)
+    waits = [x * 1000 for x in waits]
+    results.append(rates("thumbgenerator", seconds, len(videos), synthetic.count_spawns(log),
+                         wait_p50_ms=round(synthetic.percentile(waits, 50), 3),
+                         wait_p95_ms=round(synthetic.percentile(waits, 95), 3),
+                         wait_max_ms=round(max(waits), 3)))
+    print(f"{'':<16}waited for the next video {results[-1]['wait_p50_ms']:.1f} ms median, "
+          f"{results[-1]['wait_p95_ms']:.1f} ms p95, {results[-1]['wait_max_ms']:.1f} ms max")
+    quietly(db.commit_changes)
+
+    params = vars(args).copy()
+    params.pop("out")
+    synthetic.write_results(out, "scan", params, results)
+    if not args.workspace:
+        os.chdir(synthetic.REPO)
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
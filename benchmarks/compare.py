@@ -0,0 +1,21 @@
+import json
+from sys import argv
+
+"""Standalone script to be invoked from the command line, compares two benchmark result files, e.g. from before
+and after a change: python benchmarks/compare.py before.json after.json
+
+Every timing (fields ending in _ms) is shown side by side with the ratio after / before, so below 1 is faster."""
+
+with open(argv[1], "r") as f:
+    before = json.load(f)
+with open(argv[2], "r") as f:
+    after = json.load(f)
+
+print(f"{before['benchmark']}: {before['environment']['commit']} -> {after['environment']['commit']}")
+old_results = {x["name"]: x for x in before["results"]}
+for new in after["results"]:
+    old = old_results.get(new["name"], {})
+    for field, value in new.items():
+        if not field.endswith("_ms") or value is None or not old.get(field):
+            continue
+        print(f"{new['name']:<28}{field:<20}{old[field]:>12.2f}{value:>12.2f}{value / old[field]:>8.2f}x")
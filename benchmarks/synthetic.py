@@ -0,0 +1,244 @@
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+"""Shared helpers for the benchmarks: a throwaway workspace with its own settings.json, a synthetic library
+built through schema.sql, a fake media tree with stand-ins for ffmpeg and ffprobe, and machine-readable results.
+The program reads settings.json and deletion_whitelist.txt from the current directory when it is imported, so
+workspace() has to be called before anything from the main program is imported."""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("holiday", "beach", "garden", "birthday", "concert", "wedding", "mountain", "river", "city", "night",
+         "snow", "summer", "winter", "party", "family", "school", "trip", "lake", "forest", "bridge", "harbour",
+         "market", "festival", "museum", "train", "airport", "sunset", "morning", "dinner", "football", "race",
+         "parade", "castle", "island", "desert", "canyon", "village", "street", "garage", "kitchen")
+
+DAY = 86400
+
+
+def workspace(path, **overrides):
+
+    """Creates a scratch directory holding everything the program expects to find in the current directory,
+    changes into it and makes the program importable. Folders named in the settings are created inside it.
+    Returns the settings dict that was written."""
+
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(REPO, "settings.json"), "r") as f:
+        settings = json.load(f)
+    settings.update({"TOP_LEVEL": os.path.join(path, "library"),
+                     "SQLPATH": os.path.join(path, "library.sqlite3"),
+                     "DUPES_FOLDER": os.path.join(path, "dupes"),
+                     "TRASH_FOLDER": os.path.join(path, "trash"),
+                     "BROKEN_FOLDER": os.path.join(path, "broken")})
+    settings.update(overrides)
+    for key in ("TOP_LEVEL", "DUPES_FOLDER", "TRASH_FOLDER", "BROKEN_FOLDER"):
+        os.makedirs(settings[key], exist_ok=True)
+    with open(os.path.join(path, "settings.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    with open(os.path.join(path, "deletion_whitelist.txt"), "w") as f:
+        f.write("")
+    shutil.copy(os.path.join(REPO, "schema.sql"), path)
+    os.chdir(path)
+    if REPO not in sys.path:
+        sys.path.insert(0, REPO)
+
+    return settings
+
+
+def tag_names(group, count):
+
+    return [f"{group}_{i}" for i in range(count)]
+
+
+def build_library(db_path, rows=10000, tags_1=16, tags_2=8, skew=1.0, untagged=0.2, skipped=0.05,
+                  directories=20, thumb_bytes=4096, seed=1):
+
+    """Fills a new database, made from schema.sql, with rows of made-up videos and a thumbnail for each.
+    Tag i of a group is set on a row with probability 0.5 / (i + 1) ** skew, so a few tags are very common
+    and most are rare like in a real library. untagged and skipped are the fractions of rows with no tags
+    at all and with the skipped flag. Every thumbnail is the same random blob of thumb_bytes."""
+
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    with open(os.path.join(REPO, "schema.sql"), "r") as f:
+        db.executescript(f.read())
+    for table, count in (("tag_group_1", tags_1), ("tag_group_2", tags_2)):
+        db.executemany(f"insert into {table} (tag, value) values (?, ?)",
+                       [(name, 1 << i) for i, name in enumerate(tag_names(table, count))])
+    odds_1 = [0.5 / (i + 1) ** skew for i in range(tags_1)]
+    odds_2 = [0.5 / (i + 1) ** skew for i in range(tags_2)]
+    dirs = [f"{rng.choice(WORDS)}_{i}" for i in range(directories)]
+    thumbnail = os.urandom(thumb_bytes)
+    now = time.time()
+
+    def score(odds):
+        return sum(1 << i for i, p in enumerate(odds) if rng.random() < p)
+
+    batch = []
+    for n in range(rows):
+        directory = rng.choice(dirs)
+        filename = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{n}.mp4"
+        fullpath = os.path.join(directory, filename)
+        if rng.random() < untagged:
+            score_1 = score_2 = tagged_when = None
+        else:
+            score_1, score_2 = score(odds_1), score(odds_2)
+            tagged_when = int(now - rng.random() * 365 * DAY)  # a year of tagging, some of it recent
+        batch.append((fullpath, filename, rng.randint(10 ** 6, 4 * 10 ** 9), directory,
+                      now - rng.random() * 3 * 365 * DAY, int(rng.random() < skipped), 1920, 1080,
+                      score_1, score_2, "%032x" % rng.getrandbits(128), rng.uniform(10, 3600),
+                      int(rng.expovariate(0.5)), tagged_when, n + 1, thumbnail))
+        if len(batch) == 10000 or n == rows - 1:
+            db.executemany('''insert into videos (fullpath, filename, filesize, directory, created, skipped, width,
+                            height, score_1, score_2, md5, duration, times_viewed, tagged_when, inode)
+                            values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', [x[:-1] for x in batch])
+            db.executemany('''insert into thumbnails (fullpath, thumbnail) values (?, ?)''',
+                           [(x[0], x[-1]) for x in batch])
+            db.commit()
+            batch = []
+    db.close()
+
+    return dirs
+
+
+def make_tree(top, files=500, directories=10, size_bytes=262144, duplicates=0.05, broken=0.02, seed=1):
+
+    """Writes files of random bytes under top, spread over directories. A fraction are byte for byte copies of an
+    earlier file, and a fraction have "broken_" in their name, which the stand-in ffprobe refuses to read.
+    Returns the list of paths written."""
+
+    rng = random.Random(seed)
+    paths = []
+    for n in range(files):
+        directory = os.path.join(top, f"{WORDS[n % directories % len(WORDS)]}_{n % directories}")
+        os.makedirs(directory, exist_ok=True)
+        prefix = "broken_" if rng.random() < broken else ""
+        path = os.path.join(directory, f"{prefix}{rng.choice(WORDS)}_{n}.mp4")
+        if paths and rng.random() < duplicates:
+            shutil.copyfile(rng.choice(paths), path)
+        else:
+            with open(path, "wb") as f:
+                f.write(rng.randbytes(size_bytes))
+        paths.append(path)
+
+    return paths
+
+
+# stand-ins for the real programs, as shell scripts since /bin/sh starts far faster than another python. Each run
+# appends its name to a log so the benchmark can count processes spawned. The real ffmpeg does a lot more work
+# than this, so the latency setting is what decides how representative the numbers are.
+FFPROBE_SCRIPT = '''#!/bin/sh
+echo ffprobe >> "{log}"
+sleep {latency}
+case "$*" in
+    *broken_*) echo "Invalid data found when processing input" >&2; exit 1 ;;
+    *format=duration*) echo '{{"streams": [{{"width": {width}, "height": {height}}}], "format": {{"duration": "{duration}"}}}}' ;;
+    *packet=*) echo 0.000000,K_; echo 0.040000,__; echo 2.000000,K_ ;;
+esac
+'''
+
+FFMPEG_SCRIPT = '''#!/bin/sh
+echo ffmpeg >> "{log}"
+sleep {latency}
+case "$*" in
+    *broken_*) exit 1 ;;
+esac
+cat "{image}"
+'''
+
+
+def make_media_standins(path, probe_latency=0.02, ffmpeg_latency=0.05, duration=600.0, width=1920, height=1080):
+
+    """Writes executable ffprobe and ffmpeg stand-ins into path, taking the given number of seconds per run.
+    ffprobe reports the given duration and resolution, ffmpeg outputs the same small JPEG for every frame.
+    Returns (ffmpeg path, ffprobe path, spawn log path)."""
+
+    from PIL import Image  # only needed here
+
+    log = os.path.join(path, "spawned.log")
+    image = os.path.join(path, "frame.jpg")
+    Image.new("RGB", (320, 240), (90, 120, 150)).save(image)
+    scripts = {"ffprobe": FFPROBE_SCRIPT.format(log=log, latency=probe_latency, duration=duration, width=width,
+                                                height=height),
+               "ffmpeg": FFMPEG_SCRIPT.format(log=log, latency=ffmpeg_latency, image=image)}
+    for name, script in scripts.items():
+        with open(os.path.join(path, name), "w") as f:
+            f.write(script)
+        os.chmod(os.path.join(path, name), 0o755)
+
+    return os.path.join(path, "ffmpeg"), os.path.join(path, "ffprobe"), log
+
+
+def count_spawns(log):
+
+    """{program: times run} since the log was last cleared, and clears it"""
+
+    counts = {"ffmpeg": 0, "ffprobe": 0}
+    if os.path.exists(log):
+        with open(log, "r") as f:
+            for line in f:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+        os.remove(log)
+
+    return counts
+
+
+def timed(func, *args, **kwargs):
+
+    """(seconds, result) of one call"""
+
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def median(values):
+
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def percentile(values, p):
+
+    """Nearest-rank percentile, p from 0 to 100"""
+
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def environment():
+
+    """What the numbers were measured on, so results from different commits or machines can be told apart"""
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:  # no git
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "when": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def write_results(path, benchmark, params, results):
+
+    """Saves one run as JSON: the parameters, the environment and a list of result dicts"""
+
+    out = {"benchmark": benchmark, "environment": environment(), "params": params, "results": results}
+    with open(path, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"Results written to {path}")
+
+    return out
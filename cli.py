@@ -0,0 +1,219 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import settings
+
+"""Runs the library jobs without the GUI, e.g. from cron on a server with no display:
+
+python cli.py scan                      look for new, moved and deleted videos
+python cli.py dedupe [--move] [--near]  report (and move away) duplicate videos
+python cli.py export library.csv        write every video and its tags to a csv or json file
+python cli.py thumbnails [--limit 100]  choose a thumbnail for videos that haven't got one
+python cli.py sheets [--recursive] DIR  make contact sheets for a folder, see get_contact_sheet.py
+python cli.py stats [--rebuild]         videos, untagged videos and GB per directory, and videos per tag
+python cli.py tag rename|merge|delete TAG [OTHER]   rename a tag, merge it into OTHER or delete it everywhere
+
+The settings and whitelist files can be given with --settings and --whitelist, otherwise they are read from the
+current directory as usual. Nothing here imports tkinter, and the modules a job needs are only imported once
+its arguments have been read."""
+
+
+def open_library(args):
+
+    from dbman_v4 import DBManager
+    from mediabackend import get_backend
+
+    return DBManager(settings.SETTINGS["SQLPATH"], get_backend(args.backend), args.top_level)
+
+
+def scan(args):
+
+    from dbman_v4 import ScanProgress
+
+    db = open_library(args)
+    try:
+        db.scan_for_new_files(db.top_level, ScanProgress())
+    finally:
+        db.commit_changes()
+
+
+def dedupe(args):
+
+    db = open_library(args)
+    try:
+        clusters = db.find_duplicates()
+        db.write_duplicate_report(clusters)
+        if args.move:
+            db.move_duplicates(clusters)
+        if args.near:
+            pairs = db.near_duplicates()
+            print(f"{len(pairs)} near duplicates, see {db.write_near_duplicate_report(pairs)}")
+    finally:
+        db.commit_changes()
+
+
+EXPORT_FIELDS = ("fullpath", "directory", "filename", "filesize", "duration", "width", "height", "created",
+                 "tagged_when", "times_viewed", "skipped", "tag_group_1", "tag_group_2")
+
+
+def export(args):
+
+    db = open_library(args)
+    count = 0
+    try:
+        rows = ({x: getattr(entry, x) for x in EXPORT_FIELDS} for entry in db.all_entries())
+        with open(args.out, "w", newline="", encoding="utf-8") as f:
+            if args.format == "json":
+                f.write("[\n")
+                for row in rows:
+                    f.write(("" if count == 0 else ",\n") + json.dumps(row))
+                    count += 1
+                f.write("\n]\n")
+            else:
+                writer = csv.DictWriter(f, EXPORT_FIELDS)
+                writer.writeheader()
+                for row in rows:
+                    row["tag_group_1"] = ";".join(row["tag_group_1"])
+                    row["tag_group_2"] = ";".join(row["tag_group_2"])
+                    writer.writerow(row)
+                    count += 1
+    finally:
+        db.commit_changes()
+    print(f"Exported {count} videos to {args.out}")
+
+
+def thumbnails(args):
+
+    """Uses the middle frame, the same one the tagging window picks when the user doesn't choose"""
+
+    from io import BytesIO
+    from videoobject import VideoObject, BadVideoException
+
+    db = open_library(args)
+    done = failed = 0
+    try:
+        paths = db.paths_without_thumbnail()[:args.limit]
+        print(f"Making thumbnails for {len(paths)} videos")
+        for path in paths:
+            try:
+                images = VideoObject(path, backend=db.media).images
+            except BadVideoException as e:
+                print(e)
+                failed += 1
+                continue
+            image_bytes = BytesIO()
+            images[len(images) // 2].save(image_bytes, "GIF")
+            db.assign_thumbnail(path, image_bytes.getvalue())
+            done += 1
+    finally:
+        db.commit_changes()
+    print(f"Made {done} thumbnails, {failed} videos could not be read")
+
+
+def sheets(args):
+
+    from get_contact_sheet import make_sheets
+
+    if make_sheets(args.directory, args.thumbnails, args.backend, args.recursive, args.out, args.workers,
+                   args.force):
+        return 1
+
+
+def stats(args):
+
+    """With --rebuild the statistics are recounted from scratch first, and the exit status is 1 if the tables
+    kept up to date by the database were wrong"""
+
+    db = open_library(args)
+    try:
+        wrong = db.rebuild_stats() if args.rebuild else 0
+        directories = db.directory_stats()
+        tags = db.tag_stats()
+    finally:
+        db.commit_changes()
+    print(f"{'videos':>10}{'untagged':>10}{'skipped':>10}{'GB':>10}  directory")
+    for directory, videos, untagged, skipped, size in directories:
+        print(f"{videos:>10}{untagged:>10}{skipped:>10}{size / 1024 ** 3:>10.2f}  {directory}")
+    print(f"{sum(x[1] for x in directories):>10}{sum(x[2] for x in directories):>10}"
+          f"{sum(x[3] for x in directories):>10}{sum(x[4] for x in directories) / 1024 ** 3:>10.2f}  total\n")
+    print(f"{'videos':>10}  tag")
+    for group, tag, videos in tags:
+        print(f"{videos:>10}  {tag} ({group})")
+    if wrong:
+        return 1
+
+
+def tag(args):
+
+    db = open_library(args)
+    try:
+        if args.tag not in db.tag_val_dict:
+            print(f"No such tag: {args.tag}")
+            return 1
+        if args.action == "rename":
+            done = db.rename_tag(args.tag, args.other)
+        elif args.action == "merge":
+            done = db.delete_tag(args.tag, args.other) is not None
+        else:
+            done = db.delete_tag(args.tag) is not None
+    finally:
+        db.commit_changes()
+    if not done:
+        return 1
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Library jobs for the video tagger, without the GUI")
+    parser.add_argument("--settings", help="settings file, settings.json in the current directory by default")
+    parser.add_argument("--whitelist", help="deletion whitelist file")
+    parser.add_argument("--top-level", help="library folder, TOP_LEVEL in the settings by default")
+    parser.add_argument("--backend", help="media backend, see mediabackend.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("scan", help="find new, moved and deleted videos").set_defaults(run=scan)
+    command = commands.add_parser("dedupe", help="report duplicate videos")
+    command.add_argument("--move", action="store_true", help="move the extra copies to the dupes folder")
+    command.add_argument("--near", action="store_true", help="also report videos that look the same")
+    command.set_defaults(run=dedupe)
+    command = commands.add_parser("export", help="write the library and its tags to a file")
+    command.add_argument("out")
+    command.add_argument("--format", choices=("csv", "json"), help="by default from the file's extension")
+    command.set_defaults(run=export)
+    command = commands.add_parser("thumbnails", help="make missing thumbnails")
+    command.add_argument("--limit", type=int, help="at most this many videos")
+    command.set_defaults(run=thumbnails)
+    command = commands.add_parser("sheets", help="make contact sheets for a folder of videos")
+    command.add_argument("directory")
+    command.add_argument("--thumbnails", type=int, default=9, help="thumbnails per sheet")
+    command.add_argument("--recursive", "-r", action="store_true", help="include videos in subfolders")
+    command.add_argument("--out", help="write the sheets here instead of next to the videos")
+    command.add_argument("--workers", type=int, help="processes to use, one per core by default")
+    command.add_argument("--force", action="store_true", help="remake sheets that are already up to date")
+    command.set_defaults(run=sheets)
+    command = commands.add_parser("stats", help="library statistics")
+    command.add_argument("--rebuild", action="store_true", help="recount from scratch and check the totals kept")
+    command.set_defaults(run=stats)
+    command = commands.add_parser("tag", help="rename, merge or delete a tag in the whole library")
+    command.add_argument("action", choices=("rename", "merge", "delete"))
+    command.add_argument("tag")
+    command.add_argument("other", nargs="?", help="the new name, or the tag to merge into")
+    command.set_defaults(run=tag)
+    args = parser.parse_args(argv)
+    if args.command == "export" and args.format is None:
+        args.format = "json" if args.out.lower().endswith(".json") else "csv"
+    if args.command == "tag" and (args.other is None) != (args.action == "delete"):
+        parser.error("rename and merge need the other tag, delete doesn't")
+
+    settings.configure(args.settings and os.path.abspath(args.settings),
+                       args.whitelist and os.path.abspath(args.whitelist))
+    start = time.perf_counter()
+    status = args.run(args)
+    print(f"{args.command} took {time.perf_counter() - start:.1f} s")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
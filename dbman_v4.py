@@ -1,16 +1,352 @@
 import sqlite3
-from collections import namedtuple
+from collections import namedtuple, Counter
 import os
 from hashlib import md5
-from videoobject import VideoObject, BadVideoException
+from mediabackend import get_backend, BadVideoException
+from perceptual import dhash_blob, to_signed, to_unsigned, near_pairs
+from instrumentation import connection_factory
 import time  # need for time of deletion in removed db
-import json
+import math
+import threading
+import queue
+import shlex
+from contextlib import contextmanager
 from shutil import move, Error
-from settings import SETTINGS, DELETION_WHITELIST
-DUPES_FOLDER = SETTINGS["DUPES_FOLDER"]
-TRASH_FOLDER = SETTINGS["TRASH_FOLDER"]
-BROKEN_FOLDER = SETTINGS["BROKEN_FOLDER"]
-TOP_LEVEL = SETTINGS["TOP_LEVEL"]
+from settings import SETTINGS, deletion_whitelist
+from tagindex import make_index
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+# changes made since schema.sql was first written. The database's user_version records how many of these have
+# been applied, and __init__ applies the rest in order, each in its own transaction, so any older database is
+# upgraded in place. Only ever append to this list. Every statement is safe to run on a database that already
+# has the change, because databases made from schema.sql start at version 0 too.
+MIGRATIONS = (
+    ("scan journal, inodes and perceptual signatures", (
+        # fingerprints and probe results of files seen by a scan that hasn't finished yet, so that a scan
+        # restarted after a crash or cancel doesn't have to read every file again. Cleared when a scan completes.
+        '''CREATE TABLE IF NOT EXISTS "scan_journal" ( "fullpath" text, "filesize" integer, "mtime" real,
+        "md5" text, "duration" real, "width" integer, "height" integer, PRIMARY KEY("fullpath") )''',
+        # 64 bit perceptual hash of each thumbnail, stored signed, see perceptual.py
+        '''CREATE TABLE IF NOT EXISTS "signatures" ( "fullpath" text, "dhash" integer, PRIMARY KEY("fullpath") )''',
+        # file id, lets a scan recognise moved files
+        '''ALTER TABLE "videos" ADD COLUMN "inode" integer''',
+    )),
+    # an index for each query in this module that runs while the user waits, see HOT_QUERIES. Secondary indexes
+    # store the rowid rather than the primary key, so fullpath is added to the end of each to make it covering
+    # and the query never has to look up the table row.
+    ("indexes for the hot queries", (
+        # duplicate grouping and the "same size as a new file" check during scans
+        '''DROP INDEX IF EXISTS "videos_filesize_md5"''',
+        '''CREATE INDEX IF NOT EXISTS "videos_filesize_md5" ON "videos" ("filesize", "md5", "fullpath")''',
+        # tag queries filtered to a directory, and the list of directories
+        '''CREATE INDEX IF NOT EXISTS "videos_directory" 
+        ON "videos" ("directory", "score_1", "score_2", "tagged_when", "fullpath")''',
+        # newest tagged first. Tags are bitmasks so they can't be searched, but the whole query is answered
+        # from this index which is a fraction of the size of the table
+        '''CREATE INDEX IF NOT EXISTS "videos_tagged_when" 
+        ON "videos" ("tagged_when", "directory", "score_1", "score_2", "fullpath")''',
+        # most/least watched
+        '''CREATE INDEX IF NOT EXISTS "videos_times_viewed" 
+        ON "videos" ("times_viewed", "skipped", "score_1", "score_2", "fullpath")''',
+        '''CREATE INDEX IF NOT EXISTS "videos_filename" ON "videos" ("filename", "fullpath")''',
+        # partial indexes only hold the rows their queries can return, so they stay small
+        '''CREATE INDEX IF NOT EXISTS "videos_untagged" 
+        ON "videos" ("directory", "skipped", "fullpath") WHERE score_1 IS NULL AND score_2 IS NULL''',
+        '''CREATE INDEX IF NOT EXISTS "videos_untagged_created" 
+        ON "videos" ("created", "skipped", "fullpath") WHERE score_1 IS NULL AND score_2 IS NULL''',
+        '''CREATE INDEX IF NOT EXISTS "videos_skipped" ON "videos" ("directory", "filesize") WHERE skipped = 1''',
+        '''ANALYZE''',  # gives the planner row counts to choose between the indexes with
+    )),
+    # the directory dropdown used to run select distinct over the whole table at startup. This small table holds
+    # each directory and how many videos are in it, kept up to date by triggers on every insert, move and removal
+    ("directory list", (
+        '''CREATE TABLE IF NOT EXISTS "directories" ( "directory" text NOT NULL, "videos" integer NOT NULL,
+        PRIMARY KEY("directory") )''',
+        '''CREATE TRIGGER IF NOT EXISTS directories_insert AFTER INSERT ON videos 
+        WHEN new.directory IS NOT NULL BEGIN
+            INSERT INTO directories (directory, videos) VALUES (new.directory, 1)
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS directories_delete AFTER DELETE ON videos 
+        WHEN old.directory IS NOT NULL BEGIN
+            UPDATE directories SET videos = videos - 1 WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS directories_update AFTER UPDATE OF directory ON videos 
+        WHEN old.directory IS NOT new.directory BEGIN
+            UPDATE directories SET videos = videos - 1 WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+            INSERT INTO directories (directory, videos) SELECT new.directory, 1 WHERE new.directory IS NOT NULL
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1;
+        END''',
+        '''DELETE FROM directories''',
+        '''INSERT INTO directories (directory, videos) 
+        SELECT directory, count(*) FROM videos WHERE directory IS NOT NULL GROUP BY directory''',
+    )),
+    # library statistics that would otherwise take a full scan decoding every score: the directories table also
+    # counts the untagged and skipped videos and the bytes in each directory, and tag_stats counts the videos
+    # with each tag. Both are kept up to date by triggers, see STATS_QUERIES for how to recompute them.
+    ("directory and tag statistics", (
+        '''ALTER TABLE "directories" ADD COLUMN "untagged" integer NOT NULL DEFAULT 0''',
+        '''ALTER TABLE "directories" ADD COLUMN "skipped" integer NOT NULL DEFAULT 0''',
+        '''ALTER TABLE "directories" ADD COLUMN "bytes" integer NOT NULL DEFAULT 0''',
+        '''CREATE TABLE IF NOT EXISTS "tag_stats" ( "grp" integer NOT NULL, "value" integer NOT NULL, 
+        "videos" integer NOT NULL, PRIMARY KEY("grp", "value") )''',
+        '''DROP TRIGGER IF EXISTS directories_insert''',
+        '''DROP TRIGGER IF EXISTS directories_delete''',
+        '''DROP TRIGGER IF EXISTS directories_update''',
+        # each trigger takes the old row's share off its directory and tags, and adds the new row's
+        '''CREATE TRIGGER IF NOT EXISTS stats_insert AFTER INSERT ON videos BEGIN
+            INSERT INTO directories (directory, videos, untagged, skipped, bytes) 
+            SELECT new.directory, 1, new.score_1 IS NULL AND new.score_2 IS NULL, new.skipped IS 1, 
+            coalesce(new.filesize, 0) WHERE new.directory IS NOT NULL
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1, untagged = untagged + excluded.untagged, 
+            skipped = skipped + excluded.skipped, bytes = bytes + excluded.bytes;
+            UPDATE tag_stats SET videos = videos + 1 
+            WHERE (grp = 1 AND new.score_1 & value) OR (grp = 2 AND new.score_2 & value);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_delete AFTER DELETE ON videos BEGIN
+            UPDATE directories SET videos = videos - 1, 
+            untagged = untagged - (old.score_1 IS NULL AND old.score_2 IS NULL), skipped = skipped - (old.skipped IS 1), 
+            bytes = bytes - coalesce(old.filesize, 0) WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+            UPDATE tag_stats SET videos = videos - 1 
+            WHERE (grp = 1 AND old.score_1 & value) OR (grp = 2 AND old.score_2 & value);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_update 
+        AFTER UPDATE OF directory, score_1, score_2, skipped, filesize ON videos BEGIN
+            UPDATE directories SET videos = videos - 1, 
+            untagged = untagged - (old.score_1 IS NULL AND old.score_2 IS NULL), skipped = skipped - (old.skipped IS 1), 
+            bytes = bytes - coalesce(old.filesize, 0) WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+            INSERT INTO directories (directory, videos, untagged, skipped, bytes) 
+            SELECT new.directory, 1, new.score_1 IS NULL AND new.score_2 IS NULL, new.skipped IS 1, 
+            coalesce(new.filesize, 0) WHERE new.directory IS NOT NULL
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1, untagged = untagged + excluded.untagged, 
+            skipped = skipped + excluded.skipped, bytes = bytes + excluded.bytes;
+            UPDATE tag_stats SET videos = videos 
+            + (CASE grp WHEN 1 THEN coalesce(new.score_1 & value, 0) != 0 ELSE coalesce(new.score_2 & value, 0) != 0 END)
+            - (CASE grp WHEN 1 THEN coalesce(old.score_1 & value, 0) != 0 ELSE coalesce(old.score_2 & value, 0) != 0 END)
+            WHERE (grp = 1 AND (coalesce(old.score_1, 0) | coalesce(new.score_1, 0)) & value) 
+            OR (grp = 2 AND (coalesce(old.score_2, 0) | coalesce(new.score_2, 0)) & value);
+        END''',
+        # a new tag starts with however many videos already have its bit, normally none
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_insert_1 AFTER INSERT ON tag_group_1 BEGIN
+            INSERT OR REPLACE INTO tag_stats (grp, value, videos) 
+            VALUES (1, new.value, (SELECT count(*) FROM videos WHERE score_1 & new.value));
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_insert_2 AFTER INSERT ON tag_group_2 BEGIN
+            INSERT OR REPLACE INTO tag_stats (grp, value, videos) 
+            VALUES (2, new.value, (SELECT count(*) FROM videos WHERE score_2 & new.value));
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_delete_1 AFTER DELETE ON tag_group_1 BEGIN
+            DELETE FROM tag_stats WHERE grp = 1 AND value = old.value;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_delete_2 AFTER DELETE ON tag_group_2 BEGIN
+            DELETE FROM tag_stats WHERE grp = 2 AND value = old.value;
+        END''',
+        '''DELETE FROM directories''',
+        '''INSERT INTO directories (directory, videos, untagged, skipped, bytes) 
+        SELECT directory, count(*), sum(score_1 IS NULL AND score_2 IS NULL), sum(skipped IS 1), 
+        coalesce(sum(filesize), 0) FROM videos WHERE directory IS NOT NULL GROUP BY directory''',
+        '''DELETE FROM tag_stats''',
+        '''INSERT INTO tag_stats (grp, value, videos) 
+        SELECT 1, value, (SELECT count(*) FROM videos WHERE score_1 & t.value) FROM tag_group_1 t''',
+        '''INSERT INTO tag_stats (grp, value, videos) 
+        SELECT 2, value, (SELECT count(*) FROM videos WHERE score_2 & t.value) FROM tag_group_2 t''',
+    )),
+    # a group's tags used to be the bits of one 64 bit integer. Each group now has WORDS integer columns, the
+    # existing score_1 and score_2 being the first, and a tag is known by its bit number across them. Existing
+    # scores don't change, they are the first word, and the words added are NULL, i.e. 0, until a video is
+    # tagged again. The tag statistics and covering indexes are rebuilt to take in the new words.
+    ("more than 64 tags in each group", (
+        '''ALTER TABLE "videos" ADD COLUMN "score_1_1" integer''',
+        '''ALTER TABLE "videos" ADD COLUMN "score_1_2" integer''',
+        '''ALTER TABLE "videos" ADD COLUMN "score_1_3" integer''',
+        '''ALTER TABLE "videos" ADD COLUMN "score_2_1" integer''',
+        '''ALTER TABLE "videos" ADD COLUMN "score_2_2" integer''',
+        '''ALTER TABLE "videos" ADD COLUMN "score_2_3" integer''',
+        # value is only filled in for tags in the first word from now on, bit is what the program goes by
+        '''ALTER TABLE "tag_group_1" ADD COLUMN "bit" integer''',
+        '''ALTER TABLE "tag_group_2" ADD COLUMN "bit" integer''',
+        '''WITH RECURSIVE bits(b) AS (SELECT 0 UNION ALL SELECT b + 1 FROM bits WHERE b < 63) 
+        UPDATE tag_group_1 SET bit = (SELECT b FROM bits WHERE 1 << b = value)''',
+        '''WITH RECURSIVE bits(b) AS (SELECT 0 UNION ALL SELECT b + 1 FROM bits WHERE b < 63) 
+        UPDATE tag_group_2 SET bit = (SELECT b FROM bits WHERE 1 << b = value)''',
+        '''DROP TRIGGER IF EXISTS stats_insert''',
+        '''DROP TRIGGER IF EXISTS stats_delete''',
+        '''DROP TRIGGER IF EXISTS stats_update''',
+        '''DROP TRIGGER IF EXISTS tag_stats_insert_1''',
+        '''DROP TRIGGER IF EXISTS tag_stats_insert_2''',
+        '''DROP TRIGGER IF EXISTS tag_stats_delete_1''',
+        '''DROP TRIGGER IF EXISTS tag_stats_delete_2''',
+        '''DROP TABLE IF EXISTS "tag_stats"''',
+        '''CREATE TABLE "tag_stats" ( "grp" integer NOT NULL, "bit" integer NOT NULL, 
+        "videos" integer NOT NULL, PRIMARY KEY("grp", "bit") )''',
+        # whether a video has the tag with a given bit: that bit of the right word of its group
+        '''CREATE TRIGGER IF NOT EXISTS stats_insert AFTER INSERT ON videos BEGIN
+            INSERT INTO directories (directory, videos, untagged, skipped, bytes) 
+            SELECT new.directory, 1, new.score_1 IS NULL AND new.score_2 IS NULL, new.skipped IS 1, 
+            coalesce(new.filesize, 0) WHERE new.directory IS NOT NULL
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1, untagged = untagged + excluded.untagged, 
+            skipped = skipped + excluded.skipped, bytes = bytes + excluded.bytes;
+            UPDATE tag_stats SET videos = videos + 1 
+            WHERE (CASE grp 
+                WHEN 1 THEN (CASE bit / 64 WHEN 0 THEN new.score_1 WHEN 1 THEN new.score_1_1 
+                    WHEN 2 THEN new.score_1_2 ELSE new.score_1_3 END >> (bit % 64)) & 1 
+                ELSE (CASE bit / 64 WHEN 0 THEN new.score_2 WHEN 1 THEN new.score_2_1 
+                    WHEN 2 THEN new.score_2_2 ELSE new.score_2_3 END >> (bit % 64)) & 1 END) IS 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_delete AFTER DELETE ON videos BEGIN
+            UPDATE directories SET videos = videos - 1, 
+            untagged = untagged - (old.score_1 IS NULL AND old.score_2 IS NULL), skipped = skipped - (old.skipped IS 1), 
+            bytes = bytes - coalesce(old.filesize, 0) WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+            UPDATE tag_stats SET videos = videos - 1 
+            WHERE (CASE grp 
+                WHEN 1 THEN (CASE bit / 64 WHEN 0 THEN old.score_1 WHEN 1 THEN old.score_1_1 
+                    WHEN 2 THEN old.score_1_2 ELSE old.score_1_3 END >> (bit % 64)) & 1 
+                ELSE (CASE bit / 64 WHEN 0 THEN old.score_2 WHEN 1 THEN old.score_2_1 
+                    WHEN 2 THEN old.score_2_2 ELSE old.score_2_3 END >> (bit % 64)) & 1 END) IS 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_update AFTER UPDATE OF directory, score_1, score_2, 
+        score_1_1, score_1_2, score_1_3, score_2_1, score_2_2, score_2_3, skipped, filesize ON videos BEGIN
+            UPDATE directories SET videos = videos - 1, 
+            untagged = untagged - (old.score_1 IS NULL AND old.score_2 IS NULL), skipped = skipped - (old.skipped IS 1), 
+            bytes = bytes - coalesce(old.filesize, 0) WHERE directory = old.directory;
+            DELETE FROM directories WHERE directory = old.directory AND videos <= 0;
+            INSERT INTO directories (directory, videos, untagged, skipped, bytes) 
+            SELECT new.directory, 1, new.score_1 IS NULL AND new.score_2 IS NULL, new.skipped IS 1, 
+            coalesce(new.filesize, 0) WHERE new.directory IS NOT NULL
+            ON CONFLICT (directory) DO UPDATE SET videos = videos + 1, untagged = untagged + excluded.untagged, 
+            skipped = skipped + excluded.skipped, bytes = bytes + excluded.bytes;
+            UPDATE tag_stats SET videos = videos + (CASE WHEN (CASE grp 
+                WHEN 1 THEN (CASE bit / 64 WHEN 0 THEN new.score_1 WHEN 1 THEN new.score_1_1 
+                    WHEN 2 THEN new.score_1_2 ELSE new.score_1_3 END >> (bit % 64)) & 1 
+                ELSE (CASE bit / 64 WHEN 0 THEN new.score_2 WHEN 1 THEN new.score_2_1 
+                    WHEN 2 THEN new.score_2_2 ELSE new.score_2_3 END >> (bit % 64)) & 1 END) IS 1 
+            THEN 1 ELSE -1 END)
+            WHERE ((CASE grp 
+                WHEN 1 THEN (CASE bit / 64 WHEN 0 THEN new.score_1 WHEN 1 THEN new.score_1_1 
+                    WHEN 2 THEN new.score_1_2 ELSE new.score_1_3 END >> (bit % 64)) & 1 
+                ELSE (CASE bit / 64 WHEN 0 THEN new.score_2 WHEN 1 THEN new.score_2_1 
+                    WHEN 2 THEN new.score_2_2 ELSE new.score_2_3 END >> (bit % 64)) & 1 END) IS 1) 
+            != ((CASE grp 
+                WHEN 1 THEN (CASE bit / 64 WHEN 0 THEN old.score_1 WHEN 1 THEN old.score_1_1 
+                    WHEN 2 THEN old.score_1_2 ELSE old.score_1_3 END >> (bit % 64)) & 1 
+                ELSE (CASE bit / 64 WHEN 0 THEN old.score_2 WHEN 1 THEN old.score_2_1 
+                    WHEN 2 THEN old.score_2_2 ELSE old.score_2_3 END >> (bit % 64)) & 1 END) IS 1);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_insert_1 AFTER INSERT ON tag_group_1 BEGIN
+            INSERT OR REPLACE INTO tag_stats (grp, bit, videos) 
+            VALUES (1, new.bit, (SELECT count(*) FROM videos WHERE (CASE new.bit / 64 WHEN 0 THEN score_1 
+            WHEN 1 THEN score_1_1 WHEN 2 THEN score_1_2 ELSE score_1_3 END >> (new.bit % 64)) & 1));
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_insert_2 AFTER INSERT ON tag_group_2 BEGIN
+            INSERT OR REPLACE INTO tag_stats (grp, bit, videos) 
+            VALUES (2, new.bit, (SELECT count(*) FROM videos WHERE (CASE new.bit / 64 WHEN 0 THEN score_2 
+            WHEN 1 THEN score_2_1 WHEN 2 THEN score_2_2 ELSE score_2_3 END >> (new.bit % 64)) & 1));
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_delete_1 AFTER DELETE ON tag_group_1 BEGIN
+            DELETE FROM tag_stats WHERE grp = 1 AND bit = old.bit;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS tag_stats_delete_2 AFTER DELETE ON tag_group_2 BEGIN
+            DELETE FROM tag_stats WHERE grp = 2 AND bit = old.bit;
+        END''',
+        '''INSERT INTO tag_stats (grp, bit, videos) 
+        SELECT 1, bit, (SELECT count(*) FROM videos WHERE score_1 & (1 << t.bit)) FROM tag_group_1 t''',
+        '''INSERT INTO tag_stats (grp, bit, videos) 
+        SELECT 2, bit, (SELECT count(*) FROM videos WHERE score_2 & (1 << t.bit)) FROM tag_group_2 t''',
+        # the covering indexes for the tag queries, now with every word
+        '''DROP INDEX IF EXISTS "videos_directory"''',
+        '''CREATE INDEX IF NOT EXISTS "videos_directory" ON "videos" ("directory", "score_1", "score_2", 
+        "tagged_when", "score_1_1", "score_1_2", "score_1_3", "score_2_1", "score_2_2", "score_2_3", "fullpath")''',
+        '''DROP INDEX IF EXISTS "videos_tagged_when"''',
+        '''CREATE INDEX IF NOT EXISTS "videos_tagged_when" ON "videos" ("tagged_when", "directory", "score_1", 
+        "score_2", "score_1_1", "score_1_2", "score_1_3", "score_2_1", "score_2_2", "score_2_3", "fullpath")''',
+        '''DROP INDEX IF EXISTS "videos_times_viewed"''',
+        '''CREATE INDEX IF NOT EXISTS "videos_times_viewed" ON "videos" ("times_viewed", "skipped", "score_1", 
+        "score_2", "score_1_1", "score_1_2", "score_1_3", "score_2_1", "score_2_2", "score_2_3", "fullpath")''',
+        '''ANALYZE''',
+    )),
+)
+
+# the queries run while the user waits, with example parameters, for query_plan_report(). Keep these in step
+# with the methods named in the comments when changing either.
+HOT_QUERIES = (
+    ("entry", '''select * from videos where fullpath = ?''', ("a",)),  # get_entry
+    ("thumbnail", '''select thumbnail from thumbnails where fullpath = ? and thumbnail not null''', ("a",)),
+    ("filename", '''select fullpath from videos where filename = ?''', ("a",)),  # filename_to_fullpath
+    ("directories", '''select directory from directories order by directory collate nocase asc''', ()),
+    ("untagged in directory", '''select fullpath from videos where directory = ? and skipped is not 1 
+    and score_1 is null and score_2 is null''', ("a",)),  # path_generator
+    ("untagged", '''select fullpath from videos where skipped is not 1 and score_1 is null and score_2 is null 
+    order by created desc''', ()),
+    ("matches", '''select fullpath, tagged_when from videos where score_1 & ? = ? and score_2 & ? = ? 
+    order by random()''', (1, 1, 1, 1)),  # get_matches
+    ("matches in directory", '''select fullpath, tagged_when from videos where score_1 & ? = ? and 
+    score_2 & ? = ? and directory = ? order by random()''', (1, 1, 1, 1, "a")),
+    ("newest", '''select fullpath, tagged_when from videos where score_1 & ? = ? and score_2 & ? = ? 
+    and tagged_when is not NULL order by tagged_when desc''', (1, 1, 1, 1)),  # newest_matches
+    ("newest in directory", '''select fullpath, tagged_when from videos where score_1 & ? = ? and 
+    score_2 & ? = ? and tagged_when is not NULL and directory = ? order by tagged_when desc''', (1, 1, 1, 1, "a")),
+    ("popular", '''SELECT thumbnails.thumbnail, videos.fullpath from videos INNER JOIN thumbnails 
+    ON thumbnails.fullpath = videos.fullpath where skipped != 1 and score_1 & ? = ? and score_2 & ? = ? 
+    ORDER BY times_viewed DESC, RANDOM() LIMIT 34 OFFSET 0''', (1, 1, 1, 1)),  # popular_search
+    ("same size", '''select fullpath, md5 from videos where filesize = ?''', (1,)),  # check_if_new_file
+    ("duplicates", '''select filesize, md5 from videos where md5 is not null group by filesize, md5 
+    having count(*) > 1''', ()),  # find_duplicates
+    ("skipped in directory", '''select * from videos where skipped = 1 and directory = ? 
+    order by filesize''', ("a",)),  # free_up_space
+)
+
+# the statistics worked out from scratch, to fill the tables maintained by the triggers and to check them against
+STATS_QUERIES = {
+    "directories": '''SELECT directory, count(*), sum(score_1 IS NULL AND score_2 IS NULL), sum(skipped IS 1), 
+    coalesce(sum(filesize), 0) FROM videos WHERE directory IS NOT NULL GROUP BY directory ORDER BY directory''',
+    "tag_stats": '''SELECT 1, t.bit, (SELECT count(*) FROM videos WHERE (CASE t.bit / 64 WHEN 0 THEN score_1 
+    WHEN 1 THEN score_1_1 WHEN 2 THEN score_1_2 ELSE score_1_3 END >> (t.bit % 64)) & 1) FROM tag_group_1 t 
+    UNION ALL SELECT 2, t.bit, (SELECT count(*) FROM videos WHERE (CASE t.bit / 64 WHEN 0 THEN score_2 
+    WHEN 1 THEN score_2_1 WHEN 2 THEN score_2_2 ELSE score_2_3 END >> (t.bit % 64)) & 1) FROM tag_group_2 t 
+    ORDER BY 1, 2''',
+}
+
+# each tag group is stored in this many signed 64 bit integer columns, see the last migration. Bit n of the
+# group is bit n % 64 of its column n // 64. In Python a group's score is just an int with bit n set for tag n.
+WORDS = 4
+SCORE_COLUMNS = tuple(tuple(f"score_{grp}" if word == 0 else f"score_{grp}_{word}" for word in range(WORDS))
+                      for grp in (1, 2))
+
+# what a tag search matches, see DBManager.compile_query. Each mask is a (score_1, score_2) pair: a video matches
+# if it has every tag in all, none of the tags in none, and at least one of the tags of each pair in any.
+TagQuery = namedtuple("TagQuery", ["all", "none", "any"])
+MATCH_ALL = TagQuery((0, 0), (0, 0), ())  # every video that has been tagged
+
+# full text index over file names and paths for the title search. It is an external content table, so it only
+# stores the index and reads the text itself from videos; the triggers keep it in step on insert, move and remove.
+# The prefix indexes make "partial*" searches as fast as whole words.
+TEXT_INDEX_SETUP = (
+    '''CREATE VIRTUAL TABLE videos_fts USING fts5(filename, fullpath, content='videos', content_rowid='rowid',
+    prefix='2 3')''',
+    '''CREATE TRIGGER videos_fts_insert AFTER INSERT ON videos BEGIN
+        INSERT INTO videos_fts (rowid, filename, fullpath) VALUES (new.rowid, new.filename, new.fullpath);
+    END''',
+    '''CREATE TRIGGER videos_fts_delete AFTER DELETE ON videos BEGIN
+        INSERT INTO videos_fts (videos_fts, rowid, filename, fullpath) 
+        VALUES ('delete', old.rowid, old.filename, old.fullpath);
+    END''',
+    '''CREATE TRIGGER videos_fts_update AFTER UPDATE OF filename, fullpath ON videos BEGIN
+        INSERT INTO videos_fts (videos_fts, rowid, filename, fullpath) 
+        VALUES ('delete', old.rowid, old.filename, old.fullpath);
+        INSERT INTO videos_fts (rowid, filename, fullpath) VALUES (new.rowid, new.filename, new.fullpath);
+    END''',
+    '''INSERT INTO videos_fts (videos_fts) VALUES ('rebuild')''',  # index whatever is already in the library
+)
+
+# applied to every connection, writer and readers alike, after the cache and mmap sizes from the settings
+SQLITE_PRAGMAS = (("temp_store", "MEMORY"),
+                  ("synchronous", "NORMAL"),  # safe with WAL, only the last transactions can be lost on power cut
+                  ("busy_timeout", 5000))
 
 """Module for interfacing with the sqlite database. This internally takes care of the conversion of tags to
 bitmaps and back again, so the calling interface only sees lists of tags. Handles scanning for new files and
@@ -31,31 +367,380 @@ def forty_days_ago():
     return int(time.time() - 3456000)
 
 
+def bit_counts(value_counts):
+
+    """Takes {score: videos with that score} and returns {tag value: videos with that bit set}. Each distinct
+    score is only taken apart once, however many videos share it."""
+
+    out = Counter()
+    for value, videos in value_counts.items():
+        value = value or 0
+        while value:
+            low = value & -value  # lowest set bit
+            out[low] += videos
+            value ^= low
+    return out
+
+
+def to_words(score):
+
+    """Splits a group's score into the numbers stored in its columns"""
+
+    return [to_signed(((score or 0) >> (64 * word)) & 0xFFFFFFFFFFFFFFFF) for word in range(WORDS)]
+
+
+def from_words(words):
+
+    """A group's score from its columns, None if the video hasn't been tagged. Words added since the video was
+    last tagged are NULL."""
+
+    if words[0] is None:
+        return None
+    score = 0
+    for word, x in enumerate(words):
+        if x:
+            score |= (x & 0xFFFFFFFFFFFFFFFF) << (64 * word)  # the two's complement bits of a negative word
+    return score
+
+
+def tag_filter(query):
+
+    """The where clause and its parameters for the videos a TagQuery matches, a single test of each row. The first
+    word of each group is always tested for the tags in all, so that a video that hasn't been tagged never matches
+    and searches for the first 64 tags of each group are the same query they always were. Other words are only
+    tested if a tag in them is searched for. Words added since a video was last tagged are NULL, which the
+    tests for none and any treat as no tags."""
+
+    first, rest, params, rest_params = [], [], [], []
+    for columns, score in zip(SCORE_COLUMNS, query.all):
+        for word, (column, value) in enumerate(zip(columns, to_words(score))):
+            if word == 0:
+                first.append(f"{column} & ? = ?")
+                params += [value, value]
+            elif value:
+                rest.append(f"{column} & ? = ?")
+                rest_params += [value, value]
+    for columns, score in zip(SCORE_COLUMNS, query.none):
+        for column, value in zip(columns, to_words(score)):
+            if value:
+                rest.append(f"ifnull({column}, 0) & ? = 0")
+                rest_params.append(value)
+    for clause in query.any:
+        tests = [(column, value) for columns, score in zip(SCORE_COLUMNS, clause)
+                 for column, value in zip(columns, to_words(score)) if value]
+        rest.append("(" + " or ".join(f"{column} & ? != 0" for column, value in tests) + ")")
+        rest_params += [value for column, value in tests]
+    return " and ".join(first + rest), params + rest_params
+
+
+def score_updates(add, remove):
+
+    """The set clause and its parameters that turn on the tags in add and turn off those in remove, both
+    (score_1, score_2), leaving every other tag as it is. Only the words that change are written, except that
+    if anything is added the first word of both groups is too, so that a video tagged for the first time gets
+    a score in each group as write_entry would give it."""
+
+    sets, params = [], []
+    for columns, on, off in zip(SCORE_COLUMNS, add, remove):
+        for word, (column, on_word, off_word) in enumerate(zip(columns, to_words(on), to_words(off))):
+            if on_word or off_word or (word == 0 and any(add)):
+                sets.append(f"{column} = (ifnull({column}, 0) | ?) & ~?")
+                params += [on_word, off_word]
+    return ", ".join(sets), params
+
+
+def query_words(query):
+
+    """A TagQuery with its scores split into words, the way the tag index takes it"""
+
+    return TagQuery([to_words(x) for x in query.all], [to_words(x) for x in query.none],
+                    [[to_words(x) for x in clause] for clause in query.any])
+
+
+def weighted_bits(score, weights):
+
+    """The total weight of the tags in a score, weights is {bit: weight}"""
+
+    return sum(weight for bit, weight in weights.items() if score >> bit & 1)
+
+
+def similarity(a, b, weights):
+
+    """Weighted Jaccard similarity of two videos' (score_1, score_2): the weight of the tags they have in common
+    over the weight of the tags either of them has. weights is one {bit: weight} per group."""
+
+    common = sum(weighted_bits(x & y, w) for x, y, w in zip(a, b, weights))
+    either = sum(weighted_bits(x | y, w) for x, y, w in zip(a, b, weights))
+    return common / either if either else 0.0
+
+
+def apply_pragmas(conn):
+
+    """Set the tuned pragma profile on a freshly opened connection"""
+
+    # cache_size is negative so it is read as KiB rather than pages, mmap lets readers share the OS page cache
+    # instead of copying into their own
+    sizes = (("cache_size", -SETTINGS.get("SQLITE_CACHE_KB", 65536)),
+             ("mmap_size", SETTINGS.get("SQLITE_MMAP_BYTES", 268435456)))
+    for name, value in sizes + SQLITE_PRAGMAS:
+        conn.execute(f"pragma {name} = {value}")
+
+
+class ReaderPool:
+
+    """A pool of read-only connections to the database. With WAL journaling, readers never block the
+    writer (or each other) so background threads such as the thumbnail prefetcher can query while the
+    main window writes. Connections are handed out with connection() and returned when the block exits."""
+
+    def __init__(self, db_path, size=None):
+
+        from urllib.request import pathname2url  # only needed here, and slow to import
+        self.uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+        self.size = size or SETTINGS.get("SQLITE_READERS", 4)  # idle read-only connections kept open for reuse
+        self.idle = queue.LifoQueue()  # most recently used connection first, its cache is warmest
+        self.lock = threading.Lock()
+        self.opened = 0  # connections currently owned by the pool, idle or in use
+        self.closed = False
+
+    def open_connection(self):
+
+        # isolation_level None means autocommit, so a reader never sits in an open transaction pinning an
+        # old snapshot of the database. check_same_thread is off because connections move between threads
+        conn = sqlite3.connect(self.uri, uri=True, isolation_level=None, check_same_thread=False,
+                               factory=connection_factory())  # every query is timed, see instrumentation.py
+        apply_pragmas(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+
+        """Borrow a read-only connection. If the pool is exhausted a spare connection is opened and
+        closed again afterwards rather than making the caller wait."""
+
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.open_connection()
+            with self.lock:
+                self.opened += 1
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                keep = not self.closed and self.idle.qsize() < self.size
+                if not keep:
+                    self.opened -= 1
+            if keep:
+                self.idle.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# a set of videos with identical size and md5. keep is the copy worth keeping (tagged, most watched, oldest)
+# and extras are the fullpaths of the others, reclaimable is the bytes freed by getting rid of the extras
+DupeCluster = namedtuple("DupeCluster", ["filesize", "md5", "keep", "extras", "reclaimable"])
+# two videos whose thumbnails are perceptually the same, distance is the number of differing hash bits
+NearDupe = namedtuple("NearDupe", ["fullpath_a", "fullpath_b", "distance"])
+
+
+class ScanProgress:
+
+    """Counters for a library scan, written by the scanning thread and read by the GUI, which also uses it to
+    pause or cancel the scan. Plain int attributes are fine to share as only the scanning thread writes them."""
+
+    counters = ("walked", "hashed", "probed", "reused", "moved", "inserted", "duped", "removed")
+
+    def __init__(self):
+
+        self.started = time.time()
+        self.ended = None
+        self.phase = "starting"
+        self.walked = 0  # video files looked at
+        self.hashed = 0  # md5s computed
+        self.probed = 0  # ffprobe calls for duration/resolution
+        self.reused = 0  # hashes and probes taken from the scan journal of an earlier, interrupted scan
+        self.moved = 0  # entries matched to a file that was moved or renamed
+        self.inserted = 0  # new entries
+        self.duped = 0  # files moved to the dupes folder
+        self.removed = 0  # entries whose files have gone
+        self.stop_requested = threading.Event()
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+
+    def pause(self):
+
+        self.unpaused.clear()
+
+    def resume(self):
+
+        self.unpaused.set()
+
+    def cancel(self):
+
+        self.stop_requested.set()
+        self.unpaused.set()  # a paused scan has to wake up to notice it was cancelled
+
+    def cancelled(self):
+
+        return self.stop_requested.is_set()
+
+    def paused(self):
+
+        return not self.unpaused.is_set()
+
+    def checkpoint(self):
+
+        """Called by the scan between files. Blocks while paused, returns True if the scan should stop"""
+
+        self.unpaused.wait()
+        return self.cancelled()
+
+    def finish(self):
+
+        self.ended = time.time()
+        self.phase = "cancelled" if self.cancelled() else "finished"
+
+    def snapshot(self):
+
+        """{counter name: value} at this moment"""
+
+        return {name: getattr(self, name) for name in self.counters}
+
+    def elapsed(self):
+
+        return (self.ended or time.time()) - self.started
+
+    def summary(self):
+
+        secs = max(self.elapsed(), 0.001)
+        rates = ", ".join(f"{name} {value} ({value / secs:.1f}/s)" for name, value in self.snapshot().items())
+        return f"Scan {self.phase} after {round(secs)} s: {rates}"
+
+
 class DBManager:
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, media=None, top_level=None):
 
         """tag_group_1 and tag_group_2 are received in a canonical order for computing
-        the bits"""
-
+        the bits. media is the backend scans probe videos with, see mediabackend.py. The library folder and
+        the folders files are moved to come from settings.json unless top_level is given."""
+
+        self.db_path = db_path
+        self.media = media or get_backend()
+        self.top_level = top_level or SETTINGS["TOP_LEVEL"]  # paths in the database are relative to this
+        self.dupes_folder = SETTINGS["DUPES_FOLDER"]
+        self.trash_folder = SETTINGS["TRASH_FOLDER"]
+        self.broken_folder = SETTINGS["BROKEN_FOLDER"]
+        # the writer is shared by the main window and background jobs, so it may be used from any thread
+        # but only while holding self.write_lock
         if os.path.exists(db_path):
-            self.db = sqlite3.connect(db_path)
+            self.db = sqlite3.connect(db_path, check_same_thread=False, factory=connection_factory())
         else:
             # first-time setup
-            self.db = sqlite3.connect(db_path)
-            setup_script = open("schema.sql", "r").read()
+            self.db = sqlite3.connect(db_path, check_same_thread=False, factory=connection_factory())
+            with open(SCHEMA, "r") as f:
+                setup_script = f.read()
             self.db.executescript(setup_script)
 
+        # the one and only writer connection, all reads that don't need to see uncommitted changes
+        # go through the reader pool instead
+        self.db.execute("pragma journal_mode = WAL")  # persistent, stored in the database file
+        apply_pragmas(self.db)
         self.db_cursor = self.db.cursor()
+        self.migrate()
+        self.text_index = self.setup_text_index()  # False if this sqlite was built without FTS5
+        self.write_lock = threading.RLock()
+        self.readers = ReaderPool(db_path)
         self.dbrow = self.setup_dbrow()  # this function returns a namedtuple
         self.tag_group_1 = []
         self.tag_group_2 = []
         self.tag_group_1_rev = {}
         self.tag_group_2_rev = {}  # {int value: "type"}
         self.tag_val_dict = {}  # {"type":int value}
-        self.extensions = []
         self.values_setup()  # all the above are now read from DB file
+        self.extensions = SETTINGS["EXTENSIONS"]
         self.filter_directory = None  # if this is set, only return results from this top level direcotry
+        # searches are worked out in memory with numpy if this is on, see tagindex.py
+        self.tag_index = make_index(SCORE_COLUMNS) if SETTINGS.get("TAG_INDEX", False) else None
+        self.scan_pending = 0  # uncommitted changes made by the running scan
+        self.last_checkpoint = time.time()
+
+    def migrate(self):
+
+        """Brings the database up to the latest version in MIGRATIONS. Each migration and the version bump that
+        records it are committed together, so a crash part way through leaves the database at the last
+        complete version and the rest is applied on the next start."""
+
+        self.db_cursor.execute('''pragma user_version''')
+        version = self.db_cursor.fetchone()[0]
+        if version > len(MIGRATIONS):
+            print(f"Database is version {version} but this program only knows up to {len(MIGRATIONS)}, "
+                  f"it was probably opened by a newer version")
+            return
+        for number, (description, statements) in enumerate(MIGRATIONS[version:], version + 1):
+            print(f"Upgrading the database to version {number}: {description}")
+            self.db_cursor.execute('''begin''')
+            try:
+                for statement in statements:
+                    try:
+                        self.db_cursor.execute(statement)
+                    except sqlite3.OperationalError as e:
+                        # sqlite has no "add column if not exists", databases made from schema.sql have them
+                        if "duplicate column name" not in str(e):
+                            raise
+                self.db_cursor.execute(f'''pragma user_version = {number}''')
+            except sqlite3.Error:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def query_plan_report(self):
+
+        """EXPLAIN QUERY PLAN for each of HOT_QUERIES. Returns a list of (name, [plan steps], table scan) where
+        table scan is True if sqlite would read every row of a table rather than use an index. Scanning a whole
+        covering index is expected for the tag queries because bitmask tests can't be searched."""
+
+        queries = list(HOT_QUERIES)
+        if self.text_index:
+            queries.append(("title search", '''SELECT videos.fullpath from videos_fts INNER JOIN videos 
+            ON videos.rowid = videos_fts.rowid where videos_fts MATCH ? and skipped != 1 
+            ORDER BY videos_fts.rank LIMIT 34''', ("a*",)))  # text_search
+        report = []
+        for name, sql, params in queries:
+            steps = [x[3] for x in self.read_all(f"explain query plan {sql}", params)]
+            table_scan = any(x.startswith("SCAN ") and "INDEX" not in x and "VIRTUAL TABLE" not in x
+                             for x in steps)
+            report.append((name, steps, table_scan))
+
+        return report
+
+    def setup_text_index(self):
+
+        """Creates and fills the full text index the first time the database is opened by this version.
+        Returns whether the index is available, title search falls back to LIKE if it isn't."""
+
+        self.db_cursor.execute('''select 1 from sqlite_master where name = ?''', ("videos_fts",))
+        if self.db_cursor.fetchone():
+            return True
+        print("Building the title search index...")
+        try:
+            for statement in TEXT_INDEX_SETUP:
+                self.db_cursor.execute(statement)
+        except sqlite3.OperationalError as e:  # "no such module: fts5"
+            print(f"Full text search not available, title search will be slow: {e}")
+            self.db.rollback()
+            return False
+        self.db.commit()
+        return True
 
     def setup_dbrow(self):
 
@@ -67,45 +752,41 @@ class DBManager:
         self.db_cursor.execute('''pragma table_info(videos)''')
         res = self.db_cursor.fetchall()
         colnames = []
+        positions = {x[1]: x[0] for x in res}
+        # where each group's words are in a row, make_dbrow puts the group's tags in place of its first word
+        self.score_positions = [[positions[x] for x in columns] for columns in SCORE_COLUMNS]
         for tup in res:
             cid, cname, data_type, a, b, c = tup
             # scores are converted to lists of tags so these columns are renamed as the
             # main window does not directly understand the scores
             if cname == "score_1":
                 cname = "tag_group_1"
-            if cname == "score_2":
+            elif cname == "score_2":
                 cname = "tag_group_2"
+            elif cname in SCORE_COLUMNS[0] or cname in SCORE_COLUMNS[1]:
+                continue  # the other words are part of the same tag lists
             colnames.append(cname)
-        print("found the following column names:")
-        print(colnames)
         return namedtuple("dbrow", colnames + ["thumbnail"])
         # need to manually add thumbnail because it comes from a seperate table
 
     def values_setup(self):
 
         """Reads in the tag values from the database tables for tag_group_1 and tag_group_2
-        set self.tag_group_1, self.tag_group_2 and self.extensions"""
+        set self.tag_group_1 and self.tag_group_2"""
 
-        self.db_cursor.execute('''select * from tag_group_1''')
+        self.db_cursor.execute('''select tag, bit from tag_group_1''')
         for row in self.db_cursor.fetchall():
-            tag, value = row
+            tag, bit = row
             self.tag_group_1.append(tag)
-            self.tag_group_1_rev[value] = tag
-            self.tag_val_dict[tag] = value
+            self.tag_group_1_rev[1 << bit] = tag
+            self.tag_val_dict[tag] = 1 << bit
 
-        self.db_cursor.execute('''select * from tag_group_2''')
+        self.db_cursor.execute('''select tag, bit from tag_group_2''')
         for row in self.db_cursor.fetchall():
-            tag, value = row
+            tag, bit = row
             self.tag_group_2.append(tag)
-            self.tag_group_2_rev[value] = tag
-            self.tag_val_dict[tag] = value
-
-        # self.db_cursor.execute('''select * from extensions''')
-        # self.extensions = [x[0] for x in self.db_cursor.fetchall()]  # extensions are now stored in the json
-        with open("settings.json", "r") as f:
-            dat = json.load(f)
-            self.extensions = dat["EXTENSIONS"]
-            print("recognised extensions:", self.extensions)
+            self.tag_group_2_rev[1 << bit] = tag
+            self.tag_val_dict[tag] = 1 << bit
 
     def get_tag_settings(self):
 
@@ -122,18 +803,14 @@ class DBManager:
         for taglist, integer, adict in zip((tag_group_1, tag_group_2),
                                            (score_1, score_2),
                                            (self.tag_group_1_rev, self.tag_group_2_rev)):
-            i = 0
-            while i <= max(len(self.tag_group_1), len(self.tag_group_2)):  # binary up to highest needed
-                toand = 2 ** i
-                if integer is None:  # might be null value in db
-                    integer = 0
-
-                if toand & integer == toand:  # common bit
-                    try:
-                        taglist.append(adict[toand])
-                    except KeyError:
-                        print("key error for {}".format(toand))
-                i += 1
+            integer = integer or 0  # might be null value in db
+            while integer:
+                toand = integer & -integer  # lowest set bit
+                try:
+                    taglist.append(adict[toand])
+                except KeyError:
+                    print("key error for {}".format(toand))
+                integer ^= toand
         return tag_group_1, tag_group_2
 
     def tags_to_ints(self, tag_group_1, tag_group_2):
@@ -150,85 +827,270 @@ class DBManager:
 
         return score_1, score_2
 
+    def split_groups(self, tags):
+
+        """Sorts a list of tags from either group into (tag_group_1, tag_group_2)"""
+
+        return [x for x in tags if x in self.tag_group_1], [x for x in tags if x not in self.tag_group_1]
+
+    def compile_query(self, tag_group_1, tag_group_2, exclude=((), ()), any_of=()):
+
+        """The TagQuery for videos with all the tags in tag_group_1 and tag_group_2, none of the tags in exclude
+        (a pair of lists like them) and at least one tag from each list in any_of (tags from either group)"""
+
+        return TagQuery(self.tags_to_ints(tag_group_1, tag_group_2), self.tags_to_ints(*exclude),
+                        tuple(self.tags_to_ints(*self.split_groups(x)) for x in any_of if x))
+
+    def parse_tag_query(self, text):
+
+        """Reads a tag search typed by the user. Tags separated by spaces must all be there, -tag must not be and
+        tag|tag|tag needs at least one of them, e.g. cats "big dogs" -birds fish|frogs, with quotes around names
+        that have spaces. -tag|tag excludes all of them. Returns (tag_group_1, tag_group_2, exclude, any_of) to
+        pass to the searches, raises ValueError if the text can't be read or names a tag that doesn't exist."""
+
+        include, exclude, any_of = [], [], []
+        for term in shlex.split(text):  # raises ValueError for an unmatched quote
+            if term in self.tag_val_dict:  # whatever is in it, a whole tag name is just that tag
+                include.append(term)
+                continue
+            tags = term.removeprefix("-").split("|")
+            if "" in tags:
+                raise ValueError(f"Missing tag name in {term}")
+            if term.startswith("-"):
+                exclude.extend(tags)
+            elif len(tags) > 1:
+                any_of.append(tags)
+            else:
+                include.append(term)
+        unknown = [x for x in include + exclude + sum(any_of, []) if x not in self.tag_val_dict]
+        if unknown:
+            raise ValueError(f"No such tag: {', '.join(unknown)}")
+        return *self.split_groups(include), self.split_groups(exclude), any_of
+
     def add_tag(self, kind, name):
 
         """Add a new tag to the db from the interface. Type is tag_group_1 or tag_group_2.
-        calculates the value and inserts into the tags table"""
+        gives it the lowest bit not in use, which may have belonged to a deleted tag, and inserts into the tags
+        table. Returns False if the group is full."""
 
         # can't use a placeholder for a table name so use string formatting:
-        sqlstring1 = '''select max(value) from {}'''.format(kind)
-        sqlstring2 = '''insert into {} (tag, value) values (?, ?)'''.format(kind)
+        sqlstring1 = '''select bit from {}'''.format(kind)
+        sqlstring2 = '''insert into {} (tag, value, bit) values (?, ?, ?)'''.format(kind)
+
+        with self.write_lock:
+            self.db_cursor.execute(sqlstring1)
+            used = {x[0] for x in self.db_cursor.fetchall()}
+            # delete_tag clears a tag's bit from every video, so a free bit is free everywhere
+            bit = min(set(range(WORDS * 64)) - used, default=None)
+            if bit is None:
+                print(f"Can't add {name}, {kind} already has {WORDS * 64} tags")
+                return False
+            new_value = 1 << bit
+            # the value column is the old way of storing the bit, for tags that fit in the first word
+            self.db_cursor.execute(sqlstring2, (name, new_value if bit < 63 else None, bit))
+            print("Inserted {} into {} with bit {}".format(name, kind, bit))
+            self.db.commit()
+        # the main window may already have added the name to the list it shares with us
+        tags = self.tag_group_1 if kind == "tag_group_1" else self.tag_group_2
+        if name not in tags:
+            tags.append(name)
+        (self.tag_group_1_rev if kind == "tag_group_1" else self.tag_group_2_rev)[new_value] = name
+        self.tag_val_dict[name] = new_value
+        return True
 
-        self.db_cursor.execute(sqlstring1)
-        max_value = self.db_cursor.fetchone()[0]  # from tuple
-        if max_value:
-            new_value = max_value * 2
-        else:
-            new_value = 1  # NULL will be returned the first time the db is created, we are making
-            # the first entry in the tag table here
-        self.db_cursor.execute(sqlstring2, (name, new_value))
-        print("Inserted {} into {} with value {}".format(name, kind, new_value))
-        self.db.commit()
-        self.values_setup()  # re-read the tag values to include the new one
+    def tag_kind(self, name):
+
+        return "tag_group_1" if name in self.tag_group_1 else "tag_group_2"
+
+    def rename_tag(self, name, new_name):
+
+        """Renames a tag for the whole library. Videos store the tag's bit, not its name, so only the tags table
+        changes. Returns False if there is already a tag called new_name, merge it with delete_tag instead."""
+
+        if new_name in self.tag_val_dict:
+            print(f"Can't rename {name}, there is already a tag called {new_name}")
+            return False
+        kind = self.tag_kind(name)
+        with self.write_lock:
+            self.db_cursor.execute(f'''update {kind} set tag = ? where tag = ?''', (new_name, name))
+            self.db.commit()
+        tags = self.tag_group_1 if kind == "tag_group_1" else self.tag_group_2
+        tags[tags.index(name)] = new_name  # the main window shares these lists
+        value = self.tag_val_dict.pop(name)
+        self.tag_val_dict[new_name] = value
+        (self.tag_group_1_rev if kind == "tag_group_1" else self.tag_group_2_rev)[value] = new_name
+        print(f"Renamed {name} to {new_name}")
+        return True
+
+    def delete_tag(self, name, into=None):
+
+        """Takes a tag off every video and deletes it, so that add_tag can give its bit to a new tag. With into,
+        the videos that had the tag get the tag into instead, i.e. the two are merged. The videos are changed by a
+        single bitwise update, in the same transaction as the tags table. Returns how many videos had the tag,
+        or None if into isn't another tag."""
+
+        if into is not None and (into == name or into not in self.tag_val_dict):
+            print(f"Can't merge {name} into {into}")
+            return None
+        kind = self.tag_kind(name)
+        value = self.tag_val_dict[name]
+        bit = value.bit_length() - 1
+        remove = (value, 0) if kind == "tag_group_1" else (0, value)
+        add = (0, 0) if into is None else self.tags_to_ints(*self.split_groups([into]))
+        sets, params = score_updates(add, remove)
+        column = SCORE_COLUMNS[kind == "tag_group_2"][bit // 64]
+        mask = to_words(1 << bit % 64)[0]
+        with self.write_lock:
+            self.db_cursor.execute(f'''select fullpath from videos where {column} & ? != 0''', (mask,))
+            paths = [x[0] for x in self.db_cursor.fetchall()]
+            # the tag goes first so that the stats triggers don't count it down one video at a time
+            self.db_cursor.execute(f'''delete from {kind} where tag = ?''', (name,))
+            self.db_cursor.execute(f'''update videos set {sets} where {column} & ? != 0''', (*params, mask))
+            self.reindex(paths)
+            self.db.commit()
+        tags = self.tag_group_1 if kind == "tag_group_1" else self.tag_group_2
+        tags.remove(name)
+        del self.tag_val_dict[name]
+        del (self.tag_group_1_rev if kind == "tag_group_1" else self.tag_group_2_rev)[value]
+        print(f"Deleted {name} from {len(paths)} videos" + ("" if into is None else f", they have {into} instead"))
+        return len(paths)
+
+    def reindex(self, paths):
+
+        """Brings the tag index up to date for these videos after changing, adding or removing them. Call while
+        holding the write lock, before committing."""
+
+        if self.tag_index is not None:
+            self.tag_index.refresh(self.db, paths)
+
+    def loaded_index(self):
+
+        """The tag index, read from the database on first use, or None if searches go to SQLite"""
+
+        if self.tag_index is not None and not self.tag_index.loaded:
+            with self.write_lock:  # so that no write falls between loading and the first refresh
+                if not self.tag_index.loaded:
+                    self.tag_index.load(self.db)
+        return self.tag_index
+
+    def indexed_pages(self, path_pages):
+
+        """Turns pages of paths, e.g. from the tag index, into the (thumbnail, fullpath) pages the searches return.
+        Like the inner join in the queries, videos with no row in the thumbnails table are left out."""
+
+        for paths in path_pages:
+            found = dict(self.read_all(f'''select fullpath, thumbnail from thumbnails
+                                        where fullpath in ({", ".join("?" * len(paths))})''', paths))
+            page = [(found[x], x) for x in paths if x in found]
+            if page:
+                yield page
 
     def write_entry(self, fp, tag_group_1, tag_group_2):
 
         """Write tags for entry identified by fullpath"""
 
-        fullpath = fp.removeprefix(TOP_LEVEL + os.sep)
+        fullpath = fp.removeprefix(self.top_level + os.sep)
         score_1, score_2 = self.tags_to_ints(tag_group_1, tag_group_2)
+        words = ", ".join(f"{x} = ?" for x in SCORE_COLUMNS[0] + SCORE_COLUMNS[1])
         timenow = int(time.time())
-        self.db_cursor.execute('''update videos set score_1 = ?, 
-                                score_2 = ? , 
-                                skipped = 0,
-                                tagged_when = ? 
-                                where fullpath = ?''',
-                               (score_1, score_2, timenow, fullpath))
+        with self.write_lock:
+            self.db_cursor.execute(f'''update videos set {words}, 
+                                    skipped = 0,
+                                    tagged_when = ? 
+                                    where fullpath = ?''',
+                                   (*to_words(score_1), *to_words(score_2), timenow, fullpath))
+            self.reindex([fullpath])
+            self.db.commit()
 
-        self.db.commit()
+    def bulk_tag(self, paths, add=((), ()), remove=((), ())):
+
+        """Adds the tags in add to every one of these videos and takes away the tags in remove, both a pair of
+        lists like write_entry takes, leaving their other tags alone. Each batch of videos is one bitwise update
+        and they are all one transaction. Videos that haven't been tagged are only changed if something is added.
+        Returns how many videos were changed."""
+
+        add = self.tags_to_ints(*add)
+        sets, params = score_updates(add, self.tags_to_ints(*remove))
+        if not sets:
+            return 0
+        paths = [x.removeprefix(self.top_level + os.sep) for x in paths]
+        tagged = "" if any(add) else f" and {SCORE_COLUMNS[0][0]} is not null"
+        timenow = int(time.time())
+        changed = 0
+        with self.write_lock:
+            for start in range(0, len(paths), 500):  # stay under sqlite's limit on parameters
+                batch = paths[start:start + 500]
+                self.db_cursor.execute(f'''update videos set {sets}, skipped = 0, tagged_when = ? 
+                                        where fullpath in ({", ".join("?" * len(batch))}){tagged}''',
+                                       (*params, timenow, *batch))
+                changed += self.db_cursor.rowcount
+            self.reindex(paths)
+            self.db.commit()
+        print(f"Changed the tags of {changed} videos")
+        return changed
 
     def increment_play_count(self, fp):
 
         # print(fullpath)
-        fullpath = fp.removeprefix(TOP_LEVEL + os.sep)
-        self.db_cursor.execute('''update videos set times_viewed = times_viewed + 1
-                                where fullpath = ?''', (fullpath,))
-        self.db.commit()
+        fullpath = fp.removeprefix(self.top_level + os.sep)
+        with self.write_lock:
+            self.db_cursor.execute('''update videos set times_viewed = times_viewed + 1
+                                    where fullpath = ?''', (fullpath,))
+            self.reindex([fullpath])
+            self.db.commit()
 
     def skip_entry(self, fullpath):
 
         """Set the skipped flag so that the video is not re-visted during later tagging sessions. Skipped videos
         are never returned as search results even if the user searches on no tags."""
 
-        self.db_cursor.execute('''update videos set skipped = 1 where fullpath = ?''', (fullpath,))
-        self.db.commit()
+        fullpath = fullpath.removeprefix(self.top_level + os.sep)  # the main window passes the absolute path
+        with self.write_lock:
+            self.db_cursor.execute('''update videos set skipped = 1 where fullpath = ?''', (fullpath,))
+            self.reindex([fullpath])
+            self.db.commit()
 
     def assign_thumbnail(self, fp, gif):
 
         """Identifying an entry by fullpath, write a gif blob to the database"""
 
-        fullpath = fp.removeprefix(TOP_LEVEL + os.sep)
+        fullpath = fp.removeprefix(self.top_level + os.sep)
 
-        self.db_cursor.execute('''update thumbnails set thumbnail = ? where fullpath = ?''',
-                               (gif, fullpath))
+        with self.write_lock:
+            self.db_cursor.execute('''update thumbnails set thumbnail = ? where fullpath = ?''',
+                                   (gif, fullpath))
+            self.db_cursor.execute('''delete from signatures where fullpath = ?''', (fullpath,))  # now stale
+            self.db.commit()  # otherwise the readers won't see the new thumbnail until some other write commits
 
     def commit_changes(self):
 
         """what it sez"""
 
         print("committing changes to database and closing connection")
-        self.db.commit()
-        self.db.close()
+        with self.write_lock:
+            self.db.commit()
+            self.db.close()
+        self.readers.close()
+
+    def read_all(self, sql, params=()):
+
+        """Run a select on a pooled read-only connection and return every row. Safe from any thread."""
+
+        with self.readers.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def read_one(self, sql, params=()):
+
+        with self.readers.connection() as conn:
+            return conn.execute(sql, params).fetchone()
 
     def get_entry(self, fullpath):
 
         """gets the info for a video, finds the thumbnail from the thumbnails table and joins these results togeter,
         returns a namedtuple"""
 
-        self.db_cursor.execute('''select * from videos where fullpath = ?''', (fullpath,))
-        res = self.db_cursor.fetchone()
-        self.db_cursor.execute('''select * from thumbnails where fullpath = ?''', (fullpath,))
-        res2 = self.db_cursor.fetchone()
+        res = self.read_one('''select * from videos where fullpath = ?''', (fullpath,))
+        res2 = self.read_one('''select * from thumbnails where fullpath = ?''', (fullpath,))
 
         return self.make_dbrow(res + (res2[0],))
 
@@ -236,82 +1098,137 @@ class DBManager:
 
         """Function for use with scan mode to find the full path"""
 
-        self.db_cursor.execute('''select fullpath from videos where filename = ?''',
-                               (filename,))
-
-        results = [x for x in self.db_cursor.fetchall()]
+        results = self.read_all('''select fullpath from videos where filename = ?''', (filename,))
         if len(results) > 1:
             print("NAME COLLISION for {}".format(filename))
         return results[0][0]  # a list of tuples containing one value
 
+    @staticmethod
+    def text_query(text):
+
+        """Turns what the user typed into an FTS5 query: every word has to match, and each word is treated as a
+        prefix so results show up while a name is only half typed. Returns None for no words."""
+
+        words = text.split()
+        if not words:
+            return None
+        # each word is quoted so punctuation in it can't be read as FTS syntax, quotes are escaped by doubling
+        return " AND ".join('"{}"*'.format(w.replace('"', '""')) for w in words)
+
     def text_search(self, text, batch_size=34):
 
-        self.db_cursor.execute(f'''SELECT thumbnails.thumbnail, videos.fullpath from videos
-                                INNER JOIN
-                                thumbnails ON thumbnails.fullpath = videos.fullpath
-                                where videos.fullpath LIKE ?
-                                and skipped != 1''', (f'''%{text}%''',))
+        """Search file names and paths, best matches first, a page of batch_size at a time"""
+
+        if not self.text_index:
+            yield from self.like_search(text, batch_size)
+            return
+
+        match = self.text_query(text)
+        if match is None:
+            return
+
+        # rank and page in the subquery so only the visible page of thumbnails is read
+        qry = '''SELECT thumbnails.thumbnail, hits.fullpath from
+                (SELECT videos.fullpath, videos_fts.rank from videos_fts
+                INNER JOIN videos ON videos.rowid = videos_fts.rowid
+                where videos_fts MATCH ?
+                and skipped != 1
+                ORDER BY videos_fts.rank
+                LIMIT ? OFFSET ?) as hits
+                INNER JOIN
+                thumbnails ON thumbnails.fullpath = hits.fullpath
+                ORDER BY hits.rank'''
+
+        offset = 0
+        out = self.read_all(qry, (match, batch_size, offset))
+        while not out == []:
+            yield out
+            offset += batch_size
+            out = self.read_all(qry, (match, batch_size, offset))
 
-        # it has to be an iterator to behave like the get_matches function
-        yield self.db_cursor.fetchall()  # only return one screen of results
+    def like_search(self, text, batch_size=34):
 
-        # even though we're not really generating results, this still needs to look like a generator with a next func
+        """The old substring search, for when there is no full text index"""
 
-    def popular_search(self, tags1, tags2, batch_size=34, most_popular=True):
+        qry = '''SELECT thumbnails.thumbnail, videos.fullpath from videos
+                INNER JOIN
+                thumbnails ON thumbnails.fullpath = videos.fullpath
+                where videos.fullpath LIKE ?
+                and skipped != 1
+                LIMIT ? OFFSET ?'''
+
+        offset = 0
+        out = self.read_all(qry, (f'''%{text}%''', batch_size, offset))
+        while not out == []:
+            yield out
+            offset += batch_size
+            out = self.read_all(qry, (f'''%{text}%''', batch_size, offset))
+
+    def popular_search(self, tags1, tags2, batch_size=34, most_popular=True, exclude=((), ()), any_of=()):
+
+        query = self.compile_query(tags1, tags2, exclude, any_of)
+        if self.loaded_index():
+            yield from self.indexed_pages(self.tag_index.popular_pages(query_words(query), batch_size,
+                                                                       most_popular))
+            return
 
         if most_popular:
             popu = "DESC"
         else:
             popu = "ASC"
 
-        gqscore, eqscore = self.tags_to_ints(tags1, tags2)
         offset = 0
         limit = batch_size
         out = []
+        where, params = tag_filter(query)
         qry = '''SELECT thumbnails.thumbnail, videos.fullpath from videos
                 INNER JOIN
                 thumbnails ON thumbnails.fullpath = videos.fullpath
                 where skipped != 1
-                and score_1 & ? = ? and
-                score_2 & ? = ? 
+                and ''' + where + ''' 
                 ORDER BY times_viewed {}, RANDOM()  
                 LIMIT {} OFFSET {}'''
 
-        self.db_cursor.execute(qry.format(popu, limit, offset), (gqscore, gqscore, eqscore, eqscore))
-        out = self.db_cursor.fetchall()
+        out = self.read_all(qry.format(popu, limit, offset), params)
 
         while not out == []:
             yield out  # only return one screen of results
             offset += batch_size
-            self.db_cursor.execute(qry.format(popu, limit, offset), (gqscore, gqscore, eqscore, eqscore))
-            out = self.db_cursor.fetchall()
+            out = self.read_all(qry.format(popu, limit, offset), params)
 
 
-    def newest_matches(self, tag_group_1, tag_group_2, batch_size=34):
+    def newest_matches(self, tag_group_1, tag_group_2, batch_size=34, exclude=((), ()), any_of=()):
 
         #TODO: refactor and avoid this copy-pasted code
-        offset = 0
-        gqscore, eqscore = self.tags_to_ints(tag_group_1, tag_group_2)
+        query = self.compile_query(tag_group_1, tag_group_2, exclude, any_of)
+        if self.loaded_index():
+            yield from self.indexed_pages(self.tag_index.newest_pages(query_words(query), self.filter_directory, 52))
+            return
+
+        with self.readers.connection() as conn:  # held until the generator is exhausted or thrown away
+            yield from self.newest_matches_pages(conn.cursor(), query)
 
-        self.db_cursor.executescript('''drop table if exists abcd;
-                                                create table abcd (fp TEXT, tagged_when INTEGER)''')
+    def newest_matches_pages(self, cursor, query):
+
+        # the scratch table is a temp table so that it lives only in this reader connection
+        cursor.executescript('''drop table if exists temp.abcd;
+                                                create temp table abcd (fp TEXT, tagged_when INTEGER)''')
+        where, params = tag_filter(query)
         if self.filter_directory:
             print(f"Query with filter directory {self.filter_directory}")
-            self.db_cursor.execute('''insert into abcd (fp, tagged_when) 
+            cursor.execute(f'''insert into abcd (fp, tagged_when) 
                                                     select fullpath, tagged_when from videos 
-                                                    where score_1 & ? = ? and
-                                                    score_2 & ? = ? and
+                                                    where {where} and
                                                     tagged_when is not NULL and
                                                     directory = ? order by tagged_when desc''',
-                                   (gqscore, gqscore, eqscore, eqscore, self.filter_directory))
+                                   (*params, self.filter_directory))
         else:
-            self.db_cursor.execute('''insert into abcd (fp, tagged_when)
+            cursor.execute(f'''insert into abcd (fp, tagged_when)
                                         select fullpath, tagged_when from videos 
-                                        where score_1 & ? = ? and
-                                        score_2 & ? = ? 
+                                        where {where} 
                                         and tagged_when is not NULL
                                         order by tagged_when desc''',
-                                   (gqscore, gqscore, eqscore, eqscore))
+                                   params)
 
         # this sets up a temporary table from which we select chunks which are joined on
         # the thumbnails table, joining all results at once is too slow
@@ -323,36 +1240,47 @@ class DBManager:
                                 '''
         lim = 52
         offset = 0
-        self.db_cursor.execute(selector.format(lim, offset))
-        outa = self.db_cursor.fetchall()
+        cursor.execute(selector.format(lim, offset))
+        outa = cursor.fetchall()
 
         while not outa == []:
 
             yield outa
             offset += lim
-            self.db_cursor.execute(selector.format(lim, offset))
-            outa = self.db_cursor.fetchall()
+            cursor.execute(selector.format(lim, offset))
+            outa = cursor.fetchall()
 
-    def get_matches(self, tag_group_1, tag_group_2, batch_size=34):
+    def get_matches(self, tag_group_1, tag_group_2, batch_size=34, exclude=((), ()), any_of=()):
 
-        offset = 0
-        gqscore, eqscore = self.tags_to_ints(tag_group_1, tag_group_2)
+        """Videos with all of these tags, none of the tags in exclude and one of each list in any_of, see
+        compile_query. Shuffled, with a few recently tagged videos on each page."""
+
+        query = self.compile_query(tag_group_1, tag_group_2, exclude, any_of)
+        if self.loaded_index():
+            yield from self.indexed_pages(self.tag_index.random_pages(query_words(query), self.filter_directory,
+                                                                      batch_size, forty_days_ago()))
+            return
+
+        with self.readers.connection() as conn:  # held until the generator is exhausted or thrown away
+            yield from self.get_matches_pages(conn.cursor(), query, batch_size)
+
+    def get_matches_pages(self, cursor, query, batch_size):
 
-        self.db_cursor.executescript('''drop table if exists abcd;
-                                        create table abcd (fp TEXT, tagged_when INTEGER)''')
+        offset = 0
+        cursor.executescript('''drop table if exists temp.abcd;
+                                        create temp table abcd (fp TEXT, tagged_when INTEGER)''')
+        where, params = tag_filter(query)
         if self.filter_directory:
-            self.db_cursor.execute('''insert into abcd (fp, tagged_when) 
+            cursor.execute(f'''insert into abcd (fp, tagged_when) 
                                             select fullpath, tagged_when from videos 
-                                            where score_1 & ? = ? and
-                                            score_2 & ? = ? and
+                                            where {where} and
                                             directory = ? order by random()''',
-                                   (gqscore, gqscore, eqscore, eqscore, self.filter_directory))
+                                   (*params, self.filter_directory))
         else:
-            self.db_cursor.execute('''insert into abcd (fp, tagged_when)
+            cursor.execute(f'''insert into abcd (fp, tagged_when)
                                 select fullpath, tagged_when from videos 
-                                where score_1 & ? = ? and
-                                score_2 & ? = ? order by random()''',
-                                   (gqscore, gqscore, eqscore, eqscore))
+                                where {where} order by random()''',
+                                   params)
 
         # this sets up a temporary table from which we select chunks which are joined on
         # the thumbnails table, joining all results at once is too slow
@@ -381,15 +1309,15 @@ class DBManager:
         offset_new = new_qty
         # offset_old = batch_size - new_qty
 
-        self.db_cursor.executescript(sc_new.format(recent, new_qty, offset))
-        self.db_cursor.execute(selector.format(view="tuvw"))
-        outb = self.db_cursor.fetchall()
+        cursor.executescript(sc_new.format(recent, new_qty, offset))
+        cursor.execute(selector.format(view="tuvw"))
+        outb = cursor.fetchall()
         if len(outb) < new_qty:
             new_qty = len(outb)
 
-        self.db_cursor.executescript(sc.format(recent, batch_size - new_qty, offset))
-        self.db_cursor.execute(selector.format(view="pqrs"))
-        outa = self.db_cursor.fetchall()
+        cursor.executescript(sc.format(recent, batch_size - new_qty, offset))
+        cursor.execute(selector.format(view="pqrs"))
+        outa = cursor.fetchall()
 
         out = outb + outa  # mostly any videos, but with guaranteed some recent ones
         while not out == []:
@@ -398,43 +1326,167 @@ class DBManager:
             yield out
             offset += batch_size
 
-            self.db_cursor.executescript(sc_new.format(recent, new_qty, offset_new))
-            self.db_cursor.execute(selector.format(view="tuvw"))
-            outb = self.db_cursor.fetchall()
+            cursor.executescript(sc_new.format(recent, new_qty, offset_new))
+            cursor.execute(selector.format(view="tuvw"))
+            outb = cursor.fetchall()
 
             offset_new += new_qty
 
             if len(outb) < new_qty:
                 new_qty = len(outb)  # run out of new stuff so return more old
 
-            self.db_cursor.executescript(sc.format(recent, batch_size - new_qty, offset - new_qty))
-            self.db_cursor.execute(selector.format(view="pqrs"))
-            outa = self.db_cursor.fetchall()
+            cursor.executescript(sc.format(recent, batch_size - new_qty, offset - new_qty))
+            cursor.execute(selector.format(view="pqrs"))
+            outa = cursor.fetchall()
 
             out = outb + outa
 
         return
 
+    def facet_counts(self, tag_group_1, tag_group_2, exclude=((), ()), any_of=()):
+
+        """For the videos get_matches would return for these tags (in the filter directory if one is set),
+        returns how many there are and {tag: how many of them also have that tag}, i.e. how many results
+        each extra tag would leave.
+
+        This is one pass over the matching rows: only the scores are read, from the covering index, and rows
+        are counted per distinct pair of scores so that only the distinct scores are taken apart into bits.
+        With no tags and no directory the answer is already in the tag_stats table. Safe from any thread."""
+
+        query = self.compile_query(tag_group_1, tag_group_2, exclude, any_of)
+        if query == MATCH_ALL and not self.filter_directory:
+            # every tagged video matches. Scores are always written in pairs, so a video with a tag in one
+            # group has a (possibly 0) score in the other and tag_stats counts exactly the matching videos
+            matches = self.read_one('''select coalesce(sum(videos - untagged), 0) from directories''')[0]
+            res = self.read_all('''select grp, bit, videos from tag_stats''')
+            counts_1 = {1 << bit: videos for grp, bit, videos in res if grp == 1}
+            counts_2 = {1 << bit: videos for grp, bit, videos in res if grp == 2}
+        else:
+            where, params = tag_filter(query)
+            # only the words that have tags in them, so a library with 64 tags or fewer reads what it always did
+            used = [1 + (max(x, default=1).bit_length() - 1) // 64 for x in (self.tag_group_1_rev,
+                                                                            self.tag_group_2_rev)]
+            columns = SCORE_COLUMNS[0][:used[0]] + SCORE_COLUMNS[1][:used[1]]
+            sql = f'''select {", ".join(columns)} from videos where {where}'''
+            if self.filter_directory:
+                sql += ''' and directory = ?'''
+                params.append(self.filter_directory)
+            with self.readers.connection() as conn:
+                pairs = Counter(conn.execute(sql, params))
+            matches = sum(pairs.values())
+            words_1, words_2 = Counter(), Counter()
+            for words, videos in pairs.items():
+                words_1[words[:used[0]]] += videos
+                words_2[words[used[0]:]] += videos
+            counts_1, counts_2 = (bit_counts({from_words(k): v for k, v in x.items()}) for x in (words_1, words_2))
+
+        counts = {tag: counts_1.get(value, 0) for value, tag in self.tag_group_1_rev.items()}
+        counts.update({tag: counts_2.get(value, 0) for value, tag in self.tag_group_2_rev.items()})
+        return matches, counts
+
+    def tag_weights(self):
+
+        """{bit: weight} for each group, the log of how many times rarer than the average video the tag is, so
+        that sharing a rare tag counts for much more than sharing one almost every video has"""
+
+        tagged = self.read_one('''select coalesce(sum(videos - untagged), 0) from directories''')[0]
+        weights = ({}, {})
+        for grp, bit, videos in self.read_all('''select grp, bit, videos from tag_stats where videos > 0'''):
+            weights[grp - 1][bit] = math.log((tagged + 1) / videos)
+        return weights
+
+    def similar_videos(self, fp, batch_size=34):
+
+        """Videos with tags most like this one's, best first, see similarity(). Videos with no tag in common and
+        skipped videos are left out. Vectorised over the tag index if it is on, otherwise the videos sharing a
+        tag are scored in Python, once for each distinct pair of scores."""
+
+        fullpath = fp.removeprefix(self.top_level + os.sep)
+        columns = SCORE_COLUMNS[0] + SCORE_COLUMNS[1]
+        row = self.read_one(f'''select {", ".join(columns)} from videos where fullpath = ?''', (fullpath,))
+        scores = (None, None) if row is None else (from_words(row[:WORDS]), from_words(row[WORDS:]))
+        if None in scores:
+            print(f"{fullpath} has not been tagged")
+            return
+        words = to_words(scores[0]) + to_words(scores[1])
+        weights = self.tag_weights()
+        if self.loaded_index():
+            yield from self.indexed_pages(self.tag_index.similar_pages(fullpath, (words[:WORDS], words[WORDS:]),
+                                                                       weights, batch_size))
+            return
+
+        shared = " or ".join(f"{column} & ? != 0" for column, word in zip(columns, words) if word)
+        if not shared:
+            return  # tagged with nothing
+        rows = self.read_all(f'''select fullpath, {", ".join(columns)} from videos
+                                where ({shared}) and skipped is not 1
+                                and fullpath != ?''', (*[x for x in words if x], fullpath))
+        scored = {}
+        for row in rows:
+            if row[1:] not in scored:
+                scored[row[1:]] = similarity(scores, (from_words(row[1:WORDS + 1]), from_words(row[WORDS + 1:])),
+                                             weights)
+        rows.sort(key=lambda x: scored[x[1:]], reverse=True)
+        yield from self.indexed_pages([x[0] for x in rows[i:i + batch_size]] for i in range(0, len(rows), batch_size))
+
     def make_dbrow(self, tup):
 
         """takes a whole database row, does the int-to-tag conversion and returns a namedtuple"""
 
         args = [x for x in tup]
-        score_1 = args[8]  # have to unpack the tuple and convert g- and score_2s to tag lists
-        score_2 = args[9]  # TODO: unpack by NAME, not INDEX
-        tag_group_1, tag_group_2 = self.ints_to_tags(score_1, score_2)
-        args[8] = tag_group_1
-        args[9] = tag_group_2
-        return self.dbrow(*args)
+        words_1, words_2 = self.score_positions
+        tags = self.ints_to_tags(from_words([args[x] for x in words_1]), from_words([args[x] for x in words_2]))
+        args[words_1[0]], args[words_2[0]] = tags
+        extra_words = set(words_1[1:] + words_2[1:])
+        return self.dbrow(*[x for i, x in enumerate(args) if i not in extra_words])
 
     def get_directories(self):
 
         """Returns the list of all possible top-level directories for filtering purposes"""
 
-        print("Getting distinct directories...")
-        self.db_cursor.execute('''select distinct directory from videos order by directory collate nocase asc''')
-        # this query returns every distinct possible value in the column
-        return [x[0] for x in self.db_cursor.fetchall()]  # unpack the tuples
+        res = self.read_all('''select directory from directories order by directory collate nocase asc''')
+        # a few rows kept up to date by triggers, see MIGRATIONS
+        return [x[0] for x in res]  # unpack the tuples
+
+    def directory_stats(self):
+
+        """(directory, videos, untagged, skipped, bytes) for every directory, read from the table the triggers
+        keep up to date so it takes no time however big the library is"""
+
+        return self.read_all('''select directory, videos, untagged, skipped, bytes from directories
+                                order by directory collate nocase asc''')
+
+    def tag_stats(self):
+
+        """(tag group, tag, videos with it) for every tag, most used first"""
+
+        res = self.read_all('''select grp, bit, videos from tag_stats order by videos desc''')
+        names = {1: self.tag_group_1_rev, 2: self.tag_group_2_rev}
+        return [(f"tag_group_{grp}", names[grp].get(1 << bit, f"bit {bit}"), videos) for grp, bit, videos in res]
+
+    def rebuild_stats(self):
+
+        """Works the statistics out from scratch with STATS_QUERIES, prints every row where the tables kept by the
+        triggers were wrong and replaces them. Returns the number of wrong or missing rows, which should be 0."""
+
+        wrong = 0
+        with self.write_lock:
+            for table, columns in (("directories", "directory, videos, untagged, skipped, bytes"),
+                                   ("tag_stats", "grp, bit, videos")):
+                self.db_cursor.execute(STATS_QUERIES[table])
+                expected = set(self.db_cursor.fetchall())
+                self.db_cursor.execute(f'''select {columns} from {table}''')
+                found = set(self.db_cursor.fetchall())
+                for row in sorted(found - expected, key=str):
+                    print(f"{table} had {row}")
+                for row in sorted(expected - found, key=str):
+                    print(f"{table} should have {row}")
+                wrong += len(found ^ expected)
+                self.db_cursor.execute(f'''delete from {table}''')
+                self.db_cursor.execute(f'''insert into {table} ({columns}) ''' + STATS_QUERIES[table])
+            self.db.commit()
+        print(f"Statistics rebuilt, {wrong} rows were out of date")
+        return wrong
 
     def get_icons(self):
 
@@ -453,16 +1505,14 @@ class DBManager:
 
         """Return true if a thumbnail blob exists"""
 
-        fullpath = fp.removeprefix(TOP_LEVEL + os.sep)
+        fullpath = fp.removeprefix(self.top_level + os.sep)
 
         # self.db_cursor.execute('''select thumbnail from videos where fullpath = ? and thumbnail not null''',
         #                       (fullpath,))   # old database structure
-        self.db_cursor.execute('''select thumbnail from thumbnails
+        res = self.read_one('''select thumbnail from thumbnails
                                 where fullpath = ?
                                 and thumbnail not null''', (fullpath,))
 
-        res = self.db_cursor.fetchone()
-
         if not res:
             return False
         else:
@@ -478,13 +1528,13 @@ class DBManager:
         returns a list having fetchall'ed from the db cursor"""
 
         if random is False:
-            self.db_cursor.execute('''select fullpath from videos 
+            res = self.read_all('''select fullpath from videos 
             where directory = ? 
             and skipped is not 1
             and score_1 is null
             and score_2 is null''', (directory,))
         else:
-            self.db_cursor.execute('''select fullpath from videos 
+            res = self.read_all('''select fullpath from videos 
             where skipped is not 1
             and score_1 is null
             and score_2 is null
@@ -494,10 +1544,9 @@ class DBManager:
             # and duration not null
             # and duration > 420  additional contstraints cut out
 
-        return [os.path.join(TOP_LEVEL, x[0]) for x in self.db_cursor.fetchall()]
+        return [os.path.join(self.top_level, x[0]) for x in res]
 
-        # have to unpack the whole thing otherwise SQL will complain about being
-        # called from another thread
+        # unpacked into a plain list so the thumbnail thread never touches a database cursor
 
     def remove_directory_filter(self):
 
@@ -513,75 +1562,117 @@ class DBManager:
         print("set filter directory", path)
         self.filter_directory = path
 
-    def check_if_new_file(self, fullpath):
+    def check_if_new_file(self, fullpath, st, progress=None, fhash=None):
 
-        """New fullpath has been found that is not in DB - check to see if the new file
-        is duplicate (using size/hash comparison) or check if an old file was moved"""
+        """New fullpath has been found that is not in DB - check to see if the new file is a duplicate of one
+        already in the library. st is the file's os.stat result and fhash its md5, if already known. The
+        comparison uses the sizes and hashes stored in the database, so the existing files don't have to be read
+        again."""
 
-        bits = fullpath.split("\\")
-        directory = bits[1]
-        dupe = False
-        if directory == "$RECYCLE.BIN":
-            return False
+        with self.write_lock:
+            self.db_cursor.execute('''select fullpath, md5 from videos where filesize = ?''', (st.st_size,))
+            found = self.db_cursor.fetchall()
+        if not found:
+            print("{} is a new file".format(fullpath))
+            return True
 
-        new_file_size = os.stat(fullpath).st_size
-        self.db_cursor.execute('''select fullpath from videos where filesize = ?''', (new_file_size,))
-        found = self.db_cursor.fetchall()
-        if found:
-            print("Found matching filesize, checking hash")
-            this_hash = self.get_file_hash(fullpath)
-            for qa in found:
-                print(qa)
-                found_path = qa[0]
+        print("Found matching filesize, checking hash")
+        this_hash = fhash or self.fingerprint(fullpath, progress)
+        for found_path, found_hash in found:
+            if found_hash is None:  # entry from before hashes were stored
                 try:
-                    fhash = self.get_file_hash(found_path)
-
+                    found_hash = self.fingerprint(os.path.join(self.top_level, found_path), progress)
                 except FileNotFoundError:
-                    print("File {} no longer exists, updating entry".format(found_path))
-                    self.db_cursor.execute('''
-                    update videos 
-                    set fullpath = ?,
-                    filename = ? 
-                    where fullpath = ?''', (fullpath, os.path.split(fullpath)[-1], found_path,))
-                    print("New file location is {}".format(fullpath))
-                    dupe = True
-                    break
-                if fhash == this_hash:
-                    print("New file %s already exists at %s (matching hash and size)"
-                          % (fullpath, found_path))
-                    report = f"{fullpath}\t{found_path}\n"
-                    fname = f"dupe_report_{get_today_date()}.csv"
-                    # note two files will be created if dupe checking happens across midnight
-                    with open(fname, "a") as f:
-                        f.write(report)
-
-                    dupe = True
-                    break
-        else:
-            dupe = False
+                    continue
+            if found_hash == this_hash:
+                print("New file %s already exists at %s (matching hash and size)"
+                      % (fullpath, found_path))
+                report = f"{fullpath}\t{found_path}\n"
+                fname = f"dupe_report_{get_today_date()}.csv"
+                # note two files will be created if dupe checking happens across midnight
+                with open(fname, "a") as f:
+                    f.write(report)
+                print("File already exists and was not added")
+                return False
+
+        print("{} is a new file".format(fullpath))
+        return True
+
+    def scan_for_new_files(self, toplevel, progress=None):
 
-        if dupe:
-            print("File already exists and was not added")
-            return False
-        else:
-            print("{} is a new file".format(fullpath))
-            return True
+        """walks the entirety of toplevel. If files are found with allowed extensions,
+        new entries are created for them in the db.
 
-    def scan_for_new_files(self, toplevel):
+        The scan runs in phases: walk the library, match files that went missing against files that appeared
+        (moves and renames keep their tags and thumbnail), add the rest as new entries and finally remove entries
+        whose files are gone.
 
-        """walks the entirety of toplevel. If files are found with allowed extensions,
-        new entries are created for them in the db."""
+        progress is a ScanProgress that the GUI can watch and use to pause or cancel the scan. Work is
+        committed every SCAN_COMMIT_EVERY changes or SCAN_CHECKPOINT_SECS seconds, and every hash and probe is
+        recorded in the scan journal, so a scan that is cancelled or crashes picks up where it stopped next
+        time without reading those files again. The writer lock is only held for the database statements, not
+        while hashing or probing, so the user can carry on tagging during a scan."""
+
+        if progress is None:
+            progress = ScanProgress()
+        self.scan_pending = 0
+        self.last_checkpoint = time.time()
 
         # note: here is the command that was used to strip the root drive from the fullpaths, to just get relative paths
         # UPDATE videos SET directory = substr(fullpath, 0, INSTR(fullpath, '\'));
 
-        added = 0
-        self.db_cursor.execute('''select fullpath from videos''')
-        known = set([os.path.join(TOP_LEVEL, x[0]) for x in self.db_cursor.fetchall()])
-        # better than looking up each indivudal name in SQL
-        # the os.path.join part is needed to "regenerate" the fullpath for comparison with os.walk
-        # os.walk gives us the full paths, but the database doesn't store the root directory, so we add it back on.
-        verified = set()  # used at end to check if any files are missing
+        progress.phase = "walking"
+        with self.write_lock:
+            self.db_cursor.execute('''select fullpath, inode from videos''')
+            res = self.db_cursor.fetchall()
+        known = set(x[0] for x in res)  # better than looking up each indivudal name in SQL
+        # the database doesn't store the root directory, so paths found by the walk are compared without it
+        needs_inode = set(x[0] for x in res if x[1] is None)  # entries from before inodes were stored
+        seen, new_files = self.walk_library(toplevel, known, needs_inode, progress)
+        missing = known - seen
+
+        if missing and new_files and not progress.cancelled():
+            progress.phase = "matching moved files"
+            new_files = self.reconcile_moves(toplevel, missing, new_files, progress)
+
+        progress.phase = "adding new files"
+        for fullpath, st, fhash in new_files:
+            if progress.checkpoint():  # blocks here while paused
+                break
+            self.add_new_file(toplevel, fullpath, st, progress, fhash)
+
+        print("Added {} new entries".format(progress.inserted))
+
+        with self.write_lock:
+            if progress.cancelled():
+                # the walk didn't finish, so anything not seen yet isn't necessarily missing
+                print("Scan cancelled, keeping the entries added so far")
+            else:
+                if missing:
+                    progress.phase = "removing missing videos"
+                    print(f"Moving {len(missing)} missing videos to the deletions table")
+                    progress.removed += self.remove_videos(missing)
+
+                self.db_cursor.execute('''delete from scan_journal''')  # everything is in the videos table now
+
+            self.db.commit()
+        if missing and not progress.cancelled():
+            self.collect_orphans()
+            if SETTINGS.get("VACUUM_AFTER_REMOVAL", False):  # give space back to the disk after a scan
+                progress.phase = "vacuuming"
+                self.reclaim_space()
+        progress.finish()
+        print(progress.summary())
+
+    def walk_library(self, toplevel, known, needs_inode, progress):
+
+        """First phase of a scan. Returns the set of known (relative) paths that were found and a list of
+        (fullpath, os.stat result, None) for video files that aren't in the database, the None being for their
+        md5 once it's known. Known files whose inode hasn't been recorded yet get it filled in on the way."""
+
+        seen = set()
+        new_files = []
+        inodes = []
         for head, folders, files in os.walk(toplevel):
             # print(f"{head}, {folders}, {files}")
             if "__" in head:
@@ -591,73 +1682,387 @@ class DBManager:
                 _, ext = os.path.splitext(filename)
                 if ext.lower() not in self.extensions:
                     continue
+                if progress.checkpoint():  # blocks here while paused
+                    break
+                progress.walked += 1
                 fullpath = os.path.join(head, filename)
-                if fullpath in known:
-                    verified.add(fullpath)
+                noroot = fullpath.removeprefix(toplevel + os.sep)  # file loc independent of toplevel location
+                if noroot in known:
+                    seen.add(noroot)
+                    if noroot in needs_inode:
+                        inodes.append((os.stat(fullpath).st_ino or None, noroot))
+                    continue
+                if "$RECYCLE.BIN" in noroot.split(os.sep):
                     continue
+                new_files.append((fullpath, os.stat(fullpath), None))
+            if progress.cancelled():
+                break
+
+        if inodes:
+            with self.write_lock:
+                self.db_cursor.executemany('''update videos set inode = ? where fullpath = ?''', inodes)
+                self.db.commit()
+
+        return seen, new_files
+
+    def reconcile_moves(self, toplevel, missing, new_files, progress):
+
+        """Matches the whole set of missing entries against the whole set of new files in memory, first by
+        (size, inode), which catches moves within a drive without reading anything, then by (size, md5) using
+        the stored hash, so only new files the same size as a missing one are hashed. Matched entries are moved
+        to their new paths in one batch, keeping their tags and thumbnail. Matches are taken out of missing,
+        and the new files that didn't match anything are returned, with their md5 if it had to be taken."""
+
+        with self.write_lock:
+            self.db_cursor.execute('''select fullpath, filesize, md5, inode from videos''')
+            rows = [x for x in self.db_cursor.fetchall() if x[0] in missing]
+        by_inode = {}
+        by_hash = {}
+        for fullpath, filesize, fhash, inode in rows:
+            if inode:
+                by_inode[(filesize, inode)] = fullpath
+            if fhash:
+                by_hash.setdefault((filesize, fhash), []).append(fullpath)
+        sizes = set(x[1] for x in rows)
+
+        moves = []
+        unmatched = []
+        for fullpath, st, fhash in new_files:
+            if st.st_size not in sizes or progress.checkpoint():
+                unmatched.append((fullpath, st, fhash))
+                continue
+            old = by_inode.get((st.st_size, st.st_ino))
+            if old not in missing:  # no inode match, or that entry has already been claimed by a hash match
+                old = None
+                fhash = fhash or self.fingerprint(fullpath, progress)
+                candidates = by_hash.get((st.st_size, fhash), [])
+                while candidates and old is None:
+                    old = candidates.pop()
+                    if old not in missing:
+                        old = None
+            if old is None:
+                unmatched.append((fullpath, st, fhash))
+                continue
+            missing.discard(old)
+            noroot = fullpath.removeprefix(toplevel + os.sep)
+            directory = noroot.split(os.path.sep)[0]
+            moves.append((noroot, os.path.split(noroot)[-1], directory, st.st_ino or None, old))
+            print(f"{old} was moved to {noroot}")
+
+        if moves:
+            with self.write_lock:
+                self.db_cursor.executemany('''update videos 
+                                            set fullpath = ?, filename = ?, directory = ?, inode = ? 
+                                            where fullpath = ?''', moves)
+                renames = [(new, old) for new, filename, directory, inode, old in moves]
+                # "or replace" in case an old entry for the new path was left behind in these tables
+                self.db_cursor.executemany('''update or replace thumbnails set fullpath = ? where fullpath = ?''',
+                                           renames)
+                self.db_cursor.executemany('''update or replace signatures set fullpath = ? where fullpath = ?''',
+                                           renames)
+                self.reindex([x for pair in renames for x in pair])
+                self.db.commit()
+            progress.moved += len(moves)
+
+        return unmatched
+
+    def add_new_file(self, toplevel, fullpath, st, progress, fhash=None):
+
+        """Last phase of a scan, for files that weren't moved from somewhere else in the library. Inserts a new
+        entry, or moves the file to the dupes folder if it is a copy of a video already in the library. fhash is
+        the file's md5 if matching moved files already took it, so the file is only hashed once."""
+
+        fhash = fhash or self.fingerprint(fullpath, progress)
+        if not self.check_if_new_file(fullpath, st, progress, fhash):
+            try:
+                move(fullpath, self.dupes_folder)
+                progress.duped += 1
+                print(f"{fullpath} is not new and was moved to the dupes folder.")
+            except Exception as e:
+                print(e)
+            return
 
-                if self.check_if_new_file(fullpath):
-                    created = os.path.getctime(fullpath)
-                    fhash = self.get_file_hash(fullpath)
-                    fsize = os.stat(fullpath).st_size
+        created = st.st_ctime
 
-                    # UPDATE videos SET directory = SUBSTR(fullpath, 0, INSTR(fullpath, '\'))
-                    # WHERE directory is NULL;  <-- query to manually add directory from fullpath
+        # UPDATE videos SET directory = SUBSTR(fullpath, 0, INSTR(fullpath, '\'))
+        # WHERE directory is NULL;  <-- query to manually add directory from fullpath
 
-                    noroot = fullpath.removeprefix(toplevel + os.sep)  # file loc independent of toplevel location
-                    directory = noroot.split(os.path.sep)[0]  # the highest level directory within the root
+        noroot = fullpath.removeprefix(toplevel + os.sep)  # file loc independent of toplevel location
+        directory = noroot.split(os.path.sep)[0]  # the highest level directory within the root
+        filename = os.path.split(noroot)[-1]
 
-                    try:
-                        dur, unused = VideoObject.get_initial_info(fullpath)
-                    except BadVideoException:
-                        print(f"Video at {fullpath} appears to be broken, skipping.")  # TODO: actually move
-                        continue
-
-                    resx, resy = self.get_video_res(fullpath)
-                    self.db_cursor.execute('''insert into videos (
-                                            fullpath,
-                                            filename,
-                                            filesize,
-                                            directory,
-                                            created,
-                                            md5,
-                                            duration,
-                                            width,
-                                            height,
-                                            times_viewed) values
-                                            (?,?,?,?,?,?,?,?,?,?)''', (noroot, filename, fsize,
-                                                                       directory, created, fhash, dur, resx, resy, 0))
-                    try:
-                        self.db_cursor.execute('''insert into thumbnails (fullpath) values (?)''', (noroot,))
-                    except sqlite3.IntegrityError:
-                        print(f"Thumbnail already existed for {fullpath}")  # TODO: probably best handled inside SQL
-                        # the only time this should happen is if a video is removed (added to the deletions table)
-                        # and then re-added later
-                        # TODO: have thumbnail deleted when video is deleted
-                    # need to insert it into info table AND thumbnail table
-                    # print("Made new db entry for {}".format(filename))
-                    added += 1
-                    known.add(fullpath)  # need to add it to the set otherwise walker will try to add multiple times
-                    verified.add(fullpath)
-                else:
-                    try:
-                        move(fullpath, DUPES_FOLDER)
-                        print(f"{fullpath} is not new and was moved to the dupes folder.")
-                    except Exception as e:
-                        print(e)
-                    verified.add(fullpath)
+        try:
+            dur, resx, resy = self.probe(fullpath, progress)
+        except BadVideoException:
+            print(f"Video at {fullpath} appears to be broken, skipping.")  # TODO: actually move
+            return
+
+        with self.write_lock:
+            self.db_cursor.execute('''insert into videos (
+                                    fullpath,
+                                    filename,
+                                    filesize,
+                                    directory,
+                                    created,
+                                    md5,
+                                    duration,
+                                    width,
+                                    height,
+                                    times_viewed,
+                                    inode) values
+                                    (?,?,?,?,?,?,?,?,?,?,?)''', (noroot, filename, st.st_size, directory, created,
+                                                               fhash, dur, resx, resy, 0, st.st_ino or None))
+            try:
+                self.db_cursor.execute('''insert into thumbnails (fullpath) values (?)''', (noroot,))
+            except sqlite3.IntegrityError:
+                # removing a video deletes its thumbnail, so this is one left behind by an older version that
+                # collect_orphans hasn't cleaned up yet
+                print(f"Thumbnail already existed for {fullpath}")
+            self.reindex([noroot])
+            # need to insert it into info table AND thumbnail table
+            # print("Made new db entry for {}".format(filename))
+            self.checkpoint_scan()
+        progress.inserted += 1
+
+    def checkpoint_scan(self):
+
+        """Called by the scan after each change with the writer lock held. Commits once enough changes
+        have built up or enough time has passed since the last commit"""
+
+        self.scan_pending += 1
+        if (self.scan_pending >= SETTINGS.get("SCAN_COMMIT_EVERY", 50)
+                or time.time() - self.last_checkpoint > SETTINGS.get("SCAN_CHECKPOINT_SECS", 30)):
+            self.db.commit()
+            self.scan_pending = 0
+            self.last_checkpoint = time.time()
+
+    def fingerprint(self, fullpath, progress=None):
+
+        """md5 of the file at fullpath. Taken from the scan journal if the file was already hashed by an
+        earlier scan and hasn't changed size or modification time since, otherwise hashed and journalled."""
+
+        st = os.stat(fullpath)
+        with self.write_lock:
+            self.db_cursor.execute('''select md5 from scan_journal 
+                                    where fullpath = ? and filesize = ? and mtime = ? 
+                                    and md5 is not null''', (fullpath, st.st_size, st.st_mtime))
+            row = self.db_cursor.fetchone()
+        if row:
+            if progress:
+                progress.reused += 1
+            return row[0]
+
+        fhash = self.get_file_hash(fullpath)
+        if progress:
+            progress.hashed += 1
+        with self.write_lock:
+            # replacing the whole row also throws away probe results for an older version of the file
+            self.db_cursor.execute('''insert or replace into scan_journal (fullpath, filesize, mtime, md5) 
+                                    values (?,?,?,?)''', (fullpath, st.st_size, st.st_mtime, fhash))
+            self.checkpoint_scan()
+        return fhash
+
+    def probe(self, fullpath, progress=None):
+
+        """(duration, width, height) of the video from the media backend, cached in the scan journal like
+        fingerprint. Raises BadVideoException if the backend can't read it."""
+
+        st = os.stat(fullpath)
+        with self.write_lock:
+            self.db_cursor.execute('''select duration, width, height from scan_journal 
+                                    where fullpath = ? and filesize = ? and mtime = ? 
+                                    and duration is not null''', (fullpath, st.st_size, st.st_mtime))
+            row = self.db_cursor.fetchone()
+        if row:
+            if progress:
+                progress.reused += 1
+            return row
+
+        dur, resx, resy = self.media.probe(fullpath)
+        if progress:
+            progress.probed += 1
+        with self.write_lock:
+            self.db_cursor.execute('''update scan_journal set duration = ?, width = ?, height = ? 
+                                    where fullpath = ? and filesize = ? and mtime = ?''',
+                                   (dur, resx, resy, fullpath, st.st_size, st.st_mtime))
+            if self.db_cursor.rowcount == 0:
+                self.db_cursor.execute('''insert or replace into scan_journal 
+                                        (fullpath, filesize, mtime, duration, width, height) 
+                                        values (?,?,?,?,?,?)''', (fullpath, st.st_size, st.st_mtime, dur, resx, resy))
+            self.checkpoint_scan()
+        return dur, resx, resy
+
+    def find_duplicates(self):
+
+        """Every set of exact duplicates in the library, found from the stored sizes and hashes alone so no
+        files are read. Returns a list of DupeCluster, the most reclaimable space first."""
+
+        # the grouping runs entirely on the (filesize, md5) index, only the duplicated rows are then looked up
+        res = self.read_all('''select videos.filesize, videos.md5, videos.fullpath from videos
+                                inner join
+                                (select filesize, md5 from videos 
+                                where md5 is not null 
+                                group by filesize, md5 
+                                having count(*) > 1) as dupes
+                                on videos.filesize = dupes.filesize and videos.md5 = dupes.md5
+                                order by videos.filesize, videos.md5, 
+                                videos.tagged_when is null, videos.times_viewed desc, videos.created''')
+        # the ordering puts the copy to keep first in each group: tagged, then most watched, then oldest
+
+        clusters = []
+        current = None
+        for filesize, fhash, fullpath in res:
+            if current and current[0] == filesize and current[1] == fhash:
+                current[3].append(fullpath)
+            else:
+                current = [filesize, fhash, fullpath, []]
+                clusters.append(current)
+
+        out = [DupeCluster(size, fhash, keep, extras, size * len(extras)) for size, fhash, keep, extras in clusters]
+        out.sort(key=lambda c: c.reclaimable, reverse=True)
+        return out
+
+    def write_duplicate_report(self, clusters):
+
+        """Writes the clusters to a dated report in the same tab separated format as the one made while
+        scanning, plus the size and hash. Returns the filename."""
+
+        fname = f"library_dupe_report_{get_today_date()}.csv"
+        with open(fname, "w") as f:
+            for c in clusters:
+                for extra in c.extras:
+                    f.write(f"{extra}\t{c.keep}\t{c.filesize}\t{c.md5}\n")
+        total = sum(c.reclaimable for c in clusters)
+        print(f"{len(clusters)} sets of duplicates, {round(total / (1024 ** 3), 2)} GB reclaimable, see {fname}")
+        return fname
+
+    def move_duplicates(self, clusters):
+
+        """Moves every extra copy to the dupes folder and takes it out of the library in one transaction.
+        Returns the number of bytes moved."""
+
+        total = 0
+        moved = []
+        for c in clusters:
+            for extra in c.extras:
+                try:
+                    move(os.path.join(self.top_level, extra), self.dupes_folder)
+                except (Error, OSError) as e:  # e.g. a file of that name is already in the dupes folder
+                    print(e)
                     continue
+                moved.append(extra)
+                total += c.filesize
+        with self.write_lock:
+            self.remove_videos(moved)
+            self.db.commit()
+        print(f"Moved {round(total / (1024 ** 3), 2)} GB of duplicates to {self.dupes_folder}")
+        return total
 
-        print("Added {} new entries".format(added))
+    def update_signatures(self):
 
-        missing = known - verified
+        """Works out the perceptual hash of every thumbnail that doesn't have one yet. Returns how many were added."""
 
-        if missing:
-            print("Removing missing videos")
-            for x in missing:
-                self.remove_video(x)
+        added = 0
+        batch = []
+        with self.readers.connection() as conn:
+            # iterating the cursor rather than fetchall'ing so only one thumbnail blob is in memory at a time
+            res = conn.execute('''select thumbnails.fullpath, thumbnails.thumbnail from thumbnails
+                                left join 
+                                signatures on signatures.fullpath = thumbnails.fullpath
+                                where thumbnails.thumbnail is not null
+                                and signatures.fullpath is null''')
+            for fullpath, blob in res:
+                value = dhash_blob(blob)
+                if value is None:
+                    print(f"Couldn't read the thumbnail for {fullpath}")
+                    continue
+                batch.append((fullpath, to_signed(value)))
+                if len(batch) >= 500:
+                    added += self.store_signatures(batch)
+                    batch = []
+        added += self.store_signatures(batch)
+        print(f"Computed {added} new perceptual signatures")
 
-        self.db.commit()
+        return added
+
+    def store_signatures(self, batch):
+
+        with self.write_lock:
+            self.db_cursor.executemany('''insert or replace into signatures (fullpath, dhash) values (?, ?)''', batch)
+            self.db.commit()
+        return len(batch)
+
+    def near_duplicates(self, radius=None):
+
+        """Pairs of videos that look the same but aren't byte-for-byte copies, e.g. re-encodes or different
+        resolutions of one video. radius is how many of the 64 bits of the thumbnails' hashes can differ,
+        NEAR_DUPE_DISTANCE in the settings by default. Returns a list of NearDupe, closest first."""
+
+        if radius is None:
+            radius = SETTINGS.get("NEAR_DUPE_DISTANCE", 6)
+        max_gap = SETTINGS.get("NEAR_DUPE_DURATION", 2.0)  # max seconds between the videos' durations
+        self.update_signatures()
+        res = self.read_all('''select signatures.fullpath, signatures.dhash, videos.duration, videos.md5 
+                                from signatures
+                                inner join 
+                                videos on videos.fullpath = signatures.fullpath''')
+        info = {fullpath: (duration, fhash) for fullpath, value, duration, fhash in res}
+        pairs = near_pairs([(fullpath, to_unsigned(value)) for fullpath, value, duration, fhash in res], radius)
+
+        out = []
+        for a, b, distance in pairs:
+            duration_a, hash_a = info[a]
+            duration_b, hash_b = info[b]
+            if hash_a is not None and hash_a == hash_b:
+                continue  # exact copy, find_duplicates deals with those
+            if duration_a and duration_b and abs(duration_a - duration_b) > max_gap:
+                continue  # similar looking thumbnail but a different video, e.g. parts of a series
+            out.append(NearDupe(a, b, distance))
+        print(f"Found {len(out)} pairs of near-duplicate videos")
+
+        return out
+
+    def write_near_duplicate_report(self, pairs):
+
+        fname = f"near_dupe_report_{get_today_date()}.csv"
+        with open(fname, "w") as f:
+            for p in pairs:
+                f.write(f"{p.fullpath_a}\t{p.fullpath_b}\t{p.distance}\n")
+        return fname
+
+    def thumbnail_pages(self, paths, batch_size=34):
+
+        """Pages of (thumbnail, fullpath) for a given list of paths, in that order, so that any list of
+        videos can be shown in the query window like a search result"""
+
+        for i in range(0, len(paths), batch_size):
+            chunk = paths[i:i + batch_size]
+            placeholders = ",".join("?" * len(chunk))
+            res = self.read_all(f'''select fullpath, thumbnail from thumbnails 
+                                    where fullpath in ({placeholders})''', chunk)
+            thumbs = dict(res)
+            yield [(thumbs.get(x), x) for x in chunk]
+
+    def all_entries(self, batch_size=1000):
+
+        """Every video in the library as a dbrow without its thumbnail, e.g. for exporting. Fetched in batches so
+        the whole library is never in memory at once."""
+
+        with self.readers.connection() as conn:
+            cursor = conn.execute('''select * from videos order by fullpath''')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield self.make_dbrow(row + (None,))
+
+    def paths_without_thumbnail(self):
+
+        """Absolute paths of the videos that have never had a thumbnail chosen"""
+
+        res = self.read_all('''select fullpath from thumbnails where thumbnail is null order by fullpath''')
+        return [os.path.join(self.top_level, x[0]) for x in res]
 
     def get_file_hash(self, fullpath):
 
@@ -668,79 +2073,135 @@ class DBManager:
                 hasher.update(chunk)
         return hasher.hexdigest()
 
-    def get_video_res(self, fullpath):
-
-        """Using the videoobject staticmethod to get vid resolution"""
+    def remove_video(self, fullpath):
 
-        res = VideoObject.get_video_res(fullpath)
-        try:
-            w, h = res.split("x")
-        except ValueError:  # ffprobe couldn't get the dimensions
-            w = h = 0
+        """Moves an entry from the videos table to the removed table, for when the file was not found"""
 
-        return int(w), int(h)
+        self.remove_videos([fullpath])
+        print("{} was moved to the deletions table".format(fullpath))
 
-    def remove_video(self, fullpath):
+    def remove_videos(self, paths):
 
-        """Moves an entry from the videos table to the removed table, for when the file was not found"""
+        """Moves many entries to the removed table at once and deletes their thumbnails and signatures. The paths
+        (absolute or relative to the top level) are staged in a temp table, so the whole removal is a handful of
+        statements however many videos there are. The caller commits. Returns the number of entries removed."""
 
         removal_time = time.time()
-        self.db_cursor.execute('''insert into removed 
-        (fullpath, filename, filesize) 
-        select fullpath,filename,filesize 
-        from videos where fullpath = ?''', (fullpath,))
-        self.db_cursor.execute('''update removed set deletion_date = ? where fullpath = ?''', (removal_time, fullpath))
-        self.db_cursor.execute('''delete from videos where fullpath = ?''', (fullpath,))
+        with self.write_lock:
+            self.db_cursor.execute('''create temp table if not exists removal_stage (fullpath text primary key)''')
+            self.db_cursor.executemany('''insert or ignore into removal_stage (fullpath) values (?)''',
+                                       [(x.removeprefix(self.top_level + os.sep),) for x in paths])
+            self.db_cursor.execute('''insert into removed 
+            (fullpath, filename, filesize, deletion_date) 
+            select fullpath, filename, filesize, ? 
+            from videos where fullpath in (select fullpath from removal_stage)''', (removal_time,))
+            removed = self.db_cursor.rowcount
+            for table in ("videos", "thumbnails", "signatures"):
+                self.db_cursor.execute(f'''delete from {table} where fullpath in (select fullpath from removal_stage)''')
+            self.db_cursor.execute('''delete from removal_stage''')
+            self.reindex([x.removeprefix(self.top_level + os.sep) for x in paths])
+
+        return removed
+
+    def collect_orphans(self):
+
+        """Deletes thumbnails and signatures left behind by videos removed before removal cleaned them up.
+        Only the fullpath column is read, so the thumbnail blobs themselves are never loaded."""
+
+        with self.write_lock:
+            orphans = 0
+            for table in ("thumbnails", "signatures"):
+                self.db_cursor.execute(f'''delete from {table} 
+                                        where fullpath not in (select fullpath from videos)''')
+                orphans += self.db_cursor.rowcount
+            self.db.commit()
+        if orphans:
+            print(f"Deleted {orphans} orphaned thumbnails and signatures")
+
+        return orphans
+
+    def reclaim_space(self, full=False):
+
+        """Gives the space left by deleted rows back to the file system and returns how many bytes that was.
+        Databases made before incremental vacuuming was switched on need one full VACUUM first, which rewrites
+        the whole file and can take a while on a big library, so that only happens when full is True."""
+
+        before = os.path.getsize(self.db_path)
+        with self.write_lock:
+            self.db.commit()  # vacuum can't run inside a transaction
+            self.db_cursor.execute('''pragma auto_vacuum''')
+            if self.db_cursor.fetchone()[0] != 2:  # 2 is INCREMENTAL
+                if not full:
+                    print("Incremental vacuum isn't enabled for this database yet, needs a full vacuum first")
+                    return 0
+                print("Converting the database to incremental vacuum, this rewrites the whole file...")
+                self.db_cursor.execute('''pragma auto_vacuum = INCREMENTAL''')
+                self.db_cursor.execute('''vacuum''')
+            self.db_cursor.execute('''pragma freelist_count''')
+            free_pages = self.db_cursor.fetchone()[0]
+            self.db_cursor.execute('''pragma incremental_vacuum''')
+            self.db_cursor.fetchall()
+            self.db.commit()
+            self.db_cursor.execute('''pragma wal_checkpoint(TRUNCATE)''')  # the file only shrinks on checkpoint
+            self.db_cursor.fetchall()
+        reclaimed = before - os.path.getsize(self.db_path)
+        print(f"Vacuumed {free_pages} free pages, the database shrank by {round(reclaimed / (1024 ** 2), 1)} MB")
 
-        print("{} was moved to the deletions table".format(fullpath))
+        return reclaimed
 
     def free_up_space(self, amount):
 
         """Free space in the main videos directory by moving videos that were skipped for tagging to the trash folder.
         e.g. the destination dir can be on a different drive or just somewhere outside the library."""
 
-        allowed_dirs = iter(DELETION_WHITELIST)  # the allowed directories to delete from
-        dirct = next(allowed_dirs)
-        self.db_cursor.execute('''select * from videos where skipped = 1 and directory = ? order by filesize''',
-                               (dirct,))
-        # throw out the smallest videos first
-        res = iter(self.db_cursor.fetchall())
-        total = 0  # keep track of how much has been deleted and only delete the minimum necessary
-        while total < amount:  # amount is bytes of data to free up
-            try:
-                x = next(res)  # can't use a for loop because we need to check amount deleted after every entry
-            except StopIteration:  # time to move to the next directory down
-                dirct = next(allowed_dirs)
-                self.db_cursor.execute('''select * from videos where skipped = 1 and directory = ? order by filesize''',
-                                       (dirct,))
-                res = iter(self.db_cursor.fetchall())
-                continue  # go back to the top of the loop, there is a chance that this next directory has no skipped
-                # files in it so then we'll need to advance to the next directory along
-            q = self.dbrow(*x, None)  # passing None as the thumbnail because we don't need it
-            # making it into a namedtuple/dbrow means we can now access attributes by column name
-            fsize = q.filesize
-            fullpath = q.fullpath
-            trash_dest = os.path.join(TRASH_FOLDER, q.directory)
-            if not os.path.exists(trash_dest):
-                os.makedirs(trash_dest)
+        with self.write_lock:
+            allowed_dirs = iter(deletion_whitelist())  # the allowed directories to delete from
+            res = iter(())  # the skipped videos of the current directory, empty until the first one is read
+            total = 0  # keep track of how much has been deleted and only delete the minimum necessary
+            moved = []  # taken out of the database together at the end, even if something goes wrong on the way
             try:
-                move(fullpath, trash_dest)
-                self.remove_video(fullpath)  # may as well do this now as we know it's being "deleted"
-                total += fsize
-                print(f"Moving files... ({total} / {amount})", end="\r")  # end = carriage return overwrites the line
-            except Error as e:  # "Error" comes from the shutil module
-                print(e)  # e.g. might run into duplicate file names, just print the exception and do nothing
-        print(f"Done, moved {round(total/(1024**3), 2)} GB of data to the trash folder.")
-        self.db.commit()
+                while total < amount:  # amount is bytes of data to free up
+                    try:
+                        x = next(res)  # can't use a for loop because we need to check amount deleted after every entry
+                    except StopIteration:  # time to move to the next directory down
+                        dirct = next(allowed_dirs, None)
+                        if dirct is None:
+                            print("No more skipped videos in the whitelisted directories")
+                            break
+                        self.db_cursor.execute('''select * from videos where skipped = 1 and directory = ? 
+                                               order by filesize''', (dirct,))
+                        # throw out the smallest videos first
+                        res = iter(self.db_cursor.fetchall())
+                        continue  # go back to the top of the loop, there is a chance that this next directory has no
+                        # skipped files in it so then we'll need to advance to the next directory along
+                    q = self.make_dbrow(x + (None,))  # passing None as the thumbnail because we don't need it
+                    # making it into a namedtuple/dbrow means we can now access attributes by column name
+                    fsize = q.filesize
+                    fullpath = q.fullpath
+                    trash_dest = os.path.join(self.trash_folder, q.directory)
+                    if not os.path.exists(trash_dest):
+                        os.makedirs(trash_dest)
+                    try:
+                        move(os.path.join(self.top_level, fullpath), trash_dest)  # stored relative to it
+                        moved.append(fullpath)  # may as well remove it as we know it's being "deleted"
+                        total += fsize
+                        print(f"Moving files... ({total} / {amount})", end="\r")  # carriage return overwrites the line
+                    except Error as e:  # "Error" comes from the shutil module
+                        print(e)  # e.g. might run into duplicate file names, just print the exception and do nothing
+            finally:
+                self.remove_videos(moved)
+                self.db.commit()
+            print(f"Done, moved {round(total/(1024**3), 2)} GB of data to the trash folder.")
 
     def broken_file(self, fullpath):
 
         """Move broken file at fullpath to the broken folder"""
 
-        try:
-            move(fullpath, BROKEN_FOLDER)
-            self.remove_video(fullpath)
-            print(f"{fullpath} was moved to the broken videos folder.")
-            self.db.commit()
-        except Error as e:
-            print(e)
+        with self.write_lock:
+            try:
+                move(fullpath, self.broken_folder)
+                self.remove_video(fullpath)
+                print(f"{fullpath} was moved to the broken videos folder.")
+                self.db.commit()
+            except Error as e:
+                print(e)
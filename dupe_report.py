@@ -0,0 +1,17 @@
+from dbman_v4 import DBManager
+from settings import SETTINGS
+from sys import argv
+
+"""Standalone script to be invoked from the command line, reports every set of exact duplicates in the library
+(same size and md5) and how much space they take up. With --move the extra copies are moved to the dupes folder.
+With --near it also reports pairs of videos that look the same but aren't identical files, e.g. re-encodes."""
+
+db_manager = DBManager(SETTINGS["SQLPATH"])
+clusters = db_manager.find_duplicates()
+db_manager.write_duplicate_report(clusters)
+if "--move" in argv[1:]:
+    db_manager.move_duplicates(clusters)
+if "--near" in argv[1:]:
+    pairs = db_manager.near_duplicates()
+    print(f"see {db_manager.write_near_duplicate_report(pairs)}")
+db_manager.commit_changes()
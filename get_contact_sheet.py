@@ -1,15 +1,135 @@
-from videoobject import VideoObject
-from sys import argv
+import argparse
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import settings
 
-"""Standalone script to be invoked from the command line, prints a contact sheet for a video using VideoObject."""
+"""Standalone script to be invoked from the command line, makes a contact sheet for every video in a directory
+using VideoObject, e.g.
+
+python get_contact_sheet.py D:\\videos 9
+python get_contact_sheet.py D:\\videos 16 --recursive --workers 8 --out D:\\sheets
+
+Videos are worked on by a pool of processes, one per core by default. A sheet that is newer than its video is
+left alone, so running it again only does the videos that are new or have changed. Sheets are written next to
+their videos unless --out is given, in which case the directory structure is copied there. At the end there is
+a summary of what was made, skipped and failed, and the slowest videos."""
+
+
+def sheet_path(video, directory, out):
+
+    """Where the sheet for video goes. VideoObject names it after the video with .jpg on the end"""
+
+    if out is None:
+        return os.path.dirname(video), video + ".jpg"
+    target = os.path.join(out, os.path.relpath(os.path.dirname(video), directory))
+    return target, os.path.join(target, os.path.basename(video) + ".jpg")
+
+
+def find_videos(directory, recursive, extensions):
+
+    """Every video under directory, in a stable order"""
+
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        found.extend(os.path.join(root, x) for x in sorted(files) if os.path.splitext(x)[1].lower() in extensions)
+        if not recursive:
+            break
+    return found
+
+
+def up_to_date(video, sheet):
 
-directory = argv[1]
-targets = os.listdir(directory)
-thumbs = int(argv[2])
-for x in targets:
     try:
-        vo = VideoObject(os.path.join(directory, x), thumbs)
-        vo.write_contact_sheet(argv[1])
-    except:
-        print(f"error for {x}")
+        return os.stat(sheet).st_mtime >= os.stat(video).st_mtime
+    except OSError:  # no sheet yet
+        return False
+
+
+def start_worker(settings_path, whitelist_path):
+
+    """Each worker process reads the same settings as the parent, also where processes are spawned not forked"""
+
+    settings.configure(settings_path, whitelist_path)
+
+
+def make_sheet(video, target, thumbnails, backend_name):
+
+    """Runs in a worker process. Returns (video, error message or None, seconds taken)"""
+
+    from videoobject import VideoObject  # imported by each worker, the parent process never needs PIL
+    from mediabackend import get_backend
+
+    start = time.perf_counter()
+    try:
+        os.makedirs(target, exist_ok=True)
+        VideoObject(video, thumbnails, get_backend(backend_name)).write_contact_sheet(target)
+    except Exception as e:  # reported in the summary, one bad video mustn't stop the batch
+        return video, f"{type(e).__name__}: {e}", time.perf_counter() - start
+    return video, None, time.perf_counter() - start
+
+
+def make_sheets(directory, thumbnails=9, backend_name=None, recursive=False, out=None, workers=None, force=False,
+                slowest=5):
+
+    """Makes the sheets that are missing or out of date and prints a summary. Returns {video: error} for the
+    videos that failed."""
+
+    start = time.perf_counter()
+    extensions = {x.lower() for x in settings.SETTINGS["EXTENSIONS"]}
+    videos = find_videos(directory, recursive, extensions)
+    todo = []
+    for video in videos:
+        target, sheet = sheet_path(video, directory, out)
+        if force or not up_to_date(video, sheet):
+            todo.append((video, target))
+    print(f"{len(videos)} videos, {len(videos) - len(todo)} sheets already up to date, making {len(todo)}")
+
+    failed = {}
+    timings = []
+    if todo:
+        with ProcessPoolExecutor(workers, initializer=start_worker,
+                                 initargs=(settings.SETTINGS.path, settings.WHITELIST_PATH)) as pool:
+            futures = [pool.submit(make_sheet, video, target, thumbnails, backend_name) for video, target in todo]
+            for done, future in enumerate(as_completed(futures), 1):
+                video, error, seconds = future.result()
+                timings.append((seconds, video))
+                if error:
+                    failed[video] = error
+                print(f"[{done}/{len(todo)}] {'failed' if error else 'made'} {video} in {seconds:.1f} s")
+
+    elapsed = time.perf_counter() - start
+    print(f"Made {len(todo) - len(failed)} sheets, skipped {len(videos) - len(todo)}, {len(failed)} failed, "
+          f"in {elapsed:.1f} s ({len(todo) / elapsed:.1f} videos/s)")
+    if timings:
+        print("Slowest:")
+        for seconds, video in sorted(timings, reverse=True)[:slowest]:
+            print(f"{seconds:>8.1f} s  {video}")
+    if failed:
+        print("Failed:")
+        for video, error in failed.items():
+            print(f"    {video}: {error}")
+
+    return failed
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Makes contact sheets for a folder of videos")
+    parser.add_argument("directory")
+    parser.add_argument("thumbnails", type=int, nargs="?", default=9, help="thumbnails per sheet")
+    parser.add_argument("backend", nargs="?", help="media backend, see mediabackend.py")
+    parser.add_argument("--recursive", "-r", action="store_true", help="include videos in subfolders")
+    parser.add_argument("--out", help="write the sheets here instead of next to the videos")
+    parser.add_argument("--workers", type=int, help="processes to use, one per core by default")
+    parser.add_argument("--force", action="store_true", help="remake sheets that are already up to date")
+    args = parser.parse_args(argv)
+
+    failed = make_sheets(args.directory, args.thumbnails, args.backend, args.recursive, args.out, args.workers,
+                         args.force)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":  # the guard is needed for the worker processes too, they import this module
+    exit(main())
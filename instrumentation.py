@@ -0,0 +1,313 @@
+import atexit
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from settings import SETTINGS
+
+"""Timing for every database query and media subprocess. Each operation is recorded under a name (the SQL with
+its literal numbers blanked out, or e.g. "ffmpeg frame") with how long it took, how many rows or bytes it
+returned and its exit status. The last STATS_WINDOW timings of each operation are kept for percentiles, and
+anything slower than SLOW_OP_MS is appended to the slow operation log as a line of JSON. The statistics can be
+dumped from the main window or at exit with STATS_AT_EXIT. Set INSTRUMENTATION to false in settings.json to
+turn it all off, the database connections are then plain sqlite3 ones.
+
+The settings are read by enabled() the first time something could be timed rather than on import, so importing
+the database module doesn't need a settings file and settings.configure() can still choose one."""
+
+ENABLED = None  # until enabled() has read the settings, the values below are the defaults
+SLOW_OP_MS = 250
+SLOW_OP_LOG = "slow_operations.log"
+STATS_WINDOW = 1000  # timings kept per operation for the percentiles
+settings_lock = threading.Lock()
+
+
+class Sample:
+
+    """One timed operation. Mutable because a query keeps adding time and rows as its results are fetched."""
+
+    __slots__ = ("seconds", "rows", "bytes", "status", "logged")
+
+    def __init__(self, seconds, rows=None, nbytes=None, status=None):
+
+        self.seconds = seconds
+        self.rows = rows
+        self.bytes = nbytes
+        self.status = status
+        self.logged = False
+
+
+class OperationStats:
+
+    """Totals for one named operation, plus its most recent samples for percentiles"""
+
+    def __init__(self, kind, name):
+
+        self.kind = kind
+        self.name = name
+        self.count = 0
+        self.failures = 0  # non-zero exit status or an exception
+        self.recent = deque(maxlen=STATS_WINDOW)
+
+    def summary(self):
+
+        times = sorted(x.seconds * 1000 for x in self.recent)
+
+        def pct(p):
+            return round(times[min(len(times) - 1, int(p / 100 * len(times)))], 3) if times else None
+
+        rows = [x.rows for x in self.recent if x.rows is not None]
+        nbytes = [x.bytes for x in self.recent if x.bytes is not None]
+        return {"kind": self.kind, "name": self.name, "count": self.count, "failures": self.failures,
+                "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99), "max_ms": pct(100),
+                "total_ms": round(sum(times), 3),
+                "mean_rows": round(sum(rows) / len(rows), 1) if rows else None,
+                "mean_bytes": round(sum(nbytes) / len(nbytes)) if nbytes else None}
+
+
+class Recorder:
+
+    """Collects the samples from every thread"""
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.operations = {}  # {(kind, name): OperationStats}
+        self.listeners = []  # called with (kind, name, seconds) for each operation or fetch, e.g. by tracing.py
+
+    def add(self, kind, name, seconds, rows=None, nbytes=None, status=None):
+
+        """Records an operation that has finished and returns its Sample"""
+
+        sample = Sample(seconds, rows, nbytes, status)
+        with self.lock:
+            stats = self.operations.get((kind, name))
+            if stats is None:
+                stats = self.operations[(kind, name)] = OperationStats(kind, name)
+            stats.count += 1
+            if status not in (None, 0):
+                stats.failures += 1
+            stats.recent.append(sample)
+        self.check_slow(kind, name, sample)
+        self.notify(kind, name, seconds)
+
+        return sample
+
+    def notify(self, kind, name, seconds):
+
+        for listener in self.listeners:
+            listener(kind, name, seconds)
+
+    def check_slow(self, kind, name, sample):
+
+        """Logs the sample the first time it goes over the threshold"""
+
+        if sample.logged or sample.seconds * 1000 < SLOW_OP_MS:
+            return
+        sample.logged = True
+        line = {"when": time.strftime("%Y-%m-%dT%H:%M:%S"), "thread": threading.current_thread().name,
+                "kind": kind, "name": name, "ms": round(sample.seconds * 1000, 3), "rows": sample.rows,
+                "bytes": sample.bytes, "status": sample.status}
+        try:
+            with self.lock, open(SLOW_OP_LOG, "a") as f:
+                f.write(json.dumps(line) + "\n")
+        except OSError as e:  # never let the log break the operation being logged
+            print(f"Couldn't write to the slow operation log: {e}")
+
+    def summaries(self):
+
+        with self.lock:
+            operations = list(self.operations.values())
+        return sorted((x.summary() for x in operations), key=lambda x: x["total_ms"], reverse=True)
+
+    def report(self, limit=25):
+
+        """The operations that took the most time in total, as a table"""
+
+        lines = [f"{'kind':<8}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+                 f"{'total ms':>12}  name"]
+        for x in self.summaries()[:limit]:
+            lines.append(f"{x['kind']:<8}{x['count']:>8}{x['p50_ms']:>10}{x['p95_ms']:>10}{x['p99_ms']:>10}"
+                         f"{x['max_ms']:>10}{x['total_ms']:>12}  {x['name'][:100]}")
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+
+        """Prints the report and writes every operation's statistics to path (STATS_FILE by default) as JSON"""
+
+        path = path or SETTINGS.get("STATS_FILE", "operation_stats.json")
+        print(self.report())
+        with open(path, "w") as f:
+            json.dump({"when": time.strftime("%Y-%m-%dT%H:%M:%S"), "slow_op_ms": SLOW_OP_MS,
+                       "operations": self.summaries()}, f, indent=2)
+        print(f"Operation statistics written to {path}")
+
+        return path
+
+
+RECORDER = Recorder()
+
+
+def enabled():
+
+    """Whether INSTRUMENTATION is on, reading the settings the first time it's asked. The statistics are only
+    dumped at exit if they are being collected."""
+
+    global ENABLED, SLOW_OP_MS, SLOW_OP_LOG, STATS_WINDOW
+    if ENABLED is None:
+        with settings_lock:
+            if ENABLED is None:
+                SLOW_OP_MS = SETTINGS.get("SLOW_OP_MS", SLOW_OP_MS)
+                SLOW_OP_LOG = SETTINGS.get("SLOW_OP_LOG", SLOW_OP_LOG)
+                STATS_WINDOW = SETTINGS.get("STATS_WINDOW", STATS_WINDOW)
+                on = SETTINGS.get("INSTRUMENTATION", True)
+                if on and SETTINGS.get("STATS_AT_EXIT", False):
+                    atexit.register(RECORDER.dump)
+                ENABLED = on  # last, so no other thread goes ahead before the rest is set
+
+    return ENABLED
+
+
+@contextmanager
+def timed(kind, name, start=None):
+
+    """Times the block as one operation, or from start (a time.perf_counter()) if given. The block can fill in
+    rows, bytes and status on the dict it's given."""
+
+    info = {"rows": None, "bytes": None, "status": None}
+    start = start or time.perf_counter()
+    try:
+        yield info
+    except Exception:
+        if info["status"] is None:
+            info["status"] = "error"
+        raise
+    finally:
+        if enabled():
+            RECORDER.add(kind, name, time.perf_counter() - start, info["rows"], info["bytes"], info["status"])
+
+
+class StartupTimer:
+
+    """Milestones from the program starting to its window being fully usable. The report is printed and appended
+    to the STARTUP_LOG file as a line of JSON, so startup times can be compared between versions and machines."""
+
+    def __init__(self, started=None):
+
+        self.started = started or time.perf_counter()
+        self.marks = {}  # {milestone: ms since started}, in the order they happened
+
+    def mark(self, name):
+
+        self.marks[name] = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def report(self):
+
+        previous = 0
+        lines = ["Startup times:"]
+        for name, ms in self.marks.items():
+            lines.append(f"{ms:>10.1f} ms  (+{ms - previous:.1f})  {name}")
+            previous = ms
+        print("\n".join(lines))
+        try:
+            with open(SETTINGS.get("STARTUP_LOG", "startup_times.log"), "a") as f:
+                f.write(json.dumps({"when": time.strftime("%Y-%m-%dT%H:%M:%S"), "ms": self.marks}) + "\n")
+        except OSError as e:
+            print(f"Couldn't write to the startup log: {e}")
+
+        return self.marks
+
+
+NUMBERS = re.compile(r"\b\d+(\.\d+)?\b")
+SPACES = re.compile(r"\s+")
+
+
+def query_name(sql):
+
+    """Groups queries that only differ in formatted-in numbers, e.g. LIMIT and OFFSET of each page"""
+
+    return NUMBERS.sub("?", SPACES.sub(" ", sql).strip())[:300]
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    """A cursor that records each statement it runs. Fetching the results counts towards the statement's time,
+    as that is where sqlite does most of the work of a select."""
+
+    sample = None
+    kind = "sql"
+    name = None
+
+    def run(self, method, sql, *args):
+
+        name = query_name(sql)
+        start = time.perf_counter()
+        try:
+            result = method(self, sql, *args)
+        except Exception:
+            RECORDER.add(self.kind, name, time.perf_counter() - start, status="error")
+            raise
+        self.name = name
+        # rows changed by an insert/update/delete, a select's rows are counted as they are fetched
+        self.sample = RECORDER.add(self.kind, name, time.perf_counter() - start, rows=max(self.rowcount, 0))
+        return result
+
+    def execute(self, sql, *args):
+
+        return self.run(sqlite3.Cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+
+        return self.run(sqlite3.Cursor.executemany, sql, *args)
+
+    def executescript(self, sql):
+
+        return self.run(sqlite3.Cursor.executescript, sql)
+
+    def fetched(self, start, rows):
+
+        if self.sample is not None:
+            seconds = time.perf_counter() - start
+            self.sample.seconds += seconds
+            self.sample.rows += rows
+            RECORDER.check_slow(self.kind, self.name, self.sample)
+            RECORDER.notify("fetch", self.name, seconds)
+
+    def fetchone(self):
+
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, row is not None)
+        return row
+
+    def fetchmany(self, *args):
+
+        start = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self.fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows))
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+
+    """Pass as factory to sqlite3.connect. Connection.execute and friends go through cursor(), so they are
+    timed too."""
+
+    def cursor(self, factory=TimedCursor):
+
+        return super().cursor(factory)
+
+
+def connection_factory():
+
+    return TimedConnection if enabled() else sqlite3.Connection
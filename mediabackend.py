@@ -0,0 +1,258 @@
+from io import BytesIO
+from collections import namedtuple
+from hashlib import md5
+import json
+import os
+import subprocess as sp
+import time
+from settings import SETTINGS
+from instrumentation import timed
+
+try:
+    import av  # PyAV, optional, decodes in-process instead of starting ffmpeg for every frame
+except ImportError:
+    av = None
+
+"""Everything that reads video files goes through a media backend: probing for duration and resolution, grabbing
+frames at given times and listing keyframes. The backend used is chosen with MEDIA_BACKEND in settings.json:
+
+subprocess  runs the ffmpeg and ffprobe executables from settings.json, the default
+pyav        decodes in the same process with PyAV, needs "pip install av"
+synthetic   makes up videos and draws their frames with Pillow, for testing and benchmarks without real media
+auto        pyav if it is installed, otherwise subprocess"""
+
+FRAME_SIZE = (320, 240)  # thumbnails are always this size
+TIMEOUT = 15  # seconds to wait for an external ffmpeg or ffprobe
+
+MediaInfo = namedtuple("MediaInfo", ["duration", "width", "height"])
+
+
+class BadVideoException(Exception):
+
+    pass
+
+
+class SubprocessBackend:
+
+    """Runs the ffmpeg/ffprobe executables. One ffprobe per probe, and one ffmpeg per frame, all the frames of
+    a video are extracted at once by parallel processes that each seek straight to their time point."""
+
+    name = "subprocess"
+
+    def __init__(self, ffmpeg=None, ffprobe=None):
+
+        self.ffmpeg = ffmpeg or SETTINGS["FFMPEG_PATH"]
+        self.ffprobe = ffprobe or SETTINGS["FFPROBE_PATH"]
+
+    def run(self, cmd, path, operation):
+
+        """stdout of cmd, or BadVideoException if it times out"""
+
+        with timed("process", f"ffprobe {operation}") as info:
+            pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=10 ** 8)
+            try:
+                out, error = pipe.communicate(timeout=TIMEOUT)
+            except sp.TimeoutExpired:
+                print("ffmpeg timed out getting info")
+                pipe.kill()
+                info["status"] = "timeout"
+                raise BadVideoException(f"ffmpeg could not read the file at {path}")
+            info["bytes"] = len(out)
+            info["status"] = pipe.returncode
+        return out
+
+    def probe(self, path):
+
+        """Duration and resolution from a single ffprobe run"""
+
+        # an argument list rather than a command line, so paths need no quoting and it works on any OS
+        cmd = [self.ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries",
+               "format=duration:stream=width,height", "-of", "json", path]
+        try:
+            info = json.loads(self.run(cmd, path, "probe") or b"{}")
+            duration = float(info["format"]["duration"])
+        except (ValueError, KeyError):
+            print("error getting video info")
+            raise BadVideoException(f"ffmpeg could not read the file at {path}")
+        streams = info.get("streams") or [{}]
+        return MediaInfo(duration, streams[0].get("width", 0), streams[0].get("height", 0))
+
+    def frames(self, path, times):
+
+        """PIL images at each of times, in seconds"""
+
+        from PIL import Image  # imported when first needed, scans and the command line only probe
+
+        pipes = []
+        started = time.perf_counter()
+        for t in times:
+            # it seems inefficient to load up ffmpeg multiple times but this allows direct seeking
+            # to the desired time point. By using the fps filter with a fractional number, the
+            # images can be got with one call to ffmpeg but it's much slower and CPU intensive
+            # as the entire video must be decoded rather than seeking by keyframe.
+            cmd = [self.ffmpeg, "-ss", str(t), "-i", path, "-f", "image2pipe", "-vframes", "1", "-s",
+                   "{}x{}".format(*FRAME_SIZE), "-"]
+            pipes.append(sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=10 ** 8))
+
+        images = []
+        for p in pipes:
+            # the processes run side by side, so each one is timed from when they were all started
+            with timed("process", "ffmpeg frame", started) as info:
+                try:
+                    imagedata, error = p.communicate(timeout=TIMEOUT)
+                except sp.TimeoutExpired:
+                    print("ffmpeg timed out getting thumbnails")
+                    p.kill()
+                    info["status"] = "timeout"
+                    return []
+                info["bytes"] = len(imagedata)
+                info["status"] = p.returncode
+            try:
+                images.append(Image.open(BytesIO(imagedata)))
+            except Exception:  # PIL raises all sorts for empty or truncated output
+                raise BadVideoException(f"ffmpeg could not read the file at {path}")
+
+        return images
+
+    def keyframes(self, path):
+
+        """Times of the keyframes of the video stream, read from the packet flags so nothing is decoded"""
+
+        cmd = [self.ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+               "-of", "csv=p=0", path]
+        times = []
+        for line in self.run(cmd, path, "keyframes").decode("utf-8").splitlines():
+            pts, unused, flags = line.partition(",")
+            if "K" in flags and pts not in ("", "N/A"):
+                times.append(float(pts))
+
+        return sorted(times)
+
+
+class PyAVBackend:
+
+    """Decodes with PyAV in this process, so there is no process start-up per frame and the file is only opened
+    once for all of a video's frames"""
+
+    name = "pyav"
+
+    def __init__(self):
+
+        if av is None:
+            raise ImportError("the pyav media backend needs PyAV, install it with pip install av")
+
+    @staticmethod
+    def open(path):
+
+        try:
+            container = av.open(path)
+            return container, container.streams.video[0]
+        except (av.error.FFmpegError, OSError, IndexError) as e:  # IndexError: no video stream
+            raise BadVideoException(f"PyAV could not read the file at {path}: {e}")
+
+    def probe(self, path):
+
+        container, stream = self.open(path)
+        with container:
+            if container.duration is not None:
+                duration = container.duration / av.time_base
+            elif stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                raise BadVideoException(f"PyAV could not find the duration of {path}")
+            return MediaInfo(duration, stream.codec_context.width, stream.codec_context.height)
+
+    def frames(self, path, times):
+
+        container, stream = self.open(path)
+        images = []
+        with container:
+            try:
+                for t in times:
+                    # seeking lands on the keyframe before t, then decode forward to the first frame at or after t
+                    container.seek(int(t / stream.time_base), stream=stream)
+                    frame = None
+                    for frame in container.decode(stream):
+                        if frame.time is None or frame.time >= t:
+                            break
+                    if frame is None:
+                        raise BadVideoException(f"PyAV found no frame at {t} s in {path}")
+                    images.append(frame.to_image().resize(FRAME_SIZE))
+            except av.error.FFmpegError as e:
+                raise BadVideoException(f"PyAV could not read the file at {path}: {e}")
+
+        return images
+
+    def keyframes(self, path):
+
+        container, stream = self.open(path)
+        with container:
+            return sorted(float(packet.pts * stream.time_base) for packet in container.demux(stream)
+                          if packet.is_keyframe and packet.pts is not None)
+
+
+class SyntheticBackend:
+
+    """Pretends every readable file is a video, with a duration and resolution worked out from its name and size
+    and a frame drawn for any time asked for. The same file always gives the same results. Files that can't be
+    opened or are empty are treated as broken videos."""
+
+    name = "synthetic"
+    keyframe_interval = 2.0  # seconds
+
+    @staticmethod
+    def seed(path):
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise BadVideoException(f"could not read the file at {path}")
+        if size == 0:
+            raise BadVideoException(f"the file at {path} is empty")
+        return int(md5(f"{os.path.basename(path)}:{size}".encode("utf-8")).hexdigest(), 16)
+
+    def probe(self, path):
+
+        seed = self.seed(path)
+        width, height = ((640, 480), (1280, 720), (1920, 1080), (3840, 2160))[seed % 4]
+        return MediaInfo(60.0 + seed % 3540, width, height)  # between one minute and an hour
+
+    def frames(self, path, times):
+
+        from PIL import Image, ImageDraw
+
+        seed = self.seed(path)
+        images = []
+        for t in times:
+            shade = (seed + int(t * 10)) % 200  # changes over the video so each frame looks different
+            image = Image.new("RGB", FRAME_SIZE, ((seed >> 8) % 200, shade, 255 - shade))
+            ctx = ImageDraw.Draw(image)
+            ctx.rectangle((0, 0, FRAME_SIZE[0] * min(t / 3600, 1), 10), fill=(255, 255, 255))  # a progress bar
+            ctx.text((10, 20), f"{os.path.basename(path)}\n{t:.1f} s", fill=(255, 255, 255))
+            images.append(image)
+
+        return images
+
+    def keyframes(self, path):
+
+        duration = self.probe(path).duration
+        return [i * self.keyframe_interval for i in range(int(duration / self.keyframe_interval) + 1)]
+
+
+BACKENDS = {"subprocess": SubprocessBackend, "pyav": PyAVBackend, "synthetic": SyntheticBackend}
+shared = {}  # {name: backend instance}, the backends keep no per-video state so one of each is enough
+
+
+def get_backend(name=None):
+
+    """The backend called name, by default the one chosen in settings.json"""
+
+    name = name or SETTINGS.get("MEDIA_BACKEND", "subprocess")
+    if name == "auto":
+        name = "pyav" if av is not None else "subprocess"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown media backend {name}, choose from {', '.join(BACKENDS)} or auto")
+    if name not in shared:
+        shared[name] = BACKENDS[name]()
+
+    return shared[name]
@@ -0,0 +1,135 @@
+from io import BytesIO
+
+"""Perceptual signatures for spotting near-duplicate videos, i.e. re-encodes and rescaled copies that have a
+different md5 but look the same. Each video gets a 64 bit difference hash of its thumbnail and a BK-tree finds
+every pair of hashes within a small Hamming distance without comparing each video to every other one."""
+
+HASH_SIZE = 8  # 8 x 8 comparisons = 64 bit hash
+np = None  # numpy, optional. Imported by the first dhash as it's slow to import, False if it isn't installed
+
+
+def dhash(image):
+
+    """Difference hash of a PIL image: shrink to 9x8 greyscale and set a bit wherever a pixel is brighter than its
+    right-hand neighbour. Survives rescaling, recompression and small colour shifts."""
+
+    from PIL import Image  # slow to import, and only needed once signatures are being made
+    global np
+    if np is None:
+        try:
+            import numpy as np  # hashes each image with a few array operations instead of a loop per pixel
+        except ImportError:
+            np = False
+
+    width = HASH_SIZE + 1
+    small = image.convert("L").resize((width, HASH_SIZE), Image.LANCZOS)
+    if np:
+        pixels = np.asarray(small)  # HASH_SIZE rows of width pixels
+        bits = pixels[:, :-1] > pixels[:, 1:]  # brighter than the right-hand neighbour
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")  # row by row, first pixel in the top bit
+
+    pixels = small.tobytes()  # one byte per pixel, row by row
+    value = 0
+    for row in range(HASH_SIZE):
+        line = pixels[row * width:(row + 1) * width]
+        for left, right in zip(line, line[1:]):
+            value = (value << 1) | (left > right)
+
+    return value
+
+
+def dhash_blob(blob):
+
+    """dhash of an image stored in the database, None if the blob isn't a readable image"""
+
+    from PIL import Image
+
+    try:
+        return dhash(Image.open(BytesIO(blob)))
+    except Exception:  # PIL raises all sorts for truncated/corrupt data
+        return None
+
+
+def to_signed(value):
+
+    """sqlite integers are signed 64 bit so hashes with the top bit set have to be stored as negative numbers"""
+
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a, b):
+
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+
+    """Burkhard-Keller tree over hashes with Hamming distance. Each child edge is labelled with its distance to
+    the parent, so a search within radius r only has to follow edges labelled d-r to d+r, which prunes most of
+    the tree for small radii."""
+
+    def __init__(self):
+
+        self.root = None  # [hash, [items with this exact hash], {distance: child node}]
+        self.size = 0
+
+    def add(self, value, item):
+
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)  # identical hashes share a node
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+
+        """All (distance, item) within radius of value"""
+
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                found.extend((d, item) for item in node[1])
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+
+        return found
+
+
+def near_pairs(signatures, radius):
+
+    """signatures is a list of (key, hash). Returns (key_a, key_b, distance) for every pair of keys whose hashes
+    are within radius of each other, each pair once."""
+
+    tree = BKTree()
+    for index, (key, value) in enumerate(signatures):
+        tree.add(value, index)
+
+    pairs = []
+    for index, (key, value) in enumerate(signatures):
+        for d, other in tree.search(value, radius):
+            if other > index:  # only report a pair from its first member, and never a video against itself
+                pairs.append((key, signatures[other][0], d))
+
+    pairs.sort(key=lambda p: p[2])
+    return pairs
@@ -0,0 +1,18 @@
+from dbman_v4 import DBManager
+from settings import SETTINGS
+
+"""Standalone script to be invoked from the command line, prints how sqlite plans each of the queries that the
+user waits on and exits with status 1 if any of them has to read a whole table."""
+
+db_manager = DBManager(SETTINGS["SQLPATH"])
+report = db_manager.query_plan_report()
+for name, steps, table_scan in report:
+    print(f"{'TABLE SCAN' if table_scan else 'ok':<12}{name}")
+    for step in steps:
+        print(f"{'':<16}{step}")
+db_manager.commit_changes()
+scans = [name for name, steps, table_scan in report if table_scan]
+if scans:
+    print(f"{len(scans)} queries scan a whole table: {', '.join(scans)}")
+    exit(1)
+print(f"All {len(report)} queries use an index")
@@ -2,7 +2,7 @@ CREATE TABLE "videos" ( "fullpath" text, "filename" text, "filesize" integer, "d
 "created" real, "skipped" integer, "width" integer, "height" integer,
 "score_1" integer, "score_2" integer,
 "md5" text, "duration" REAL, "times_viewed" integer,
-"tagged_when" integer,
+"tagged_when" integer, "inode" integer,
 PRIMARY KEY("fullpath") );
 
 CREATE TABLE "tag_group_1" ( "tag" TEXT, "value" integer );
@@ -13,6 +13,13 @@ CREATE TABLE "thumbnails" ( "fullpath" text, "thumbnail" blob, PRIMARY KEY("full
 
 CREATE TABLE "removed" (fullpath text, filename text, filesize integer, deletion_date real);
 
+CREATE TABLE "scan_journal" ( "fullpath" text, "filesize" integer, "mtime" real,
+"md5" text, "duration" real, "width" integer, "height" integer, PRIMARY KEY("fullpath") );
+
+CREATE TABLE "signatures" ( "fullpath" text, "dhash" integer, PRIMARY KEY("fullpath") );
+
+-- indexes and any later changes are applied by the MIGRATIONS in dbman_v4.py
+
 -- CREATE TABLE "icons" ( "name" TEXT, "image" BLOB );  -- seperate files
 
 -- CREATE TABLE "extensions" (extension string); -- this is now in settings.json
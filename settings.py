@@ -1,17 +1,70 @@
 import json
+import os
+from collections import UserDict
 
-# always load settings at import so they are available to other parts of the program
-with open("settings.json", "r") as f:
-    SETTINGS = json.load(f)
+"""The program's settings, from settings.json, and the deletion whitelist. Neither file is read until something
+is first looked up, so a script can point to other files with configure() before it imports the rest of the
+program. The files are found in the current directory unless VIDEO_TAGGER_SETTINGS and VIDEO_TAGGER_WHITELIST
+say otherwise."""
+
+
+class Settings(UserDict):
+
+    """A dict of the settings that loads itself from the settings file on first use"""
+
+    def __init__(self, path):
+
+        self.path = path
+        self.loaded = None  # UserDict keeps everything in self.data, which is the property below
+
+    @property
+    def data(self):
+
+        if self.loaded is None:
+            with open(self.path, "r") as f:
+                self.loaded = json.load(f)
+        return self.loaded
+
+    def reload(self, path=None):
+
+        """Read from path (or the same file again) next time a setting is looked up"""
+
+        self.path = path or self.path
+        self.loaded = None
+
+
+SETTINGS = Settings(os.environ.get("VIDEO_TAGGER_SETTINGS", "settings.json"))
+WHITELIST_PATH = os.environ.get("VIDEO_TAGGER_WHITELIST", "deletion_whitelist.txt")
+whitelist = None
+
+
+def configure(settings_path=None, whitelist_path=None):
+
+    """Use other settings and whitelist files. The GUI copies some settings into constants when it is imported,
+    so call this before importing it, or before anything opens the database."""
+
+    global WHITELIST_PATH, whitelist
+    if settings_path:
+        SETTINGS.reload(settings_path)
+    if whitelist_path:
+        WHITELIST_PATH = whitelist_path
+        whitelist = None
+
+
+def deletion_whitelist():
+
+    """When running the "free space" command, can only look in these directories for videos to delete"""
+
+    global whitelist
+    if whitelist is None:
+        with open(WHITELIST_PATH, "r") as f:
+            whitelist = [line.rstrip("\r\n") for line in f.readlines()]
+    return whitelist
 
-DELETION_WHITELIST = []  # when running the "free space" command, can only look in here for videos to delete
-with open("deletion_whitelist.txt", "r") as f:
-    for line in f.readlines():
-        DELETION_WHITELIST.append(line.rstrip("\r\n"))
 
 def save_settings():
 
     """The SETTINGS dict may have been changed by other parts of the program"""
 
-    with open("settings.json", "w") as f:
-        json.dump(SETTINGS, f)
+    with open(SETTINGS.path, "w") as f:
+        json.dump(SETTINGS.data, f)
@@ -0,0 +1,303 @@
+import threading
+
+"""An in-memory copy of the columns the main window searches on, one numpy array per column, so that a search is
+a few vectorised operations over every video instead of a query that reads the whole videos table. Turned on
+with "TAG_INDEX": true in settings.json. SQLite is still the only place anything is stored: the index is loaded
+from it the first time a search is made and DBManager refreshes the rows it changes, so the index only decides
+which videos are on each page and their thumbnails are still read from the database a page at a time.
+
+Costs about 90 bytes per video, i.e. 90 MB for a million videos, plus the paths themselves."""
+
+CHUNK_PAGES = 20  # ordered searches sort this many pages at a time, most searches never get past the first
+np = None  # numpy, imported by make_index as it's slow to import and only needed when the index is turned on
+
+
+def make_index(score_columns):
+
+    """A TagIndex, or None if numpy is not installed"""
+
+    global np
+    try:
+        import numpy as np  # optional, without it every search goes to SQLite
+    except ImportError:
+        print("TAG_INDEX is set but numpy is not installed, searching in SQLite instead")
+        return None
+    return TagIndex(score_columns)
+
+
+def in_order(positions, key, chunk):
+
+    """Yields positions in order of key a chunk at a time. Each chunk is picked out with a partial sort of what
+    is left, so the first page of a huge result costs about one pass rather than a full sort."""
+
+    while len(positions) > chunk:
+        part = np.argpartition(key, chunk - 1)
+        first = part[:chunk]
+        yield positions[first[np.argsort(key[first], kind="stable")]]
+        rest = part[chunk:]
+        positions, key = positions[rest], key[rest]
+    yield positions[np.argsort(key, kind="stable")]
+
+
+def pages_of(chunks, page_size):
+
+    """Splits arrays of positions into pages of page_size, carrying what's left over into the next chunk"""
+
+    left = np.empty(0, dtype=np.int64)
+    for chunk in chunks:
+        chunk = np.concatenate((left, chunk))
+        full = len(chunk) - len(chunk) % page_size
+        for start in range(0, full, page_size):
+            yield chunk[start:start + page_size]
+        left = chunk[full:]
+    if len(left):
+        yield left
+
+
+def weighted_bits(words, weights):
+
+    """weighted_bits() from dbman_v4 for an array of one word of the scores, weights is {bit in the word: weight}.
+    Looks up each byte of the words in a table of the total weight of every possible byte, so it is eight lookups
+    at most however many tags there are."""
+
+    total = np.zeros(len(words))
+    unsigned = words.view(np.uint64)
+    by_byte = {}
+    for bit, weight in weights.items():
+        by_byte.setdefault(bit // 8, np.zeros(8))[bit % 8] += weight
+    for byte, bit_weights in by_byte.items():
+        table = ((np.arange(256)[:, None] >> np.arange(8)) & 1) @ bit_weights
+        total += table[(unsigned >> np.uint64(8 * byte)) & np.uint64(255)]
+    return total
+
+
+class Shuffled:
+
+    """Rows handed out in a random order a few at a time. Only chunk rows at a time are drawn at random from those
+    left, so the first page doesn't wait for the whole result to be shuffled."""
+
+    def __init__(self, rows, rng, chunk):
+
+        self.rows = rows
+        self.rng = rng
+        self.chunk = chunk
+        self.drawn = rows[:0]
+
+    def __len__(self):
+
+        return len(self.rows) + len(self.drawn)
+
+    def take(self, n):
+
+        while len(self.drawn) < n and len(self.rows):
+            if len(self.rows) <= self.chunk:
+                picked, self.rows = self.rng.permutation(self.rows), self.rows[:0]
+            else:
+                at = self.rng.choice(len(self.rows), self.chunk, replace=False)
+                picked, self.rows = self.rows[at], np.delete(self.rows, at)
+            self.drawn = np.concatenate((self.drawn, picked))
+        taken, self.drawn = self.drawn[:n], self.drawn[n:]
+        return taken
+
+
+class TagIndex:
+
+    """Row i of every array is the video self.paths[i]. Videos that have been removed are marked dead rather
+    than taken out, so positions never change while a search is paging through them. Arrays grow by doubling.
+    All methods are safe from any thread."""
+
+    def __init__(self, score_columns):
+
+        """score_columns is the columns each tag group is stored in, dbman_v4.SCORE_COLUMNS"""
+
+        self.score_columns = score_columns
+        self.word_columns = score_columns[0] + score_columns[1]
+        # a video counts as tagged if the first word of both groups isn't NULL, as in the queries
+        self.query = f'''select fullpath, {", ".join(f"ifnull({x}, 0)" for x in self.word_columns)},
+                        {score_columns[0][0]} is not null and {score_columns[1][0]} is not null,
+                        tagged_when, ifnull(times_viewed, 0), directory, ifnull(skipped, -1) from videos'''
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.paths = []
+        self.positions = {}  # {fullpath: row}
+        self.directory_ids = {}  # {directory: number stored in the directory column}
+        self.size = 0
+        self.columns = {}
+
+    def load(self, conn):
+
+        """Reads every video. conn should be the writer connection, called while holding the write lock, so that
+        nothing written before the load is missed and everything written after it is refreshed"""
+
+        rows = conn.execute(self.query).fetchall()
+        with self.lock:
+            self.paths = []
+            self.positions = {}
+            self.size = 0
+            self.allocate(max(len(rows), 1024))
+            self.store(rows)
+            self.loaded = True
+        print(f"Tag index loaded {len(rows)} videos")
+
+    def refresh(self, conn, paths):
+
+        """Re-reads these videos after they have been changed, added or removed. Call while holding the write
+        lock, before committing, so that a search never sees the database and the index disagree for long."""
+
+        if not self.loaded:  # nothing to keep up to date, load() will see the change
+            return
+        paths = list(set(paths))
+        rows = []
+        for start in range(0, len(paths), 500):  # stay under sqlite's limit on parameters
+            batch = paths[start:start + 500]
+            rows.extend(conn.execute(f'''{self.query} where fullpath in ({", ".join("?" * len(batch))})''',
+                                     batch))
+        found = {x[0] for x in rows}
+        with self.lock:
+            for path in paths:
+                if path not in found and path in self.positions:
+                    self.columns["alive"][self.positions.pop(path)] = False
+            self.store(rows)
+
+    def allocate(self, capacity):
+
+        old = self.columns
+        self.columns = {x: np.zeros(capacity, np.int64) for x in self.word_columns}
+        self.columns.update({"scored": np.zeros(capacity, bool),  # False where either score is NULL
+                             "tagged_when": np.full(capacity, np.nan),  # NaN where NULL
+                             "times_viewed": np.zeros(capacity, np.int64),
+                             "directory": np.full(capacity, -1, np.int32),  # -1 where NULL
+                             "skipped": np.full(capacity, -1, np.int8),  # -1 where NULL
+                             "alive": np.zeros(capacity, bool)})
+        for name, column in old.items():
+            self.columns[name][:self.size] = column[:self.size]
+
+    def store(self, rows):
+
+        """Writes rows from self.query over the rows for those paths, appending any new paths"""
+
+        if not rows:
+            return
+        rows = sorted(rows, key=lambda x: x[0] in self.positions)  # new paths first, so they are contiguous
+        new = sum(1 for x in rows if x[0] not in self.positions)
+        if self.size + new > len(self.columns["alive"]):
+            self.allocate(max(2 * len(self.columns["alive"]), self.size + new))
+        for path in (x[0] for x in rows[:new]):
+            self.positions[path] = len(self.paths)
+            self.paths.append(path)
+        self.size += new
+
+        at = np.fromiter((self.positions[x[0]] for x in rows), np.int64, len(rows))
+        fields = list(zip(*rows))
+        for name, words in zip(self.word_columns, fields[1:]):
+            self.columns[name][at] = words
+        scored, tagged_when, times_viewed, directory, skipped = fields[1 + len(self.word_columns):]
+        self.columns["scored"][at] = scored
+        self.columns["tagged_when"][at] = np.array(tagged_when, np.float64)  # None becomes NaN
+        self.columns["times_viewed"][at] = times_viewed
+        ids = self.directory_ids
+        self.columns["directory"][at] = [-1 if x is None else ids.setdefault(x, len(ids)) for x in directory]
+        self.columns["skipped"][at] = skipped
+        self.columns["alive"][at] = True
+
+    def matches(self, query, directory=None):
+
+        """Rows that match query, a dbman_v4.TagQuery split into words by query_words, as dbman_v4.tag_filter
+        would select them, in the directory if one is given. Returns the rows and {column: its values for those
+        rows}, copies so that a refresh doesn't change the order of a search while it is paging through them."""
+
+        every, none, any_of = query
+        with self.lock:
+            n = self.size
+            c = {name: column[:n] for name, column in self.columns.items()}
+            mask = c["alive"] & c["scored"]
+            for columns, values in zip(self.score_columns, every):
+                for column, value in zip(columns, values):
+                    if value:
+                        mask &= (c[column] & value) == value
+            for columns, values in zip(self.score_columns, none):
+                for column, value in zip(columns, values):
+                    if value:
+                        mask &= (c[column] & value) == 0
+            for clause in any_of:
+                found = np.zeros(n, bool)
+                for columns, values in zip(self.score_columns, clause):
+                    for column, value in zip(columns, values):
+                        if value:
+                            found |= (c[column] & value) != 0
+                mask &= found
+            if directory is not None:
+                mask &= c["directory"] == self.directory_ids.get(directory, -2)  # -2 matches nothing
+            rows = np.flatnonzero(mask)
+            return rows, {name: c[name][rows] for name in ("tagged_when", "times_viewed", "skipped")}
+
+    def path_pages(self, pages):
+
+        for page in pages:
+            with self.lock:
+                yield [self.paths[x] for x in page.tolist()]
+
+    def random_pages(self, query, directory, batch_size, recent, new_qty=4):
+
+        """The get_matches order: shuffled, with up to new_qty videos tagged after recent on each page"""
+
+        rows, c = self.matches(query, directory)
+        rng = np.random.default_rng()
+        is_new = c["tagged_when"] > recent  # False for NaN, i.e. never tagged
+        new = Shuffled(rows[is_new], rng, batch_size * CHUNK_PAGES)
+        old = Shuffled(rows[~is_new], rng, batch_size * CHUNK_PAGES)
+        while len(new) or len(old):
+            old_qty = min(batch_size - min(new_qty, len(new)), len(old))
+            page = np.concatenate((new.take(batch_size - old_qty), old.take(old_qty)))  # more new once old run out
+            yield from self.path_pages([page])
+
+    def newest_pages(self, query, directory, page_size):
+
+        """The newest_matches order: most recently tagged first, videos never tagged are left out"""
+
+        rows, c = self.matches(query, directory)
+        tagged = ~np.isnan(c["tagged_when"])
+        chunks = in_order(rows[tagged], -c["tagged_when"][tagged], page_size * CHUNK_PAGES)
+        yield from self.path_pages(pages_of(chunks, page_size))
+
+    def popular_pages(self, query, batch_size, most_popular=True):
+
+        """The popular_search order: by times viewed then at random, skipped videos are left out. Like the query
+        this ignores the filter directory."""
+
+        rows, c = self.matches(query)
+        shown = (c["skipped"] != 1) & (c["skipped"] != -1)  # skipped != 1 is not true for NULL
+        rows, views = rows[shown], c["times_viewed"][shown].astype(np.float64)
+        # a random fraction breaks ties without changing the order of different view counts
+        key = (-views if most_popular else views) + np.random.default_rng().random(len(rows))
+        chunks = in_order(rows, key, batch_size * CHUNK_PAGES)
+        yield from self.path_pages(pages_of(chunks, batch_size))
+
+    def similar_pages(self, fullpath, words, weights, batch_size):
+
+        """The similar_videos order: most similar first by weighted Jaccard similarity, see dbman_v4.similarity.
+        words is the video's words for each group and weights {bit: weight} for each group."""
+
+        query = [(column, value, {bit % 64: weight for bit, weight in group_weights.items() if bit // 64 == word})
+                 for columns, values, group_weights in zip(self.score_columns, words, weights)
+                 for word, (column, value) in enumerate(zip(columns, values))]
+        with self.lock:
+            c = {name: column[:self.size] for name, column in self.columns.items()}
+            shared = np.zeros(self.size, bool)
+            for column, value, word_weights in query:
+                if value:
+                    shared |= (c[column] & value) != 0
+            mask = c["alive"] & c["scored"] & (c["skipped"] != 1) & shared
+            if fullpath in self.positions:
+                mask[self.positions[fullpath]] = False
+            rows = np.flatnonzero(mask)
+            found = {column: c[column][rows] for column, value, word_weights in query if word_weights}
+        common = np.zeros(len(rows))
+        either = np.zeros(len(rows))
+        for column, value, word_weights in query:
+            if word_weights:
+                common += weighted_bits(found[column] & value, word_weights)
+                either += weighted_bits(found[column] | value, word_weights)
+        similar = np.divide(common, either, out=np.zeros(len(rows)), where=either > 0)
+        chunks = in_order(rows, -similar, batch_size * CHUNK_PAGES)
+        yield from self.path_pages(pages_of(chunks, batch_size))
@@ -0,0 +1,123 @@
+import threading
+import queue
+import traceback
+import tracing
+
+"""Runs blocking work (database queries, ffmpeg calls, file moves) on a background thread so that the Tk
+event loop never freezes. Tk widgets can only be touched from the main thread, so finished tasks are put on a
+completion queue which the main loop polls with after() and the callbacks are run from there."""
+
+
+class Task:
+
+    """Handle for a piece of submitted work, can be cancelled before or while it runs. A cancelled task that
+    was already running finishes, but its result is thrown away and its callback is never called."""
+
+    def __init__(self, func, args, kwargs, callback, errback, key):
+
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.errback = errback
+        self.key = key
+        self.cancelled = False
+        self.finished = False
+        self.flow = tracing.flow_start()  # links the event that submitted the task to its callback in UI traces
+
+    def cancel(self):
+
+        self.cancelled = True
+
+
+class TaskRunner:
+
+    """A single worker thread fed by a queue. Tasks on the same runner run one at a time in the order they were
+    submitted, so e.g. a tag write always lands before the query that follows it. Use separate runners for work
+    that shouldn't wait behind each other (queries vs. ffmpeg vs. long library jobs)."""
+
+    def __init__(self, tk_root, name="tasks", poll_ms=30):
+
+        self.root = tk_root
+        self.name = name
+        self.poll_ms = poll_ms
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()  # (task, result, exception) waiting to be delivered on the main thread
+        self.latest = {}  # {key: the most recent task submitted with that key}
+        self.worker = threading.Thread(target=self.work, name=name, daemon=True)
+        self.worker.start()
+        self.root.after(self.poll_ms, self.poll)
+
+    def submit(self, func, *args, callback=None, errback=None, key=None, **kwargs):
+
+        """Queue func(*args, **kwargs) to run on the worker thread. callback(result) or errback(exception) are
+        later called on the Tk thread. Submitting with a key cancels the previous task with the same key, so a
+        newer query supersedes a stale one."""
+
+        task = Task(func, args, kwargs, callback, errback, key)
+        if key is not None:
+            old = self.latest.get(key)
+            if old is not None:
+                old.cancel()
+            self.latest[key] = task
+        self.jobs.put(task)
+        return task
+
+    def busy(self, key):
+
+        """True if the latest task with this key hasn't been delivered yet"""
+
+        task = self.latest.get(key)
+        return task is not None and not task.finished and not task.cancelled
+
+    def work(self):
+
+        while True:
+            task = self.jobs.get()
+            if task is None:
+                return  # stop() was called
+            if task.cancelled:
+                continue  # superseded before it even started
+            try:
+                with tracing.span(task.func.__name__, "task"):
+                    tracing.flow_step(task.flow)
+                    result = task.func(*task.args, **task.kwargs)
+                self.done.put((task, result, None))
+            except Exception as e:
+                self.done.put((task, None, e))
+
+    def poll(self):
+
+        """Deliver finished tasks on the Tk thread, then reschedule"""
+
+        while True:
+            try:
+                task, result, error = self.done.get_nowait()
+            except queue.Empty:
+                break
+            task.finished = True
+            if task.key is not None and self.latest.get(task.key) is task:
+                del self.latest[task.key]
+            if task.cancelled:
+                continue
+            with tracing.event(f"{task.func.__name__} result"):
+                tracing.flow_end(task.flow)
+                if error is not None:
+                    if task.errback:
+                        task.errback(error)
+                    else:
+                        print(f"Background task {task.func.__name__} on {self.name} failed:")
+                        traceback.print_exception(type(error), error, error.__traceback__)
+                elif task.callback:
+                    task.callback(result)
+
+        self.root.after(self.poll_ms, self.poll)
+
+    def stop(self, wait=True):
+
+        """Lets every task already submitted run, then ends the worker thread. Waits for that unless wait is
+        False. Callbacks of tasks that finish after this aren't delivered if the Tk loop has stopped."""
+
+        self.jobs.put(None)
+        if wait:
+            self.worker.join()
@@ -1,21 +1,27 @@
+import time
+STARTED = time.perf_counter()  # for the startup report, before the slower imports
 from tkinter import *
 from tkinter import ttk  # for combobox??
 from PIL import Image, ImageTk, UnidentifiedImageError
 from io import BytesIO
 import threading
 import os
-import time
+import sys
 from collections import deque
-from tkinter import simpledialog, font, filedialog
-from dbman_v4 import DBManager
+from tkinter import simpledialog, font, filedialog, messagebox
+from dbman_v4 import DBManager, ScanProgress
 from videoobject import VideoObject, BadVideoException
+from mediabackend import get_backend
 from settings import SETTINGS, save_settings  # a dict containing values stored in the json file
+from tasks import TaskRunner
+from instrumentation import RECORDER, StartupTimer
+import tracing
+from tracing import traced, span
 
 """The main program file, will create a database if necessary on first-time setup when none exists.
 Specify settings in settings.json
 Note this is designed to work with Windows type paths"""
 
-TOP_LEVEL = SETTINGS["TOP_LEVEL"]
 SQLPATH = SETTINGS["SQLPATH"]
 # the number of rows and columns (x, y) for the tiles in the query window results pane
 QUERY_X = SETTINGS["QUERY_X"]
@@ -24,8 +30,9 @@ QUERY_Y = SETTINGS["QUERY_Y"]
 
 class ThumbGenerator:
 
-    def __init__(self, list_of_paths):
+    def __init__(self, list_of_paths, backend=None):
 
+        self.backend = backend or get_backend()  # shared by every VideoObject made here
         self.path_gen = None  # a generator object
         self.updater_running = False  # stop more than one updater thread
         self.deque = deque()
@@ -87,7 +94,7 @@ class ThumbGenerator:
             except UnicodeEncodeError:
                 print("getting a videoobject for unprintable filename")
             try:
-                obj = VideoObject(path)
+                obj = VideoObject(path, backend=self.backend)
             except BadVideoException:
                 obj = path  # the video is broken, just put the path on the deque so that when the
                 # main window pops it it knows it's broken and can remove the video from the db
@@ -206,23 +213,32 @@ class PicsWindow(Toplevel):
         index = self.index_from
         self.piclist = []  # clear to prevent storing old images forever
 
-        for i in self.video_object.images:
-            if i == self.placeholder_image:
-                logo = i  # otherwise it will try to make a PhotoImage but placeholder is already a PhotoImage
-            else:
-                logo = ImageTk.PhotoImage(i)
-            self.piclist.append(logo)
+        with span("PhotoImage", images=len(self.video_object.images)):
+            for i in self.video_object.images:
+                if i == self.placeholder_image:
+                    logo = i  # otherwise it will try to make a PhotoImage but placeholder is already a PhotoImage
+                else:
+                    logo = ImageTk.PhotoImage(i)
+                self.piclist.append(logo)
 
-        for i in self.picture_panels:
-            if index < len(self.piclist):  # to cope with being passed a small query
-                i.configure(image=self.piclist[index], bg="light grey")
-            else:
-                i.configure(image=self.placeholder_image, bg="light grey")
-            index += 1
+        with span("configure panels"):
+            for i in self.picture_panels:
+                if index < len(self.piclist):  # to cope with being passed a small query
+                    i.configure(image=self.piclist[index], bg="light grey")
+                else:
+                    i.configure(image=self.placeholder_image, bg="light grey")
+                index += 1
 
 
 class ImageWindow(PicsWindow):
 
+    def __init__(self, parent, ph=None, tasks=None):
+
+        """tasks is the TaskRunner used to call ffmpeg when refining, without one it runs in the Tk thread"""
+
+        self.tasks = tasks
+        super().__init__(parent, ph=ph)
+
     def add_timestamp_labels(self, x):
 
         timestamp_container = Frame(self)
@@ -249,21 +265,34 @@ class ImageWindow(PicsWindow):
             i.configure(text="%s:%s" % (timestamps[cnt]))
             cnt += 1
 
+    @traced
     def on_right_click(self, e):
 
-        self.video_object.refine()
-        self.update_images()
+        if self.tasks is None:
+            self.video_object.refine()
+            self.update_images()
+            return
+
+        obj = self.video_object
+        self.tasks.submit(obj.refine, callback=lambda r: self.refined(obj), key="refine")
+
+    def refined(self, obj):
+
+        if obj is self.video_object:  # might have moved on to the next video while ffmpeg was running
+            self.update_images()
 
     def on_left_double_click(self, event):
 
         os.startfile(self.video_object.path)
 
+    @traced
     def on_left_click(self, event):
 
         widget = event.widget
         index = widget.number
         self.set_save_pic(index)
 
+    @traced
     def select_image(self, event):
 
         """select an image in the grid on the basis of a numpad keypress. Note that the number
@@ -292,9 +321,31 @@ class QueryWindow(PicsWindow):
         self.right_arrow_icon = mainwindow_ref.right_arrow_icon
         self.left_arrow_icon = mainwindow_ref.left_arrow_icon
         self.mainwindow_ref = mainwindow_ref
+        self.selected = set()  # paths of the results picked with shift + right click, see MainWindow.tag_selected
         # extra code to get the icons for fd/back arrow and put them in the picture panels
         super().__init__(parent, x, y, ph=ph)
 
+    def set_videoobject(self, obj):
+
+        self.selected = set()  # a new search starts a new selection
+        super().set_videoobject(obj)
+
+    def update_images(self):
+
+        super().update_images()
+        self.show_selection()
+
+    def show_selection(self):
+
+        """Colours the panels of the selected videos on this page"""
+
+        paths = getattr(self.video_object, "paths", [])
+        for panel in self.picture_panels:
+            index = panel.number + self.index_from
+            if index < len(paths) and paths[index] in self.selected:
+                panel.configure(bg="light blue")
+
+    @traced
     def on_left_click(self, event):
 
         """uses os.startfile on releveant path from selected thumbnail"""
@@ -304,16 +355,17 @@ class QueryWindow(PicsWindow):
         index += self.index_from  # offset used if we are on screen 2,3... of results
         if not index > len(self.video_object.paths) - 1:
             path = self.video_object.paths[index]
-            path = os.path.join(TOP_LEVEL, path)  # get the absolute path from the root in settings
+            path = os.path.join(self.mainwindow_ref.db_manager.top_level, path)  # the database stores relative paths
             if os.path.exists(path):
                 os.startfile(path)
             else:
                 print(f"File was not found at {path}")
-            self.mainwindow_ref.db_manager.increment_play_count(path)
-            self.mainwindow_ref.history_window.add(self.piclist[index], path)
+            self.mainwindow_ref.db_tasks.submit(self.mainwindow_ref.db_manager.increment_play_count, path)
+            self.mainwindow_ref.history().add(self.piclist[index], path)
         else:
             print("index beyond video list")
 
+    @traced
     def on_right_click(self, event):
 
         """overloaded to query tags from the parent's database object"""
@@ -325,6 +377,7 @@ class QueryWindow(PicsWindow):
                 i.configure(bg="light grey")
                 # reset colours so that old green highlights don't linger, but don't go beyond len of piclist
                 cnt += 1
+        self.show_selection()
 
         widget = event.widget
         index = widget.number + self.index_from
@@ -338,9 +391,38 @@ class QueryWindow(PicsWindow):
         else:
             print("index beyond video list")
 
+    @traced
+    def on_shift_right_click(self, event):
+
+        """Adds the video to the selection, or takes it out if it is already in it"""
+
+        index = event.widget.number + self.index_from
+        if index > len(self.video_object.paths) - 1:
+            print("index beyond video list")
+            return
+        path = self.video_object.paths[index]
+        if path in self.selected:
+            self.selected.remove(path)
+            event.widget.configure(bg="light grey")
+        else:
+            self.selected.add(path)
+            event.widget.configure(bg="light blue")
+        self.title(f"Results, {len(self.selected)} selected")
+
+    @traced
+    def on_control_right_click(self, event):
+
+        """Selects the video like a right click, then searches for the videos tagged most like it"""
+
+        self.on_right_click(event)
+        self.mainwindow_ref.search_similar()
+
     def picpanels_setup(self, x, y):
 
         super().picpanels_setup(x, y)
+        for panel in self.picture_panels:
+            panel.bind("<Control-Button-3>", self.on_control_right_click)
+            panel.bind("<Shift-Button-3>", self.on_shift_right_click)
 
         # re-bind commands for first and last picture panels for use as forward/back button
 
@@ -350,12 +432,16 @@ class QueryWindow(PicsWindow):
         self.picture_panels[0].bind("<Double-Button-1>", self.prev_image_set)
         self.picture_panels[0].bind("<Button-2>", null_method)
         self.picture_panels[0].bind("<Button-3>", null_method)
+        self.picture_panels[0].bind("<Control-Button-3>", null_method)
+        self.picture_panels[0].bind("<Shift-Button-3>", null_method)
         self.picture_panels[0].configure(image=self.left_arrow_icon, bg="light grey")
 
         self.picture_panels[-1].bind("<Button-1>", self.next_image_set)
         self.picture_panels[-1].bind("<Double-Button-1>", self.next_image_set)
         self.picture_panels[-1].bind("<Button-2>", null_method)
         self.picture_panels[-1].bind("<Button-3>", null_method)
+        self.picture_panels[-1].bind("<Control-Button-3>", null_method)
+        self.picture_panels[-1].bind("<Shift-Button-3>", null_method)
         self.picture_panels[-1].configure(image=self.right_arrow_icon, bg="light grey")
 
         self.picture_panels.pop()
@@ -364,24 +450,43 @@ class QueryWindow(PicsWindow):
         for panel in self.picture_panels:
             panel.number -= 1  # compensate for reserving first and last
 
+    @traced
     def next_image_set(self, event):
 
+        db_tasks = self.mainwindow_ref.db_tasks
         if self.index_from + len(self.picture_panels) < len(self.video_object.images):
             self.index_from += len(self.picture_panels)
             # might have gone forward then back, so can go forward again without
             # asking the generator for a new batch of results
+            self.show_page()
+        elif not db_tasks.busy("page"):  # ignore extra clicks while a batch is on its way
+            obj = self.video_object
+            db_tasks.submit(obj.add_batch, callback=lambda r: self.batch_added(obj),
+                            errback=lambda e: self.batch_failed(obj, e), key="page")
+
+    def batch_added(self, obj):
+
+        if obj is self.video_object:  # a new query might have replaced the results in the meantime
+            self.index_from += len(self.picture_panels)
+            self.show_page()
+
+    def batch_failed(self, obj, e):
+
+        if isinstance(e, StopIteration):
+            print("results generator exhausted")
         else:
-            try:
-                self.video_object.add_batch()
-                self.index_from += len(self.picture_panels)
-            except StopIteration:
-                print("results generator exhausted")
+            print(f"error getting more results: {e}")
+        if obj is self.video_object:
+            self.show_page()
+
+    def show_page(self):
 
         self.update_images()
         self.mainwindow_ref.deselect_update()
         # self.file_name_display.configure(text="Results")  # clear selection
         self.title("Results")
 
+    @traced
     def prev_image_set(self, event):
 
         if not self.index_from == 0:
@@ -425,6 +530,133 @@ class HistoryWindow(PicsWindow):
         # this doesn't update the "times played" count but that's not really that useful anyway
 
 
+class ScanWindow(Toplevel):
+
+    """Live counters for a library scan running in the background, with pause and cancel buttons"""
+
+    def __init__(self, parent, progress, interval_ms=500):
+
+        super().__init__(parent)
+        self.title("Scanning library")
+        self.progress = progress
+        self.interval_ms = interval_ms
+        self.last = progress.snapshot()  # to work out the per second rates between refreshes
+        self.last_time = time.time()
+
+        self.phase_label = Label(self, text="starting", font=font.Font(family="Helvetica", size="12"))
+        self.phase_label.pack(side=TOP, padx=20, pady=10)
+        self.counter_labels = {}
+        for name in progress.counters:
+            label = Label(self, text=f"{name}: 0", anchor=W, width=40)
+            label.pack(side=TOP, padx=20)
+            self.counter_labels[name] = label
+
+        controls = Frame(self)
+        controls.pack(side=TOP, pady=10)
+        self.pause_button = Button(controls, text="Pause", command=self.toggle_pause)
+        self.pause_button.pack(side=LEFT, padx=5)
+        self.cancel_button = Button(controls, text="Cancel", command=self.progress.cancel)
+        self.cancel_button.pack(side=LEFT, padx=5)
+
+        self.after(self.interval_ms, self.refresh)
+
+    def toggle_pause(self):
+
+        if self.progress.paused():
+            self.progress.resume()
+            self.pause_button.configure(text="Pause")
+        else:
+            self.progress.pause()
+            self.pause_button.configure(text="Resume")
+
+    def refresh(self):
+
+        now = time.time()
+        snap = self.progress.snapshot()
+        dt = max(now - self.last_time, 0.001)
+        for name, value in snap.items():
+            rate = (value - self.last[name]) / dt
+            self.counter_labels[name].configure(text=f"{name}: {value}  ({rate:.1f}/s)")
+        self.last = snap
+        self.last_time = now
+
+        phase = "paused" if self.progress.paused() else self.progress.phase
+        self.phase_label.configure(text=f"{phase}, {round(self.progress.elapsed())} s")
+
+        if self.progress.ended is None:
+            self.after(self.interval_ms, self.refresh)
+        else:
+            self.pause_button.configure(state=DISABLED)
+            self.cancel_button.configure(text="Close", command=self.destroy)
+
+
+class StatsWindow(Toplevel):
+
+    """Videos, untagged and skipped videos and size of each directory, and how many videos have each tag. The
+    numbers come from tables the database keeps up to date as it goes, so they are there straight away."""
+
+    def __init__(self, parent, mainwindow_ref):
+
+        super().__init__(parent)
+        self.title("Library statistics")
+        self.mainwindow_ref = mainwindow_ref
+        self.totals_label = Label(self, font=font.Font(family="Helvetica", size="12"))
+        self.totals_label.pack(side=TOP, padx=20, pady=10)
+
+        columns = ("videos", "untagged", "skipped", "GB")
+        self.directories = ttk.Treeview(self, columns=columns, height=15)
+        self.directories.heading("#0", text="directory")
+        for name in columns:
+            self.directories.heading(name, text=name)
+            self.directories.column(name, width=90, anchor=E)
+        self.directories.pack(side=TOP, fill=BOTH, expand=YES, padx=20)
+
+        self.tags = ttk.Treeview(self, columns=("group", "videos"), height=15)
+        self.tags.heading("#0", text="tag")
+        self.tags.heading("group", text="group")
+        self.tags.heading("videos", text="videos")
+        self.tags.column("videos", width=90, anchor=E)
+        self.tags.pack(side=TOP, fill=BOTH, expand=YES, padx=20, pady=10)
+
+        self.rebuild_button = Button(self, text="Recount from scratch", command=self.rebuild)
+        self.rebuild_button.pack(side=TOP, pady=10)
+        self.load()
+
+    def load(self):
+
+        db = self.mainwindow_ref.db_manager
+        self.mainwindow_ref.db_tasks.submit(lambda: (db.directory_stats(), db.tag_stats()), callback=self.show)
+
+    def show(self, stats):
+
+        if not self.winfo_exists():
+            return  # closed while the numbers were being read
+        directories, tags = stats
+        self.directories.delete(*self.directories.get_children())
+        self.tags.delete(*self.tags.get_children())
+        for directory, videos, untagged, skipped, size in directories:
+            self.directories.insert("", END, text=directory,
+                                    values=(videos, untagged, skipped, round(size / 1024 ** 3, 2)))
+        for group, tag, videos in tags:
+            self.tags.insert("", END, text=tag, values=(group, videos))
+        total = sum(x[1] for x in directories)
+        untagged = sum(x[2] for x in directories)
+        size = sum(x[4] for x in directories)
+        self.totals_label.configure(text=f"{total} videos, {untagged} untagged, {round(size / 1024 ** 3, 2)} GB")
+
+    def rebuild(self):
+
+        self.rebuild_button.configure(state=DISABLED)
+        self.mainwindow_ref.jobs.submit(self.mainwindow_ref.db_manager.rebuild_stats, callback=self.rebuilt)
+
+    def rebuilt(self, wrong):
+
+        if not self.winfo_exists():
+            return
+        self.rebuild_button.configure(state=NORMAL, text=f"Recount from scratch ({wrong} rows were wrong)")
+        self.load()
+
+
 class ResultsObject:
 
     """behaves like a VideoObject, can be passed to the querywindow for displaying the results of a query"""
@@ -457,37 +689,57 @@ class ResultsObject:
             # it's not really a generator but this tells the QueryWindow there are no more
 
         new_images = []
-        for qq in new_batch:
+        with span("decode thumbnails", images=len(new_batch)):
+            for qq in new_batch:
 
-            pth = qq[1]  # in case need to print path name for image getting error
+                pth = qq[1]  # in case need to print path name for image getting error
 
-            try:
-                im = Image.open(BytesIO(qq[0])).resize((160, 120))
-            except UnidentifiedImageError:
-                im = self.placeholder_image
-                print(f"Error getting image for {pth}")
-            new_images.append(im)
+                try:
+                    im = Image.open(BytesIO(qq[0])).resize((160, 120))
+                except UnidentifiedImageError:
+                    im = self.placeholder_image
+                    print(f"Error getting image for {pth}")
+                new_images.append(im)
 
         new_paths = [x[1] for x in new_batch]
         self.images.extend(new_images)
         self.paths.extend(new_paths)
 
+    def close(self):
+
+        """Finish with the generator early so it gives back its database connection"""
+
+        self.generator.close()
+
 
 class MainWindow:
-    def __init__(self, parent):
+    def __init__(self, parent, startup=None, quit_after_startup=False):
 
+        """startup is a StartupTimer for the startup report, with quit_after_startup the program closes again
+        as soon as the report is written, e.g. to time startup from a script"""
+
+        self.startup = startup or StartupTimer()
+        self.quit_after_startup = quit_after_startup
         self.button_font = font.Font(family="Helvetica", size="12")
         self.parent = parent  # ref held for starting query mode or making new windows outside of init
+        tracing.attach(parent)  # traced events end when this goes idle, see tracing.py
 
         self.parent.geometry(SETTINGS["GEOMETRY_MAIN"])
         self.db_manager = DBManager(SQLPATH)
+        self.startup.mark("database opened")
+        # blocking work is handed to these so that the window never freezes, see tasks.py
+        self.db_tasks = TaskRunner(parent, "database")  # queries and tag writes, run in the order submitted
+        self.media_tasks = TaskRunner(parent, "media")  # ffmpeg, i.e. getting the next video while tagging
+        self.jobs = TaskRunner(parent, "jobs")  # long library-wide jobs like scanning and freeing space
         self.tag_group_1, self.tag_group_2, self.extensions = self.db_manager.get_tag_settings()
 
-        la, ra, ph = self.db_manager.get_icons()  # function returns images in predefined order
-
-        self.placeholder_image = ImageTk.PhotoImage(Image.open(BytesIO(ph)).resize((80, 80)))
-        self.left_arrow_icon = ImageTk.PhotoImage(Image.open(BytesIO(la)).resize((80, 80)))
-        self.right_arrow_icon = ImageTk.PhotoImage(Image.open(BytesIO(ra)).resize((80, 80)))
+        # the icons, the results window and the directory list wait until the main window is on screen,
+        # see finish_startup
+        self.placeholder_image = None
+        self.left_arrow_icon = None
+        self.right_arrow_icon = None
+        self.picpanel = None
+        self.history_window = None  # made the first time a video is opened from the results, see history()
 
         self.done_objects = []  # session-specific list for history seeking purposes, max. length 10 items
         self.saved_objects = []  # current videoobject is saved to return to later if seeking
@@ -498,6 +750,7 @@ class MainWindow:
         self.found_video = ""  # the name of the video being played in some media player for scan mode
         self.thumbgenerator = None  # this is instantiated in another function
         self.scan_task_id = None  # reference to the scanning task in tkinter event loop for cancellation
+        self.scan_progress = None  # ScanProgress of the running scan, also used to cancel it
 
         self.xtiles = QUERY_X
         self.ytiles = QUERY_Y  # store geometry in this object in case the user updates it via the interface
@@ -506,7 +759,6 @@ class MainWindow:
 
         self.left_container = Frame(parent)
         self.right_container = Frame(parent)
-        self.picpanel = ImageWindow(parent, ph=self.placeholder_image)
 
         self.query_button = Button(self.left_container)
         self.query_button.configure(text="Query mode", command=self.start_query_mode)
@@ -532,12 +784,23 @@ class MainWindow:
         self.free_space_button.configure(text="Free up library space", command=self.free_space)
         self.free_space_button.pack(fill=BOTH, expand=YES)
 
+        self.near_dupes_button = Button(self.left_container)
+        self.near_dupes_button.configure(text="Find near duplicates", command=self.find_near_duplicates)
+        self.near_dupes_button.pack(fill=BOTH, expand=YES)
+
+        self.library_stats_button = Button(self.left_container)
+        self.library_stats_button.configure(text="Library statistics", command=lambda: StatsWindow(self.parent, self))
+        self.library_stats_button.pack(fill=BOTH, expand=YES)
+
+        self.stats_button = Button(self.left_container)
+        self.stats_button.configure(text="Timing statistics", command=self.dump_stats)
+        self.stats_button.pack(fill=BOTH, expand=YES)
+
         self.dropdown_label = Label(self.left_container, text="Search within directory:")
         self.dropdown_label.pack(fill=BOTH, expand=YES)
 
         self.dropdown_var = StringVar()
-        ddvals = ["Any"] + self.db_manager.get_directories()
-        self.directory_dropdown = ttk.Combobox(self.left_container, textvariable = self.dropdown_var, values=ddvals)
+        self.directory_dropdown = ttk.Combobox(self.left_container, textvariable=self.dropdown_var, values=["Any"])
         self.directory_dropdown.bind("<<ComboboxSelected>>", self.on_dropdown_select)
         self.directory_dropdown.pack(fill=BOTH, expand=YES)
 
@@ -585,11 +848,16 @@ class MainWindow:
         self.newquery_button.configure(font=self.button_font, text="New results", command=self.new_query_results)
         self.newquery_button.pack(side=LEFT)
 
+        self.tag_selected_button = Button(self.controls_container)
+        self.tag_selected_button.configure(font=self.button_font, text="Tag selected", command=self.tag_selected)
+        self.tag_selected_button.pack(side=LEFT)
+
         for k in (self.category_container, self.extras_container):
             button = Button(k)
             button.configure(text="add", command=lambda container=k: self.add_button(container))
             button.grid()
             button.value = 0  # so that it doesn't crash the button value reading method
+            button.tag_name = None
             k.current_row = 0
             k.current_column = 0
 
@@ -599,6 +867,10 @@ class MainWindow:
         self.text_search.pack(side=LEFT, padx=20)
         self.text_search_button.pack(side=LEFT, padx=20)
 
+        self.tag_search_button = Button(self.text_container)
+        self.tag_search_button.configure(text="Search by tags", font=self.button_font, command=self.search_by_tags)
+        self.tag_search_button.pack(side=LEFT, padx=5)
+
         self.pop_search_button = Button(self.text_container)
         self.pop_search_button.configure(text="Most viewed", font=self.button_font, command=self.search_popular)
         self.pop_search_button.pack(side=LEFT, padx=5)
@@ -607,6 +879,10 @@ class MainWindow:
         self.unpop_search_button.configure(text="Least viewed", font=self.button_font, command=self.search_unpopular)
         self.unpop_search_button.pack(side=LEFT, padx=5)
 
+        self.similar_search_button = Button(self.text_container)
+        self.similar_search_button.configure(text="More like this", font=self.button_font, command=self.search_similar)
+        self.similar_search_button.pack(side=LEFT, padx=5)
+
         self.extras_container.pack(fill=BOTH, expand=YES)
         self.category_container.pack(fill=BOTH, expand=YES)
         self.text_container.pack()
@@ -620,8 +896,42 @@ class MainWindow:
 
         self.setup_num_bindings()  # bind numeric keypad to thumbnail 1-9 for selection while tagging
 
+        self.startup.mark("main window built")
+        self.parent.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+
+        """The rest of startup, once the main loop is running"""
+
+        self.parent.update_idletasks()  # draw the main window first
+        self.startup.mark("main window drawn")
+        la, ra, ph = self.db_manager.get_icons()  # function returns images in predefined order
+
+        self.placeholder_image = ImageTk.PhotoImage(Image.open(BytesIO(ph)).resize((80, 80)))
+        self.left_arrow_icon = ImageTk.PhotoImage(Image.open(BytesIO(la)).resize((80, 80)))
+        self.right_arrow_icon = ImageTk.PhotoImage(Image.open(BytesIO(ra)).resize((80, 80)))
+
         self.start_query_mode()
+        self.startup.mark("results window shown")
+        self.db_tasks.submit(self.db_manager.get_directories, callback=self.directories_loaded)
+
+    def directories_loaded(self, directories):
 
+        self.directory_dropdown.configure(values=["Any"] + directories)
+        self.startup.mark("directory list loaded")
+        self.startup.report()
+        if self.quit_after_startup:
+            self.on_quit()
+
+    def history(self):
+
+        """The history window, made when first needed and again if the user has closed it"""
+
+        if self.history_window is None or not self.history_window.winfo_exists():
+            self.history_window = HistoryWindow(parent=self.parent, ph=self.placeholder_image)
+        return self.history_window
+
+    @traced
     def on_dropdown_select(self, e):
 
         dd = self.dropdown_var.get()
@@ -629,6 +939,8 @@ class MainWindow:
             self.db_manager.remove_directory_filter()
         else:
             self.db_manager.set_directory_filter(dd)
+        if self.query_mode:
+            self.update_facets()
 
     def setup_num_bindings(self):
 
@@ -654,15 +966,103 @@ class MainWindow:
                 self.tag_group_1.append(name)
             elif container.name == "tag_group_2":
                 self.tag_group_2.append(name)
-            self.db_manager.add_tag(container.name, name)
+            if not self.db_manager.add_tag(container.name, name):  # the group is full
+                tags = self.tag_group_1 if container.name == "tag_group_1" else self.tag_group_2
+                if name in tags:
+                    tags.remove(name)
+                messagebox.showinfo("", f"Can't add {name}, there is no room for more tags in this group")
+                return
 
         button = Button(container)
         button.value = 0
-        button.configure(text=name, font=self.button_font,
-                         command=lambda b=button: MainWindow.selection_button_cmd(b))
+        button.tag_name = name  # the text also shows a count in query mode, see show_facets
+        button.configure(text=name, font=self.button_font, command=lambda b=button: self.tag_button_clicked(b))
+        button.bind("<Button-3>", lambda e, b=button: self.tag_menu(b, e))
         button.grid(row=row, column=column, sticky=E + W)
 
+    def tag_menu(self, button, event):
+
+        """Right click on a tag: rename, merge or delete it for the whole library"""
+
+        menu = Menu(self.parent, tearoff=0)
+        menu.add_command(label="Rename...", command=lambda: self.rename_tag(button))
+        menu.add_command(label="Merge into...", command=lambda: self.merge_tag(button))
+        menu.add_command(label="Delete", command=lambda: self.delete_tag(button))
+        menu.tk_popup(event.x_root, event.y_root)
+
+    def rename_tag(self, button):
+
+        name = simpledialog.askstring("", f"Rename {button.tag_name} to")
+        if not name or name == button.tag_name:
+            return  # user cancelled
+        if name in self.db_manager.tag_val_dict:
+            messagebox.showinfo("", f"There is already a tag called {name}, merge them instead")
+            return
+
+        def renamed(done):
+
+            if done:
+                button.tag_name = name
+                button.configure(text=name)
+                self.update_facets()
+
+        self.db_tasks.submit(self.db_manager.rename_tag, button.tag_name, name, callback=renamed)
+
+    def merge_tag(self, button):
+
+        into = simpledialog.askstring("", f"Give every video tagged {button.tag_name} this tag instead")
+        if not into or into == button.tag_name:
+            return  # user cancelled
+        if into not in self.db_manager.tag_val_dict:
+            messagebox.showinfo("", f"No such tag: {into}")
+            return
+        self.db_tasks.submit(self.db_manager.delete_tag, button.tag_name, into,
+                             callback=lambda videos: videos is None or self.remove_tag_button(button))
+
+    def delete_tag(self, button):
+
+        if not messagebox.askyesno("", f"Take {button.tag_name} off every video and delete it?"):
+            return
+        self.db_tasks.submit(self.db_manager.delete_tag, button.tag_name,
+                             callback=lambda videos: self.remove_tag_button(button))
+
+    def remove_tag_button(self, button):
+
+        button.destroy()
+        if self.query_mode:
+            self.update_facets()
+
+    def tag_button_clicked(self, widget):
+
+        MainWindow.selection_button_cmd(widget)
+        if self.query_mode:
+            self.update_facets()
+
+    def update_facets(self):
+
+        """Counts in the background how many results each tag would leave, see DBManager.facet_counts"""
+
+        tag_group_1, tag_group_2, exclude = self.get_query_values()
+        self.db_tasks.submit(self.db_manager.facet_counts, tag_group_1, tag_group_2, exclude=exclude,
+                             callback=self.show_facets, key="facets")  # a newer count replaces one not yet started
+
+    def show_facets(self, facets):
+
+        """Shows the count after each tag's name, or just the names if facets is None. Tags that would leave
+        no results are greyed out but can still be clicked."""
+
+        counts = facets[1] if facets and self.query_mode else {}
+        for i in (self.category_container, self.extras_container):
+            for j in i.winfo_children():
+                if type(j) == Button and j.tag_name is not None:
+                    if j.tag_name in counts:
+                        j.configure(text=f"{j.tag_name} ({counts[j.tag_name]})",
+                                    foreground="black" if counts[j.tag_name] else "gray50")
+                    else:
+                        j.configure(text=j.tag_name, foreground="black")
+
     @staticmethod
+    @traced
     def selection_button_cmd(widget):
 
         colourkey = ["gray92", "green", "pink"]
@@ -676,10 +1076,17 @@ class MainWindow:
 
         gif_image = self.picpanel.save_pic
         full_path = self.picpanel.video_object.path
-        tag_group_1, tag_group_2 = self.get_button_values()
+        # in query mode a second click excludes a tag from the search, it isn't a tag to store
+        tag_group_1, tag_group_2 = self.get_button_values((1,) if self.query_mode else (1, 2))
         self.last_tags = tag_group_1 + tag_group_2
         # store last if next video has identical tags and the user wants to clone them
 
+        self.db_tasks.submit(self.write_entry_and_thumbnail, full_path, tag_group_1, tag_group_2, gif_image)
+
+    def write_entry_and_thumbnail(self, full_path, tag_group_1, tag_group_2, gif_image):
+
+        """Runs on the database thread, values are read from the widgets beforehand in save_entry"""
+
         self.db_manager.write_entry(full_path, tag_group_1, tag_group_2)
         image_bytes = BytesIO()
         gif_image.save(image_bytes, "GIF")
@@ -696,8 +1103,9 @@ class MainWindow:
             full_path = self.picpanel.video_object.path
         except AttributeError:
             full_path = None
-        self.db_manager.skip_entry(full_path)
+        self.db_tasks.submit(self.db_manager.skip_entry, full_path)
 
+    @traced
     def repeat_tags(self):
 
         for i in (self.category_container, self.extras_container):
@@ -705,12 +1113,16 @@ class MainWindow:
             children = i.winfo_children()
             for j in children:
                 if type(j) == Button:
-                    if j["text"] in self.last_tags:
+                    if j.tag_name in self.last_tags:
                         j.value = 1
                         j.configure(background="green")
 
+    @traced
     def next_entry(self, override=None):  # override added new when getting currently viewed video
 
+        if self.media_tasks.busy("next"):
+            return  # still waiting for ffmpeg to give us the next video, don't save this one twice
+
         if not self.get_button_values() == [[], []]:
             self.save_entry()
         else:  # no tags were assigned, the user skipped the video & it probably isn't interesting
@@ -727,17 +1139,32 @@ class MainWindow:
             if override:
                 obj = override
             else:
-                obj = self.thumbgenerator.get_next()
-                while type(obj) is str:  # take care of as many broken videos as necessary
-                    self.db_manager.broken_file(obj)
-                    obj = self.thumbgenerator.get_next()
+                # get_next can block while the prefetch thread is still running ffmpeg
+                self.media_tasks.submit(self.fetch_next_video, callback=self.show_video, key="next")
+                return
 
         else:
             obj = self.saved_objects.pop()
-            try:
-                self.update_tags(obj.path)  # re-load and display the object's tags
-            except KeyError:
-                pass  # object had been viewed but not tagged yet
+            self.update_tags(obj.path)  # re-load and display the object's tags
+
+        self.show_video(obj)
+
+    def fetch_next_video(self):
+
+        """Runs on the media thread. Returns the next VideoObject from the thumbnail generator, moving any
+        broken videos it turns up to the broken folder on the way"""
+
+        obj = self.thumbgenerator.get_next()
+        while type(obj) is str:  # take care of as many broken videos as necessary
+            self.db_manager.broken_file(obj)
+            obj = self.thumbgenerator.get_next()
+
+        return obj
+
+    def show_video(self, obj):
+
+        if not self.tag_mode:
+            return  # switched to query mode while the video was being fetched
         if not (obj is None or obj == -1):
 
             self.picpanel.set_videoobject(obj)
@@ -745,6 +1172,7 @@ class MainWindow:
         else:
             print("got nonetype from thumb generator")
 
+    @traced
     def previous_entry(self):
 
         if not self.done_objects == []:
@@ -756,13 +1184,9 @@ class MainWindow:
             return
 
         self.picpanel.set_videoobject(obj)
+        self.update_tags(obj.path)
 
-        try:
-            self.update_tags(obj.path)
-        except KeyError:  # file was skipped and not tagged at all
-            self.reset_buttons()
-
-    def get_button_values(self):
+    def get_button_values(self, values=(1, 2)):
 
         ls = []
 
@@ -771,12 +1195,20 @@ class MainWindow:
             children = i.winfo_children()
             for j in children:
                 if type(j) == Button:
-                    if not j.value == 0:  # can be 1 (tag once) or 2 (tag and conserve tag for next entry)
-                        taglist.append(j["text"])
+                    if j.value in values:  # can be 1 (tag once) or 2 (tag and conserve tag for next entry)
+                        taglist.append(j.tag_name)
 
             ls.append(taglist)
         return ls
 
+    def get_query_values(self):
+
+        """In query mode a tag clicked once is searched for and one clicked twice is left out. Returns the lists
+        of tags to search for in each group and the pair of lists to exclude."""
+
+        return *self.get_button_values((1,)), self.get_button_values((2,))
+
+    @traced
     def reset_buttons(self):
 
         for i in (self.category_container, self.extras_container):
@@ -786,59 +1218,69 @@ class MainWindow:
                     if j.value == 1:  # reset values stored in button if it has been clicked but not if clicked twice
                         j.value = 0
                         j.configure(background="gray92")
+        if self.query_mode:
+            self.update_facets()
 
+    @traced
     def start_query_mode(self):
 
         print("Query mode started")
         self.reset_buttons()
         self.query_mode = True
         self.tag_mode = False
-        self.picpanel.destroy()
+        if self.picpanel is not None:
+            self.picpanel.destroy()
         self.picpanel = QueryWindow(parent=self.parent, x=self.xtiles, y=self.ytiles,
                                     mainwindow_ref=self, ph=self.placeholder_image)
-        self.history_window = HistoryWindow(parent=self.parent, ph=self.placeholder_image)
+        self.update_facets()
 
+    @traced
     def start_tag_mode(self, randomly=False):
 
         print("Tag mode started")
         self.reset_buttons()
         self.query_mode = False
         self.tag_mode = True
-        self.picpanel.destroy()
-        self.picpanel = ImageWindow(self.parent)
+        self.show_facets(None)
+        if self.picpanel is not None:
+            self.picpanel.destroy()
+        self.picpanel = ImageWindow(self.parent, tasks=self.media_tasks)
 
         if not randomly:
             apath = filedialog.askdirectory()
             # apath = apath.split("/")[1]
             apath = os.path.split(apath)[1]
             # db manager's path generator expects just the name of the directory for an SQL query
-            list_of_paths = self.db_manager.path_generator(apath, random=False)
         else:
-            list_of_paths = self.db_manager.path_generator(None, random=True)
+            apath = None
 
-        self.thumbgenerator = ThumbGenerator(list_of_paths)
+        self.media_tasks.submit(self.start_thumbgenerator, apath, randomly, callback=self.show_video, key="next")
+
+    def start_thumbgenerator(self, directory, randomly):
 
-        no_dir = False
-        video_object = None
-        while video_object is None:
-            video_object = self.thumbgenerator.get_next()
-            # todo: this code is duplicated in the next_entry function
-            while type(video_object) is str:  # take care of as many broken videos as necessary
-                self.db_manager.broken_file(video_object)
-                video_object = self.thumbgenerator.get_next()
+        """Runs on the media thread, builds the list of videos to tag and waits for the first one"""
 
-            if video_object == -1:
-                no_dir = True
-                break
+        list_of_paths = self.db_manager.path_generator(directory, random=randomly)
+        self.thumbgenerator = ThumbGenerator(list_of_paths)
 
-        if not no_dir:
-            self.picpanel.set_videoobject(video_object)
+        return self.fetch_next_video()  # -1 if there was nothing to tag in that directory
 
+    @traced
     def update_tags(self, key):
 
+        """Looks up the video's tags in the background and lights up the buttons when they arrive"""
+
         self.reset_buttons()
-        result = self.db_manager.get_entry(key)
         self.key_to_update = key
+        self.db_tasks.submit(self.db_manager.get_entry, key, callback=lambda result: self.show_tags(key, result),
+                             errback=lambda e: self.reset_buttons(), key="entry")
+        # an error here means the file was skipped and not tagged at all
+
+    def show_tags(self, key, result):
+
+        if not key == self.key_to_update:
+            return  # the user has already selected something else
+
         info_list = result.tag_group_1 + result.tag_group_2
 
         for i in (self.category_container, self.extras_container):
@@ -846,24 +1288,47 @@ class MainWindow:
             children = i.winfo_children()
             for j in children:
                 if type(j) == Button:
-                    if j["text"] in info_list:
+                    if j.tag_name in info_list:
                         j.value = 1
                         j.configure(background="green")
 
+    @traced
+    def tag_selected(self):
+
+        """Adds the green tags to every video selected in the results with shift + right click and takes the pink
+        ones off them, in one go"""
+
+        if not self.query_mode:
+            return
+        paths = list(self.picpanel.selected)
+        if not paths:
+            print("Shift + right click results to select them")
+            return
+        add, remove = self.get_button_values((1,)), self.get_button_values((2,))
+        self.db_tasks.submit(self.db_manager.bulk_tag, paths, add, remove,
+                             callback=lambda changed: self.update_facets())
+
+    @traced
     def commit_change(self):
 
         if not self.query_mode:
             print("not in query mode or scan mode")
             return
-        tag_group_1, tag_group_2 = self.get_button_values()
+        tag_group_1, tag_group_2 = self.get_button_values((1,))  # the others are excluded from searches
 
         if not self.key_to_update:  # clicked "commit" without having a video selected
             return
-        if not self.db_manager.check_has_thumbnail(self.key_to_update):
-            self.save_entry()  # if no thumbnail, it hasn't been tagged before and needs new entry
-        else:
-            self.db_manager.write_entry(self.key_to_update, [], [])  # clear previous tag values
-            self.db_manager.write_entry(self.key_to_update, tag_group_1, tag_group_2)
+        key = self.key_to_update
+        gif_image = self.picpanel.save_pic  # read now, the panel and buttons are reset before write runs
+
+        def write():
+
+            if self.db_manager.check_has_thumbnail(key):
+                self.db_manager.write_entry(key, tag_group_1, tag_group_2)  # replaces all the tags it had
+            else:  # if no thumbnail, it hasn't been tagged before and needs new entry
+                self.write_entry_and_thumbnail(key, tag_group_1, tag_group_2, gif_image)
+
+        self.db_tasks.submit(write)
 
         self.reset_buttons()
 
@@ -872,69 +1337,120 @@ class MainWindow:
         self.reset_buttons()
         self.key_to_update = None
 
-    def new_query_results(self):
+    def show_query(self, query, *args, **kwargs):
+
+        """Runs a search on the database thread and shows the first page of results when it's ready.
+        Starting another search cancels one that hasn't come back yet."""
+
+        def build():
+
+            return ResultsObject(query(*args, **kwargs), placeholder=self.placeholder_image)
+
+        self.db_tasks.submit(build, callback=self.show_results, key="query")
+
+    def show_results(self, obj):
 
-        # TODO: refactor, copy-pasted from below
         if not self.query_mode:
+            self.db_tasks.submit(obj.close)
             return
 
-        queryls = self.get_button_values()
-        results = self.db_manager.newest_matches(*queryls, batch_size=self.tile_count)
-
-        obj = ResultsObject(results, placeholder=self.placeholder_image)
+        old = self.picpanel.video_object
         self.picpanel.set_videoobject(obj)
+        if isinstance(old, ResultsObject):
+            self.db_tasks.submit(old.close)  # closed on the database thread in case it is mid-batch
 
-    def get_query_results(self):
+    @traced
+    def new_query_results(self):
 
         if not self.query_mode:
             return
 
-        queryls = self.get_button_values()
-        results = self.db_manager.get_matches(*queryls, batch_size=self.tile_count)
+        *queryls, exclude = self.get_query_values()
+        self.show_query(self.db_manager.newest_matches, *queryls, exclude=exclude, batch_size=self.tile_count)
 
-        obj = ResultsObject(results, placeholder=self.placeholder_image)
-        self.picpanel.set_videoobject(obj)
+    @traced
+    def get_query_results(self):
+
+        if not self.query_mode:
+            return
 
+        *queryls, exclude = self.get_query_values()
+        self.show_query(self.db_manager.get_matches, *queryls, exclude=exclude, batch_size=self.tile_count)
+
+    @traced
     def search_by_title(self):
 
         if not self.query_mode:
             return
 
         qry = self.text_search.get()
-        results = self.db_manager.text_search(qry, batch_size=self.tile_count)
+        self.show_query(self.db_manager.text_search, qry, batch_size=self.tile_count)
 
-        obj = ResultsObject(results, placeholder=self.placeholder_image)
-        self.picpanel.set_videoobject(obj)  # TODO: bit of code duplication with above
+    @traced
+    def search_by_tags(self):
 
-    def search_popular(self):
+        """Searches with what is typed in the search box as tags, see DBManager.parse_tag_query"""
 
         if not self.query_mode:
             return
 
-        queryls = self.get_button_values()
-        results = self.db_manager.popular_search(*queryls, batch_size=self.tile_count, most_popular=True)
+        try:
+            tag_group_1, tag_group_2, exclude, any_of = self.db_manager.parse_tag_query(self.text_search.get())
+        except ValueError as e:
+            messagebox.showinfo("", str(e))
+            return
+        self.show_query(self.db_manager.get_matches, tag_group_1, tag_group_2, exclude=exclude, any_of=any_of,
+                        batch_size=self.tile_count)
 
-        obj = ResultsObject(results, placeholder=self.placeholder_image)
-        self.picpanel.set_videoobject(obj)  # TODO: bit of code duplication with above
+    @traced
+    def search_popular(self):
 
+        if not self.query_mode:
+            return
+
+        *queryls, exclude = self.get_query_values()
+        self.show_query(self.db_manager.popular_search, *queryls, exclude=exclude, batch_size=self.tile_count,
+                        most_popular=True)
+
+    @traced
     def search_unpopular(self):
 
         if not self.query_mode:
             return
 
-        queryls = self.get_button_values()
-        results = self.db_manager.popular_search(*queryls, batch_size=self.tile_count, most_popular=False)
+        *queryls, exclude = self.get_query_values()
+        self.show_query(self.db_manager.popular_search, *queryls, exclude=exclude, batch_size=self.tile_count,
+                        most_popular=False)
+
+    @traced
+    def search_similar(self):
 
-        obj = ResultsObject(results, placeholder=self.placeholder_image)
-        self.picpanel.set_videoobject(obj)  # TODO: bit of code duplication with above
+        """Videos tagged most like the one last right clicked in the results (ctrl + right click does both)"""
+
+        if not self.query_mode:
+            return
+        if not self.key_to_update:
+            print("Right click a result to find more like it")
+            return
+
+        self.show_query(self.db_manager.similar_videos, self.key_to_update, batch_size=self.tile_count)
 
     def on_quit(self):
 
         SETTINGS["GEOMETRY_MAIN"] = self.parent.geometry()
-        SETTINGS["GEOMETRY_IMAGEWINDOW"] = self.picpanel.geometry()
-        SETTINGS["GEOMETRY_HISTORY_WINDOW"] = self.history_window.geometry()
+        if self.picpanel is not None and self.picpanel.winfo_exists():
+            SETTINGS["GEOMETRY_IMAGEWINDOW"] = self.picpanel.geometry()
+        if self.history_window is not None and self.history_window.winfo_exists():
+            SETTINGS["GEOMETRY_HISTORY_WINDOW"] = self.history_window.geometry()
         save_settings()  # remember window geometries
 
+        if self.scan_progress:
+            self.scan_progress.cancel()  # it stops at the next file, then we can get the writer lock
+        # tag writes and other changes may still be queued on the worker threads, let them all land before the
+        # connections are closed. The database runner first, it holds the writes the user is waiting on.
+        print("Waiting for background work to finish")
+        for runner in (self.db_tasks, self.media_tasks, self.jobs):
+            runner.stop()
         self.db_manager.commit_changes()
         self.parent.destroy()
 
@@ -942,7 +1458,12 @@ class MainWindow:
 
         """Asks the dbmanager to walk the directory and add new files it finds"""
 
-        self.db_manager.scan_for_new_files(TOP_LEVEL)
+        self.scan_changes_button.configure(state=DISABLED)  # one scan at a time
+        self.scan_progress = ScanProgress()
+        ScanWindow(self.parent, self.scan_progress)
+        self.jobs.submit(self.db_manager.scan_for_new_files, self.db_manager.top_level, self.scan_progress,
+                         callback=lambda r: self.job_finished(self.scan_changes_button),
+                         errback=lambda e: self.job_failed(self.scan_changes_button, e))
 
     def free_space(self):
 
@@ -957,7 +1478,53 @@ class MainWindow:
             print(f"Problem converting number {amt} to float")
             return
         amount = amount * (1024 * 1024 * 1024)  # gigs to bytes
-        self.db_manager.free_up_space(amount)
+        self.free_space_button.configure(state=DISABLED)
+        self.jobs.submit(self.db_manager.free_up_space, amount,
+                         callback=lambda r: self.job_finished(self.free_space_button),
+                         errback=lambda e: self.job_failed(self.free_space_button, e))
+
+    def find_near_duplicates(self):
+
+        """Looks for videos that look the same but aren't identical files, writes a report and shows the pairs
+        side by side in the query window for review"""
+
+        if not self.query_mode:
+            return
+        self.near_dupes_button.configure(state=DISABLED)
+        self.jobs.submit(self.db_manager.near_duplicates, callback=self.show_near_duplicates,
+                         errback=lambda e: self.job_failed(self.near_dupes_button, e))
+
+    def show_near_duplicates(self, pairs):
+
+        self.near_dupes_button.configure(state=NORMAL)
+        print(f"see {self.db_manager.write_near_duplicate_report(pairs)}")
+        paths = []
+        for p in pairs:
+            paths.extend([p.fullpath_a, p.fullpath_b])  # each pair next to each other
+        self.show_query(self.db_manager.thumbnail_pages, paths, batch_size=self.tile_count)
+
+    def dump_stats(self):
+
+        """Prints how long queries and ffmpeg have been taking and saves the numbers, see instrumentation.py"""
+
+        RECORDER.dump()
+        if tracing.enabled():
+            tracing.dump()
+
+    def job_finished(self, button):
+
+        button.configure(state=NORMAL)
+        self.refresh_directories()  # a scan may have found new top level directories
+
+    def job_failed(self, button, e):
+
+        print(f"Library job failed: {e}")
+        button.configure(state=NORMAL)
+
+    def refresh_directories(self):
+
+        self.db_tasks.submit(self.db_manager.get_directories,
+                             callback=lambda dirs: self.directory_dropdown.configure(values=["Any"] + dirs))
 
     def select_directory(self):
 
@@ -983,8 +1550,13 @@ class MainWindow:
                 self.db_manager.set_directory_filter(folder)
 
 
-root = Tk()
-myapp = MainWindow(root)
-root.protocol("WM_DELETE_WINDOW", myapp.on_quit)  # bind function only to commit db changes on quit
-root.title("video tagger")
-root.mainloop()
+if __name__ == "__main__":  # so that other scripts, e.g. the benchmarks, can import the classes
+    startup = StartupTimer(STARTED)
+    startup.mark("imports")
+    root = Tk()
+    startup.mark("Tk started")
+    # --startup-report closes the program again once it has started, to time startup from a script
+    myapp = MainWindow(root, startup, quit_after_startup="--startup-report" in sys.argv[1:])
+    root.protocol("WM_DELETE_WINDOW", myapp.on_quit)  # bind function only to commit db changes on quit
+    root.title("video tagger")
+    root.mainloop()
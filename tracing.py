@@ -0,0 +1,230 @@
+import atexit
+import cProfile
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from settings import SETTINGS
+from instrumentation import RECORDER
+
+"""Opt-in tracing of how long the GUI takes to respond. Each traced Tk event handler becomes a span that starts
+when the handler is called and ends when Tk next goes idle, so it includes redrawing the widgets it changed.
+Inside it are child spans for the handler itself, the queries and ffmpeg runs it made (from instrumentation.py),
+image decoding and widget updates. Background tasks show up on their own threads' tracks, with arrows from the
+event that submitted them to the callback that used the result.
+
+Turn it on with UI_TRACE in settings.json, then open the file written by dump() (UI_TRACE_FILE) in Chrome's
+chrome://tracing or https://ui.perfetto.dev. With UI_PROFILE_SLOW_MS set every event is also run under cProfile,
+and the profiles of events slower than that are saved in UI_PROFILE_DIR for e.g. snakeviz or pstats.
+
+When UI_TRACE is off the decorators return the handlers unchanged and span() is a shared do-nothing context,
+so there is next to no cost. The settings are read by enabled() the first time one of these is used, not on
+import."""
+
+ENABLED = None  # until enabled() has read the settings
+PROFILE_SLOW_MS = None  # None means don't profile
+PROFILE_DIR = "ui_profiles"
+
+EPOCH = time.perf_counter()
+PID = os.getpid()
+NOTHING = nullcontext()
+
+events = deque()  # Chrome trace events, appending to a deque is thread safe. Bounded once tracing is on
+settings_lock = threading.Lock()
+thread_names = {}  # {thread id: name}
+local = threading.local()  # .depth of open spans on this thread
+flow_ids = itertools.count(1)
+root = None  # the Tk root, for after_idle
+
+
+def enabled():
+
+    """Whether UI_TRACE is on, reading the settings the first time it's asked. Queries and ffmpeg runs are only
+    added to the trace, and the trace only written at exit, if it is."""
+
+    global ENABLED, PROFILE_SLOW_MS, PROFILE_DIR, events
+    if ENABLED is None:
+        with settings_lock:
+            if ENABLED is None:
+                PROFILE_SLOW_MS = SETTINGS.get("UI_PROFILE_SLOW_MS")
+                PROFILE_DIR = SETTINGS.get("UI_PROFILE_DIR", PROFILE_DIR)
+                on = SETTINGS.get("UI_TRACE", False)
+                if on:
+                    # oldest trace events are dropped after UI_TRACE_EVENTS
+                    events = deque(maxlen=SETTINGS.get("UI_TRACE_EVENTS", 200000))
+                    RECORDER.listeners.append(operation_finished)
+                    atexit.register(dump)
+                ENABLED = on  # last, so no other thread goes ahead before the rest is set
+
+    return ENABLED
+
+
+def now_us():
+
+    return (time.perf_counter() - EPOCH) * 1e6
+
+
+def add_event(name, cat, start_us, end_us, tid=None, **args):
+
+    """A complete ("X") event, Chrome nests events on the same thread by their times"""
+
+    tid = tid or threading.get_ident()
+    if tid not in thread_names:
+        thread_names[tid] = threading.current_thread().name
+    events.append({"name": name, "cat": cat, "ph": "X", "ts": round(start_us, 3),
+                   "dur": round(max(end_us - start_us, 0), 3), "pid": PID, "tid": tid, "args": args})
+
+
+def in_event():
+
+    return getattr(local, "depth", 0) > 0
+
+
+@contextmanager
+def timed_span(name, cat, args):
+
+    local.depth = getattr(local, "depth", 0) + 1
+    start = now_us()
+    try:
+        yield
+    finally:
+        local.depth -= 1
+        add_event(name, cat, start, now_us(), **args)
+
+
+def span(name, cat="work", **args):
+
+    """Context manager timing a block as a child span, e.g. with span("decode"): ..."""
+
+    if not enabled():
+        return NOTHING
+    return timed_span(name, cat, args)
+
+
+def operation_finished(kind, name, seconds):
+
+    """Called by instrumentation.py for each query and ffmpeg run, on the thread that ran it"""
+
+    end = now_us()
+    add_event(name[:80], kind, end - seconds * 1e6, end, statement=name)
+
+
+def finish_event(name, start, handler_end, tid, profiler):
+
+    """Runs when Tk goes idle after the handler, i.e. after the window has caught up with what it changed"""
+
+    end = now_us()
+    add_event(f"{name} (redraw and queued events)", "idle", handler_end, end, tid)
+    add_event(name, "event", start, end, tid)
+    if profiler is not None and (end - start) / 1000 >= PROFILE_SLOW_MS:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        ms = round((end - start) / 1000)
+        filename = re.sub(r"[^\w.-]", "_", name)  # e.g. <lambda> isn't allowed in Windows file names
+        path = os.path.join(PROFILE_DIR, f"{filename}_{time.strftime('%Y%m%d-%H%M%S')}_{ms}ms.prof")
+        profiler.dump_stats(path)
+        print(f"Slow event {name} took {ms} ms, profile saved to {path}")
+
+
+@contextmanager
+def timed_event(name):
+
+    if in_event():  # e.g. next_entry calling save_entry, or a handler running the main loop's callbacks
+        with timed_span(name, "handler", {}):
+            yield
+        return
+    start = now_us()
+    profiler = cProfile.Profile() if PROFILE_SLOW_MS is not None else None
+    if profiler:
+        profiler.enable()
+    try:
+        with timed_span(f"{name} (handler)", "handler", {}):
+            yield
+    finally:
+        if profiler:
+            profiler.disable()
+        handler_end = now_us()
+        tid = threading.get_ident()
+        if root is not None:
+            root.after_idle(finish_event, name, start, handler_end, tid, profiler)
+        else:
+            finish_event(name, start, handler_end, tid, profiler)
+
+
+def event(name):
+
+    """Context manager tracing a block run by Tk as an event, from now until Tk is next idle"""
+
+    if not enabled():
+        return NOTHING
+    return timed_event(name)
+
+
+def traced(func):
+
+    """Decorator for Tk event handlers"""
+
+    if not enabled():
+        return func
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed_event(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def flow_start():
+
+    """Starts an arrow from the current span to wherever flow_end is called with the returned id"""
+
+    if not enabled():
+        return None
+    flow_id = next(flow_ids)
+    events.append({"name": "task", "cat": "flow", "ph": "s", "id": flow_id, "ts": round(now_us(), 3),
+                   "pid": PID, "tid": threading.get_ident()})
+    return flow_id
+
+
+def flow_step(flow_id):
+
+    """The arrow passes through the current span, e.g. the background task itself"""
+
+    if flow_id is not None:
+        events.append({"name": "task", "cat": "flow", "ph": "t", "id": flow_id, "ts": round(now_us(), 3),
+                       "pid": PID, "tid": threading.get_ident()})
+
+
+def flow_end(flow_id):
+
+    if flow_id is not None:
+        events.append({"name": "task", "cat": "flow", "ph": "f", "bp": "e", "id": flow_id,
+                       "ts": round(now_us(), 3), "pid": PID, "tid": threading.get_ident()})
+
+
+def attach(tk_root):
+
+    """Events are ended by after_idle on the Tk root, without one they end when the handler returns"""
+
+    global root
+    root = tk_root
+
+
+def dump(path=None):
+
+    """Writes the trace in Chrome trace event format, to UI_TRACE_FILE by default"""
+
+    path = path or SETTINGS.get("UI_TRACE_FILE", "ui_trace.json")
+    names = [{"name": "thread_name", "ph": "M", "pid": PID, "tid": tid, "args": {"name": name}}
+             for tid, name in list(thread_names.items())]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": names + list(events), "displayTimeUnit": "ms"}, f)
+    print(f"UI trace of {len(events)} events written to {path}")
+
+    return path
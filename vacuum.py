@@ -0,0 +1,12 @@
+from dbman_v4 import DBManager
+from settings import SETTINGS
+from sys import argv
+
+"""Standalone script to be invoked from the command line, deletes thumbnails left behind by removed videos and gives
+the free space in the database back to the disk. Pass --full the first time on an older database, this rewrites the
+whole file once so that later vacuums can be incremental."""
+
+db_manager = DBManager(SETTINGS["SQLPATH"])
+db_manager.collect_orphans()
+db_manager.reclaim_space(full="--full" in argv[1:])
+db_manager.commit_changes()